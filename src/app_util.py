@@ -5,48 +5,192 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import argparse
 import errno
+import gzip
+import importlib
+import io
 import json
 import logging
 import os
 import subprocess
 import sys
 import threading
+import time
+
+log = logging.getLogger("app_util")
+
+# Assets under static/ are generated by webpack with content hashes
+# in their names and so can be cached indefinitely.
+#
+STATIC_ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+GZIP_MIN_SIZE = 512
+GZIP_MIMETYPES = ("application/json",)
+
+# Frame trace sidecars are copied alongside images - see tracing.py.
+#
+TRACE_SIDECAR_EXT = ".trace"
 
 class CameraError(Exception):
     pass
 
+# Capture backends by name - see register_backend.
+#
+CAMERA_BACKENDS = {}
+
+# Backends registered by other modules, which are imported on demand.
+#
+LAZY_CAMERA_BACKENDS = {
+    "framebus": "framebus",
+}
+
+LATENCY_DECAY = 0.2
+
+def register_backend(cls):
+    """Registers a camera class as a capture backend.
+
+    Backends are selected per camera by `init_camera` using the
+    camera's `backend` config.
+    """
+    CAMERA_BACKENDS[cls.backend] = cls
+    return cls
+
 class CameraBase(object):
+    """Base class for capture backends.
+
+    Backends implement `_capture` to write a snapshot image to a path
+    and describe themselves with class attributes:
+
+        backend        name used in config
+        capabilities   features of the backend (e.g. "rtsp", "http",
+                       "persistent", "remote", "replay")
+        latency        nominal snapshot latency in seconds, used to
+                       select the fastest available backend
+
+    Measured snapshot latency is provided by `info`.
+    """
+
+    backend = None
+    capabilities = frozenset()
+    latency = None
 
     def __init__(self, key, config):
         self.key = key
         self.config = config
         self.enabled = config.get("enabled", True)
+        self._snapshots = 0
+        self._last_latency = None
+        self._mean_latency = None
 
+    @classmethod
+    def from_config(cls, key, config, **_opts):
+        return cls(key, camera_config(key, config))
+
+    @classmethod
+    def available(cls, _key, _config, **_opts):
+        """Returns True if the backend can be used for a camera.
+
+        config is the app config.
+        """
+        return True
+
+    def __str__(self):
+        return self.key
+
+    def snapshot(self, path, timeout=5):
+        start = time.time()
+        result = self._capture(path, timeout)
+        self._record_latency(time.time() - start)
+        return result
+
+    def _capture(self, _path, _timeout):
+        raise CameraError(
+            self.key, self.config,
+            (1, "", "%s backend doesn't support snapshots" % self.backend))
+
+    def _record_latency(self, latency):
+        self._snapshots += 1
+        self._last_latency = latency
+        if self._mean_latency is None:
+            self._mean_latency = latency
+        else:
+            self._mean_latency += LATENCY_DECAY * (
+                latency - self._mean_latency)
+
+    def info(self):
+        return {
+            "backend": self.backend,
+            "capabilities": sorted(self.capabilities),
+            "latency": self.latency,
+            "snapshots": self._snapshots,
+            "last_latency": self._last_latency,
+            "mean_latency": self._mean_latency,
+        }
+
+    def close(self):
+        pass
+
+@register_backend
 class CameraProxy(CameraBase):
-    """Camera proxy that uses rsync to obtain snapshot images."""
+    """Camera proxy that uses rsync to obtain snapshot images.
+
+    If `sidecar` is True, the image's trace sidecar (see tracing.py)
+    is copied with the image when available. In this case the
+    snapshot path must have the same name as the proxy image
+    (i.e. `<camera>.jpg`).
+    """
+
+    backend = "proxy"
+    capabilities = frozenset(["remote"])
+    latency = 0.5
 
     DEFAULT_HOST = "localhost"
     DEFAULT_IMAGE_DIR = "/tmp/camera-images"
 
-    def __init__(self, key, cam_config, proxy_config):
+    def __init__(self, key, cam_config, proxy_config, sidecar=False):
         super(CameraProxy, self).__init__(key, cam_config)
         self.src = self._init_src(key, proxy_config)
+        self.sidecar = sidecar
+
+    @classmethod
+    def from_config(cls, key, config, sidecar=False, **_opts):
+        cam_config = camera_config(key, config)
+        proxy_config = config.get("servers", {}).get("image-proxy", {})
+        return cls(key, cam_config, proxy_config, sidecar)
+
+    @classmethod
+    def available(cls, _key, config, **_opts):
+        return (
+            "image-proxy" in config.get("servers", {}) and
+            _which("rsync") is not None)
 
     def _init_src(self, key, proxy_config):
         host = proxy_config.get("host", self.DEFAULT_HOST)
         image_dir = proxy_config.get("image-dir", self.DEFAULT_IMAGE_DIR)
         return "{}:{}/{}.jpg".format(host, image_dir, key)
 
-    def __str__(self):
-        return self.key
-
-    def snapshot(self, path, timeout=5):
+    def _capture(self, path, timeout):
         cmd = [
             "rsync", "-vL",
             "--timeout", str(timeout),
             "-e", "ssh -o StrictHostKeyChecking=no",
-            self.src, path]
+        ]
+        if self.sidecar:
+            # Both files are copied in one transfer to the snapshot
+            # directory, which requires matching names. Updates are
+            # delayed so both files are put in place together.
+            if os.path.basename(path) != os.path.basename(self.src):
+                raise CameraError(
+                    self.key, self.config,
+                    (1, "", "snapshot path %s must be named %s to copy "
+                     "trace sidecar" % (path, os.path.basename(self.src))))
+            cmd.extend([
+                "--ignore-missing-args", "--delay-updates",
+                self.src, self.src + TRACE_SIDECAR_EXT,
+                os.path.dirname(path) or "."])
+        else:
+            cmd.extend([self.src, path])
         p = subprocess.Popen(
             cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         out, err = p.communicate()
@@ -54,6 +198,17 @@ class CameraProxy(CameraBase):
             raise CameraError(self.key, self.config, (p.returncode, out, err))
         return out, err
 
+def _rtsp_src(config):
+    host = config.get("host", "192.168.1.8")
+    user = config.get("user", "admin")
+    password = config.get("password", "admin")
+    return ("rtsp://{user}:{password}@{host}/"
+            "cam/realmonitor?channel=1&subtype=0").format(
+                user=user,
+                password=password,
+                host=host)
+
+@register_backend
 class Camera(CameraBase):
     """Camera that uses RTSP stream and ffmpeq to capture snapshots.
 
@@ -65,25 +220,23 @@ class Camera(CameraBase):
 
     """
 
+    backend = "ffmpeg"
+    capabilities = frozenset(["rtsp"])
+    latency = 2.0
+
     def __init__(self, key, config):
         super(Camera, self).__init__(key, config)
         self.src = self._init_src(config)
 
-    def __str__(self):
-        return self.key
+    @classmethod
+    def available(cls, _key, _config, **_opts):
+        return _which("ffmpeg") is not None
 
     @staticmethod
     def _init_src(config):
-        host = config.get("host", "192.168.1.8")
-        user = config.get("user", "admin")
-        password = config.get("password", "admin")
-        return ("rtsp://{user}:{password}@{host}/"
-                "cam/realmonitor?channel=1&subtype=0").format(
-                    user=user,
-                    password=password,
-                    host=host)
+        return _rtsp_src(config)
 
-    def snapshot(self, path, timeout=5):
+    def _capture(self, path, timeout):
         cmd = [
             "ffmpeg", "-y",
             "-i", self.src,
@@ -97,6 +250,306 @@ class Camera(CameraBase):
             raise CameraError(self.key, self.config, (p.returncode, out, err))
         return out, err
 
+@register_backend
+class StreamCamera(CameraBase):
+    """Camera that keeps an RTSP stream open using ffmpeg.
+
+    ffmpeg decodes the stream continuously and writes JPEG frames at
+    `stream-fps` (default 2) to a pipe. Snapshots use the latest frame,
+    which avoids connecting to the camera for each snapshot at the cost
+    of decoding the stream. ffmpeg is restarted if it exits.
+
+    Snapshots fail if the latest frame is older than `stream-max-age`
+    seconds (default 10), e.g. when the camera stops sending frames.
+    """
+
+    backend = "stream"
+    capabilities = frozenset(["rtsp", "persistent"])
+    latency = 0.01
+
+    DEFAULT_FPS = 2
+    DEFAULT_MAX_AGE = 10
+    READ_SIZE = 65536
+    MAX_FRAME_SIZE = 16 * 1024 * 1024
+    RESTART_DELAY = 1.0
+
+    def __init__(self, key, config):
+        super(StreamCamera, self).__init__(key, config)
+        self.src = _rtsp_src(config)
+        self.fps = config.get("stream-fps", self.DEFAULT_FPS)
+        self.max_age = config.get("stream-max-age", self.DEFAULT_MAX_AGE)
+        self._frame = None
+        self._frame_time = None
+        self._frame_cond = threading.Condition()
+        self._proc = None
+        self._stopped = False
+        self._reader = threading.Thread(target=self._read_stream)
+        self._reader.daemon = True
+        self._reader.start()
+
+    @classmethod
+    def available(cls, _key, _config, **_opts):
+        return _which("ffmpeg") is not None
+
+    def _read_stream(self):
+        while not self._stopped:
+            self._proc = subprocess.Popen(
+                ["ffmpeg", "-loglevel", "error",
+                 "-rtsp_transport", "tcp",
+                 "-i", self.src,
+                 "-r", str(self.fps),
+                 "-f", "image2pipe", "-vcodec", "mjpeg", "-"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            self._read_frames(self._proc.stdout)
+            # Frames from an exited stream aren't used.
+            self._set_frame(None)
+            err = self._proc.stderr.read()
+            self._proc.wait()
+            if not self._stopped:
+                log.warning(
+                    "stream for %s exited (%s): %s",
+                    self.key, self._proc.returncode, err.strip())
+                time.sleep(self.RESTART_DELAY)
+
+    def _read_frames(self, stream):
+        buf = b""
+        while True:
+            chunk = os.read(stream.fileno(), self.READ_SIZE)
+            if not chunk:
+                break
+            buf += chunk
+            # Frames are delimited by JPEG start and end markers.
+            while True:
+                start = buf.find(b"\xff\xd8")
+                if start == -1:
+                    # Keep a trailing byte that may start a marker.
+                    buf = buf[-1:]
+                    break
+                end = buf.find(b"\xff\xd9", start + 2)
+                if end == -1:
+                    buf = buf[start:]
+                    if len(buf) > self.MAX_FRAME_SIZE:
+                        log.warning(
+                            "discarding %i bytes from stream for %s "
+                            "without a frame end", len(buf), self.key)
+                        buf = b""
+                    break
+                self._set_frame(buf[start:end + 2])
+                buf = buf[end + 2:]
+
+    def _set_frame(self, frame):
+        with self._frame_cond:
+            self._frame = frame
+            self._frame_time = time.time()
+            self._frame_cond.notify_all()
+
+    def _capture(self, path, timeout):
+        with self._frame_cond:
+            if self._frame is None:
+                self._frame_cond.wait(timeout)
+            frame, frame_time = self._frame, self._frame_time
+        if frame is None:
+            raise CameraError(
+                self.key, self.config,
+                (1, "", "no frames from stream after %is" % timeout))
+        age = time.time() - frame_time
+        if age > self.max_age:
+            raise CameraError(
+                self.key, self.config,
+                (1, "", "last frame from stream is %is old" % age))
+        with open(path, "wb") as f:
+            f.write(frame)
+        return b"", b""
+
+    def close(self):
+        self._stopped = True
+        if self._proc and self._proc.poll() is None:
+            self._proc.terminate()
+
+@register_backend
+class HttpSnapshotCamera(CameraBase):
+    """Camera that uses HTTP snapshots with a pooled session.
+
+    Connections are reused across snapshots. Uses `snapshot-url` if
+    configured, otherwise the Amcrest/Dahua snapshot URL for `host`.
+    Requires requests.
+    """
+
+    backend = "http"
+    capabilities = frozenset(["http"])
+    latency = 0.3
+
+    def __init__(self, key, config):
+        super(HttpSnapshotCamera, self).__init__(key, config)
+        import requests
+        import requests.auth
+        self.src = config.get("snapshot-url") or (
+            "http://{}/cgi-bin/snapshot.cgi?channel=1".format(
+                config.get("host", "192.168.1.8")))
+        self._session = requests.Session()
+        self._session.auth = requests.auth.HTTPDigestAuth(
+            config.get("user", "admin"),
+            config.get("password", "admin"))
+
+    @classmethod
+    def available(cls, _key, _config, **_opts):
+        return _importable("requests")
+
+    def _capture(self, path, timeout):
+        import requests
+        try:
+            resp = self._session.get(self.src, timeout=timeout)
+        except requests.RequestException as e:
+            raise CameraError(self.key, self.config, (1, "", str(e)))
+        if resp.status_code != 200:
+            raise CameraError(
+                self.key, self.config,
+                (resp.status_code, resp.content, resp.reason))
+        with open(path, "wb") as f:
+            f.write(resp.content)
+        return b"", b""
+
+    def close(self):
+        self._session.close()
+
+@register_backend
+class ReplayCamera(CameraBase):
+    """Camera that replays images from a file or directory.
+
+    `replay` is the path of a JPEG image or a directory of images,
+    which are returned in name order and repeated. Used to test and
+    load test apps without cameras.
+    """
+
+    backend = "replay"
+    capabilities = frozenset(["replay"])
+    latency = 0.001
+
+    def __init__(self, key, config):
+        super(ReplayCamera, self).__init__(key, config)
+        self.src = config.get("replay", "")
+        self._paths = self._init_paths(self.src)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _init_paths(src):
+        if os.path.isdir(src):
+            return [
+                os.path.join(src, name)
+                for name in sorted(os.listdir(src))
+                if os.path.splitext(name)[1].lower() in (".jpg", ".jpeg")
+            ]
+        return [src]
+
+    @classmethod
+    def available(cls, key, config, **_opts):
+        return os.path.exists(camera_config(key, config).get("replay", ""))
+
+    def _capture(self, path, timeout):
+        if not self._paths:
+            raise CameraError(
+                self.key, self.config, (1, "", "no images in %s" % self.src))
+        with self._lock:
+            src = self._paths[self._next % len(self._paths)]
+            self._next += 1
+        with open(src, "rb") as f_in, open(path, "wb") as f_out:
+            f_out.write(f_in.read())
+        return b"", b""
+
+class Frame(object):
+    """An image shared by the stages of an app.
+
+    A frame carries its encoded bytes (e.g. from a camera), the image
+    as an ndarray decoded on first use and encodings of the image
+    created on first use for each format and size. Frames are shared
+    rather than copied, so the decoded image is read-only - use
+    `writable_image` for an image to draw on.
+    """
+
+    __slots__ = ("encoded", "format", "_image", "_encodings", "_lock")
+
+    def __init__(self, encoded=None, format="jpeg", image=None):
+        if encoded is None and image is None:
+            raise ValueError("frame requires encoded bytes or an image")
+        self.encoded = encoded
+        self.format = format
+        self._image = _read_only(image)
+        self._encodings = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "rb") as f:
+            encoded = f.read()
+        _, ext = os.path.splitext(path)
+        return cls(encoded, ext[1:].lower().replace("jpg", "jpeg"))
+
+    @property
+    def image(self):
+        with self._lock:
+            if self._image is None:
+                self._image = _read_only(_decode_image(self.encoded))
+            return self._image
+
+    def writable_image(self):
+        """Returns a copy of the image that can be modified.
+
+        If the image hasn't been decoded, it's decoded for the caller
+        and isn't kept, which avoids a copy.
+        """
+        with self._lock:
+            image = self._image
+        if image is None:
+            return _decode_image(self.encoded)
+        return image.copy()
+
+    def encode(self, format="png", size=None):
+        """Returns the image encoded in format and resized to size.
+
+        Encodings are created once for each format and size.
+        """
+        if (format == self.format and size is None and
+                self.encoded is not None):
+            return self.encoded
+        key = format, size
+        try:
+            return self._encodings[key]
+        except KeyError:
+            pass
+        image = self.image
+        with self._lock:
+            try:
+                return self._encodings[key]
+            except KeyError:
+                encoded = self._encodings[key] = _encode_image(
+                    image, format, size)
+                return encoded
+
+def _read_only(image):
+    if image is not None and image.flags.writeable:
+        image = image.view()
+        image.flags.writeable = False
+    return image
+
+def _decode_image(encoded):
+    import numpy as np
+    import PIL.Image
+    image = PIL.Image.open(io.BytesIO(encoded))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.array(image, dtype=np.uint8)
+
+def _encode_image(image, format, size):
+    import PIL.Image
+    pil_image = PIL.Image.fromarray(image)
+    if size is not None:
+        pil_image = pil_image.resize(size, PIL.Image.BILINEAR)
+    out = io.BytesIO()
+    pil_image.save(out, format.upper())
+    return out.getvalue()
+
 class DevServer(threading.Thread):
 
     def __init__(self, host, port, app_port, app_home):
@@ -126,6 +579,73 @@ class DevServer(threading.Thread):
         p = subprocess.Popen(args, env=env)
         p.wait()
 
+def init_app_responses(app):
+    """Configure app responses for production serving.
+
+    Adds long-lived cache headers to hashed static assets and gzip
+    encodes JSON responses for clients that accept it.
+    """
+    import flask
+    @app.after_request
+    def _after_request(resp):
+        _maybe_apply_static_cache(flask.request, resp)
+        _maybe_gzip(flask.request, resp)
+        return resp
+
+def _maybe_apply_static_cache(req, resp):
+    if resp.status_code == 200 and req.path.startswith("/static/"):
+        resp.headers["Cache-Control"] = (
+            "public, max-age=%i, immutable" % STATIC_ASSET_MAX_AGE)
+
+def _maybe_gzip(req, resp):
+    if (resp.status_code != 200 or
+            resp.direct_passthrough or
+            resp.mimetype not in GZIP_MIMETYPES or
+            "Content-Encoding" in resp.headers or
+            "gzip" not in req.headers.get("Accept-Encoding", "").lower()):
+        return
+    data = resp.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return
+    resp.set_data(_gzip_bytes(data))
+    resp.headers["Content-Encoding"] = "gzip"
+    resp.headers["Content-Length"] = str(len(resp.get_data()))
+    resp.vary.add("Accept-Encoding")
+
+def _gzip_bytes(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6) as f:
+        f.write(data)
+    return out.getvalue()
+
+def serve_app(app, host, port, threads, connection_limit=100,
+              channel_timeout=120):
+    """Serve app using a multi-threaded production WSGI server.
+
+    Requests are handled by a pool of threads in this process, which
+    lets app workers (e.g. detectors) be shared without loading them
+    more than once. Connections are kept alive for up to
+    `channel_timeout` seconds of inactivity.
+    """
+    try:
+        import waitress
+    except ImportError:
+        sys.stderr.write(
+            "Production mode requires waitress - "
+            "install it with 'pip install waitress'\n")
+        sys.exit(1)
+    init_app_responses(app)
+    log.info(
+        "serving on %s:%s with %i threads", host, port, threads)
+    waitress.serve(
+        app,
+        host=host,
+        port=port,
+        threads=threads,
+        connection_limit=connection_limit,
+        channel_timeout=channel_timeout,
+        ident=app.name)
+
 def ensure_dir(d):
     d = os.path.realpath(d)
     try:
@@ -141,21 +661,105 @@ def load_config(path):
         sys.stderr.write("Error reading {}: {}\n".format(path, e))
         sys.exit(1)
 
-def init_camera(key, config, use_image_proxy=False):
-    if use_image_proxy:
-        camera = _init_camera_proxy(key, config)
+def init_camera(key, config, use_image_proxy=False, sidecar=False,
+                frame_bus_dir=None, exclude=()):
+    """Returns a camera for key using a capture backend.
+
+    The backend is selected using the camera `backend` config, which
+    may be a backend name, a list of names in order of preference or
+    "auto" to use the available backend with the lowest nominal
+    latency. If `backend` isn't configured, the frame bus is used if
+    frame_bus_dir is specified, otherwise the image proxy if
+    use_image_proxy is True, otherwise ffmpeg.
+
+    "auto" only considers the frame bus if frame_bus_dir is specified
+    and the image proxy if use_image_proxy is True. Backends named in
+    exclude are never used - e.g. pump.py, which publishes frames to
+    the bus and proxy, excludes the backends that read from them.
+    """
+    opts = {"sidecar": sidecar, "bus_dir": frame_bus_dir}
+    cls = _camera_backend(
+        key, config, use_image_proxy, frame_bus_dir, exclude, opts)
+    log.debug("using %s backend for camera %s", cls.backend, key)
+    return cls.from_config(key, config, **opts)
+
+def camera_config(key, config):
+    return config.get("cameras", {}).get(key, {})
+
+def _camera_backend(key, config, use_image_proxy, frame_bus_dir, exclude,
+                    opts):
+    cam_config = camera_config(key, config)
+    backend = cam_config.get("backend")
+    if backend is None:
+        if frame_bus_dir and "framebus" not in exclude:
+            return _backend_cls(key, cam_config, "framebus")
+        if use_image_proxy and "proxy" not in exclude:
+            return CameraProxy
+        return Camera
+    if backend == "auto":
+        exclude = set(exclude)
+        if not frame_bus_dir:
+            exclude.add("framebus")
+        if not use_image_proxy:
+            exclude.add("proxy")
+        candidates = sorted(
+            _available_backend_classes(),
+            key=lambda cls: cls.latency)
     else:
-        camera = _init_default_camera(key, config)
-    return camera
+        names = backend if isinstance(backend, list) else [backend]
+        candidates = [_backend_cls(key, cam_config, name) for name in names]
+    for cls in candidates:
+        if cls.backend in exclude:
+            log.debug("%s backend excluded for camera %s", cls.backend, key)
+            continue
+        if cls.available(key, config, **opts):
+            return cls
+    raise CameraError(
+        key, cam_config, (1, "", "no available backend in %s" % backend))
+
+def _backend_cls(key, cam_config, name):
+    if name not in CAMERA_BACKENDS and name in LAZY_CAMERA_BACKENDS:
+        importlib.import_module(LAZY_CAMERA_BACKENDS[name])
+    try:
+        return CAMERA_BACKENDS[name]
+    except KeyError:
+        raise CameraError(
+            key, cam_config,
+            (1, "", "unknown backend '%s' (expected one of: %s)"
+             % (name, ", ".join(sorted(
+                 set(CAMERA_BACKENDS) | set(LAZY_CAMERA_BACKENDS))))))
+
+def _available_backend_classes():
+    for name, module in LAZY_CAMERA_BACKENDS.items():
+        if name not in CAMERA_BACKENDS:
+            try:
+                importlib.import_module(module)
+            except ImportError as e:
+                log.debug("%s backend not available: %s", name, e)
+    return list(CAMERA_BACKENDS.values())
 
-def _init_camera_proxy(key, config):
-    cam_config = config.get("cameras", {}).get(key, {})
-    proxy_config = config.get("servers", {}).get("image-proxy", {})
-    return CameraProxy(key, cam_config, proxy_config)
+def _which(cmd):
+    try:
+        from shutil import which
+    except ImportError:
+        from distutils.spawn import find_executable as which
+    return which(cmd)
 
-def _init_default_camera(key, config):
-    cam_config = config.get("cameras", {}).get(key, {})
-    return Camera(key, cam_config)
+def _importable(module):
+    try:
+        importlib.import_module(module)
+    except ImportError:
+        return False
+    else:
+        return True
+
+def parse_image_size(s):
+    """Parses WIDTHxHEIGHT for use as an argparse type."""
+    try:
+        width, height = s.lower().split("x")
+        return int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size '%s'" % s)
 
 def init_logging(debug):
     logging.basicConfig(
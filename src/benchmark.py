@@ -0,0 +1,463 @@
+"""Benchmark the scan detect path using synthetic cameras.
+
+Synthetic cameras serve recorded JPEGs (or generated frames if none
+are provided) at a fixed rate. Each camera is run in its own thread,
+as scan.Worker does, and each frame is taken through the same stages
+as scan:
+
+    capture   camera snapshot to file
+    decode    JPEG to image array
+    infer     graph run (detect.Detector.detect_image)
+    render    boxes and masks drawn on the image
+    encode    image to PNG
+    serve     GET /detected/<camera>.png from the scan app
+
+By default a tiny stand-in frozen graph is used so that results
+reflect the overhead of the detect path rather than of a model. Use
+`--graph` and `--labels` to benchmark an exported model.
+
+Each camera count is run in a separate process so that peak RSS is
+measured per count. Results are written as JSON. To compare with an
+earlier run use `--baseline`:
+
+    python benchmark.py --cameras 1,8,64 --output benchmark.json
+    python benchmark.py --baseline benchmark.json --output new.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import PIL.Image
+import six
+
+import tensorflow as tf
+
+import app_util
+import detect
+import scan
+
+log = logging.getLogger("benchmark")
+
+STAGES = ("capture", "decode", "infer", "render", "encode", "serve")
+
+STUB_DETECTIONS = 10
+
+STUB_LABELS = """\
+item {
+  id: 1
+  name: "object"
+}
+"""
+
+# Metrics compared against a baseline and whether higher is better.
+COMPARED_METRICS = [
+    ("fps", True),
+    ("peak_rss_mb", False),
+] + [
+    ("%s/%s" % (stage, pct), False)
+    for stage in STAGES + ("frame",)
+    for pct in ("p50", "p99")
+]
+
+class SyntheticCamera(app_util.CameraBase):
+    """Camera that serves recorded frames in turn."""
+
+    backend = "synthetic"
+    capabilities = frozenset(["replay"])
+    latency = 0
+
+    def __init__(self, key, frames):
+        super(SyntheticCamera, self).__init__(key, {})
+        self.src = "synthetic"
+        self._frames = frames
+        self._next = 0
+
+    def _capture(self, path, timeout):
+        frame = self._frames[self._next % len(self._frames)]
+        self._next += 1
+        with open(path, "wb") as f:
+            f.write(frame)
+        return b"", b""
+
+class BenchWorker(threading.Thread):
+    """Runs frames from a camera through the scan detect path."""
+
+    def __init__(self, camera, detector, app, working_dir, interval,
+                 stop_event):
+        super(BenchWorker, self).__init__()
+        self.key = camera.key
+        self.camera = camera
+        self.detector = detector
+        self.interval = interval
+        self.timings = {stage: [] for stage in STAGES + ("frame",)}
+        self.errors = 0
+        self._client = app.test_client()
+        self._image_path = os.path.join(working_dir, "%s.jpg" % camera.key)
+        self._detect_image = None
+        self._stop_event = stop_event
+
+    def run(self):
+        while not self._stop_event.is_set():
+            start = time.time()
+            try:
+                self._frame()
+            except Exception:
+                log.exception("camera %s", self.camera)
+                self.errors += 1
+            to_wait = max(0, self.interval - (time.time() - start))
+            if to_wait and self._stop_event.wait(to_wait):
+                break
+
+    def _frame(self):
+        t0 = time.time()
+        self.camera.snapshot(self._image_path)
+        with open(self._image_path, "rb") as f:
+            image_bytes = f.read()
+        t1 = time.time()
+        image = detect.Detector.init_image(image_bytes)
+        t2 = time.time()
+        result = self.detector.detect_image(image, image_bytes)
+        t3 = time.time()
+        self.detector.apply_detect_result(result, image)
+        t4 = time.time()
+        self._detect_image = detect.Detector.image_bytes(image)
+        t5 = time.time()
+        resp = self._client.get("/detected/%s.png" % self.key)
+        resp.get_data()
+        t6 = time.time()
+        if resp.status_code != 200:
+            raise RuntimeError("serve returned %s" % resp.status)
+        times = (t0, t1, t2, t3, t4, t5, t6)
+        for stage, start, stop in zip(STAGES, times, times[1:]):
+            self.timings[stage].append(stop - start)
+        self.timings["frame"].append(t6 - t0)
+
+    def read_detect_image(self):
+        if self._detect_image is None:
+            raise IOError(2, "no detect image")
+        return self._detect_image
+
+def build_stub_graph(path, num_detections=STUB_DETECTIONS):
+    """Writes a tiny frozen graph with the detection graph interface.
+
+    Scores are derived from the mean of the input image so that the
+    input is read by each run.
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        image = tf.placeholder(
+            tf.uint8, [None, None, None, 3], name="image_tensor")
+        batch_size = tf.shape(image)[0]
+        mean = tf.reduce_mean(tf.cast(image, tf.float32), axis=[1, 2, 3])
+        decay = tf.linspace(1.0, 0.1, num_detections)
+        tf.identity(
+            (mean[:, None] / 255.0) * decay[None, :],
+            name="detection_scores")
+        tf.tile(
+            tf.constant(_stub_boxes(num_detections))[None],
+            [batch_size, 1, 1],
+            name="detection_boxes")
+        tf.ones([batch_size, num_detections], name="detection_classes")
+        tf.fill(
+            [batch_size], float(num_detections), name="num_detections")
+    with open(path, "wb") as f:
+        f.write(graph.as_graph_def().SerializeToString())
+
+def _stub_boxes(n):
+    # Boxes along the diagonal, normalized ymin, xmin, ymax, xmax.
+    start = np.linspace(0.0, 0.8, n, dtype=np.float32)
+    return np.stack([start, start, start + 0.2, start + 0.2], axis=1)
+
+def load_frames(frames_dir, frame_size, count=8):
+    """Returns a list of JPEG encoded frames.
+
+    Frames are read from frames_dir if specified, otherwise `count`
+    frames of random noise are generated.
+    """
+    if frames_dir:
+        paths = sorted(
+            glob.glob(os.path.join(frames_dir, "*.jpg")) +
+            glob.glob(os.path.join(frames_dir, "*.jpeg")))
+        if not paths:
+            raise SystemExit("no JPEG frames in %s" % frames_dir)
+        return [open(path, "rb").read() for path in paths]
+    width, height = frame_size
+    rand = np.random.RandomState(0)
+    frames = []
+    for _ in range(count):
+        pixels = rand.randint(0, 256, (height, width, 3), dtype=np.uint8)
+        out = six.BytesIO()
+        PIL.Image.fromarray(pixels).save(out, "JPEG", quality=90)
+        frames.append(out.getvalue())
+    return frames
+
+def run_cameras(num_cameras, args):
+    """Runs num_cameras synthetic cameras and returns a result dict."""
+    working_dir = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        graph, labels = _graph_and_labels(args, working_dir)
+        detector = detect.Detector(graph, labels, args.box_line_size)
+        detector.warm()
+        frames = load_frames(args.frames_dir, args.frame_size)
+        stop_event = threading.Event()
+        interval = 1.0 / args.fps if args.fps > 0 else 0
+        workers = [
+            BenchWorker(
+                SyntheticCamera("cam%i" % i, frames),
+                detector,
+                scan.app,
+                working_dir,
+                interval,
+                stop_event)
+            for i in range(num_cameras)
+        ]
+        scan.app.workers = workers
+        start = time.time()
+        for w in workers:
+            w.start()
+        stop_event.wait(args.duration)
+        stop_event.set()
+        for w in workers:
+            w.join()
+        elapsed = time.time() - start
+        detector.close()
+        return _result(num_cameras, workers, elapsed)
+    finally:
+        shutil.rmtree(working_dir, ignore_errors=True)
+
+def _graph_and_labels(args, working_dir):
+    if args.graph:
+        return args.graph, args.labels
+    graph = os.path.join(working_dir, "stub_graph.pb")
+    labels = os.path.join(working_dir, "stub_labels.pbtxt")
+    build_stub_graph(graph)
+    with open(labels, "w") as f:
+        f.write(STUB_LABELS)
+    return graph, labels
+
+def _result(num_cameras, workers, elapsed):
+    frames = sum(len(w.timings["frame"]) for w in workers)
+    result = {
+        "cameras": num_cameras,
+        "duration": elapsed,
+        "frames": frames,
+        "errors": sum(w.errors for w in workers),
+        "fps": frames / elapsed,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+    for stage in STAGES + ("frame",):
+        times = np.concatenate([
+            np.asarray(w.timings[stage], dtype=np.float64) for w in workers
+        ])
+        result[stage] = _latency_stats(times)
+    return result
+
+def _latency_stats(times):
+    if not len(times):
+        return {"p50": None, "p99": None, "mean": None}
+    ms = times * 1000
+    return {
+        "p50": float(np.percentile(ms, 50)),
+        "p99": float(np.percentile(ms, 99)),
+        "mean": float(ms.mean()),
+    }
+
+def _peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    if sys.platform == "darwin":
+        return rss / (1024 * 1024)
+    return rss / 1024
+
+def run_all(args):
+    """Runs each camera count in a separate process."""
+    results = []
+    for num_cameras in args.cameras:
+        print(" * Benchmarking %i camera(s)" % num_cameras)
+        out = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__),
+             "--run-cameras", str(num_cameras)] + _passthrough_args(args))
+        result = json.loads(out.decode("utf-8").strip().splitlines()[-1])
+        _print_result(result)
+        results.append(result)
+    return {
+        "time": time.time(),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "tensorflow": tf.__version__,
+        "config": {
+            "graph": args.graph or "stub",
+            "frames-dir": args.frames_dir,
+            "frame-size": "%ix%i" % tuple(args.frame_size),
+            "fps": args.fps,
+            "duration": args.duration,
+        },
+        "results": results,
+    }
+
+def _passthrough_args(args):
+    passthrough = [
+        "--duration", str(args.duration),
+        "--fps", str(args.fps),
+        "--frame-size", "%ix%i" % tuple(args.frame_size),
+        "--box-line-size", str(args.box_line_size),
+    ]
+    if args.graph:
+        passthrough.extend(["--graph", args.graph, "--labels", args.labels])
+    if args.frames_dir:
+        passthrough.extend(["--frames-dir", args.frames_dir])
+    if args.debug:
+        passthrough.append("--debug")
+    return passthrough
+
+def _print_result(result):
+    print(
+        "   %(frames)i frames, %(fps).1f frames/sec, "
+        "%(peak_rss_mb).0f MB peak RSS" % result)
+    for stage in STAGES + ("frame",):
+        stats = result[stage]
+        if stats["p50"] is None:
+            continue
+        print(
+            "   %-8s p50 %8.2f ms  p99 %8.2f ms"
+            % (stage, stats["p50"], stats["p99"]))
+
+def compare(baseline, current, tolerance):
+    """Returns a list of regressions in current relative to baseline.
+
+    A metric regresses if it's worse than the baseline by more than
+    `tolerance` (a fraction of the baseline value).
+    """
+    by_cameras = {r["cameras"]: r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        base = by_cameras.get(result["cameras"])
+        if base is None:
+            continue
+        for name, higher_is_better in COMPARED_METRICS:
+            base_val = _metric(base, name)
+            val = _metric(result, name)
+            if not base_val or val is None:
+                continue
+            change = (val - base_val) / base_val
+            if higher_is_better:
+                change = -change
+            if change > tolerance:
+                regressions.append(
+                    (result["cameras"], name, base_val, val, change))
+    return regressions
+
+def _metric(result, name):
+    val = result
+    for part in name.split("/"):
+        val = val.get(part) if isinstance(val, dict) else None
+    return val
+
+def main():
+    args = _parse_args()
+    app_util.init_logging(args.debug)
+    if args.run_cameras:
+        print(json.dumps(run_cameras(args.run_cameras, args)))
+        return
+    report = run_all(args)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(" * Results written to %s" % args.output)
+    if args.baseline:
+        _check_baseline(args, report)
+
+def _check_baseline(args, report):
+    baseline = json.load(open(args.baseline))
+    regressions = compare(baseline, report, args.tolerance)
+    if not regressions:
+        print(" * No regressions compared to %s" % args.baseline)
+        return
+    for cameras, name, base_val, val, change in regressions:
+        print(
+            " * Regression (%i camera(s)) %s: %.2f -> %.2f (%+.0f%%)"
+            % (cameras, name, base_val, val, change * 100))
+    sys.exit(1)
+
+def _parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--cameras", metavar="N[,N...]",
+        default=[1, 8, 64],
+        type=_parse_int_list,
+        help="Camera counts to benchmark (1,8,64)")
+    p.add_argument(
+        "--duration", metavar="SECONDS",
+        default=30.0,
+        type=float,
+        help="Seconds to run each camera count for (30)")
+    p.add_argument(
+        "--fps", metavar="N",
+        default=5.0,
+        type=float,
+        help="Frames per second for each camera; 0 is unthrottled (5)")
+    p.add_argument(
+        "--frames-dir", metavar="PATH",
+        help="Directory of recorded JPEG frames (generated if not set)")
+    p.add_argument(
+        "--frame-size", metavar="WxH",
+        default=(1280, 720),
+        type=app_util.parse_image_size,
+        help="Size of generated frames (1280x720)")
+    p.add_argument(
+        "--graph", metavar="PATH",
+        help="Frozen detection graph (a stand-in graph if not set)")
+    p.add_argument(
+        "--labels", metavar="PATH",
+        default="labels.pbtxt",
+        help="Path to label proto used with GRAPH")
+    p.add_argument(
+        "--box-line-size", metavar="N",
+        default=4,
+        type=int,
+        help="Bounding box line width (4)")
+    p.add_argument(
+        "--output", metavar="PATH",
+        default="benchmark.json",
+        help="File to write results to (benchmark.json)")
+    p.add_argument(
+        "--baseline", metavar="PATH",
+        help="Results to compare with; exits with 1 on regression")
+    p.add_argument(
+        "--tolerance", metavar="FRACTION",
+        default=0.1,
+        type=float,
+        help="Change from baseline reported as a regression (0.1)")
+    p.add_argument(
+        "--run-cameras", metavar="N",
+        type=int,
+        help=argparse.SUPPRESS)
+    p.add_argument(
+        "--debug",
+        action="store_true",
+        help="Print debug info")
+    return p.parse_args()
+
+def _parse_int_list(s):
+    try:
+        return [int(part) for part in s.split(",") if part]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid list '%s'" % s)
+
+if __name__ == "__main__":
+    main()
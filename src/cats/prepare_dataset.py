@@ -1,4 +1,7 @@
 """Prepare a cats dataset from a set of annotated images.
+
+Use `--benchmark` to measure throughput on a generated dataset and
+`--profile` to write profiler output for a run.
 """
 
 from __future__ import absolute_import
@@ -6,9 +9,17 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import cProfile
+import collections
 import hashlib
+import os
+import pstats
 import random
+import shutil
 import sys
+import tempfile
+import threading
+import time
 
 import click
 from lxml import etree
@@ -18,12 +29,204 @@ import tensorflow as tf
 from object_detection.utils import dataset_util
 from object_detection.utils import label_map_util
 
+STAGES = ("xml", "read", "sha256", "serialize", "write")
+
+BENCHMARK_LABELS = ("Cat", "Other")
+
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+class StageStats(object):
+    """Time and bytes processed by each stage of record preparation."""
+
+    def __init__(self):
+        self.examples = 0
+        self.seconds = collections.defaultdict(float)
+        self.bytes = collections.defaultdict(int)
+        self._start = time.time()
+
+    def add(self, stage, seconds, nbytes=0):
+        self.seconds[stage] += seconds
+        self.bytes[stage] += nbytes
+
+    def report(self, out=sys.stdout):
+        elapsed = time.time() - self._start
+        staged = sum(self.seconds.values()) or 1
+        out.write(
+            "{} examples in {:.2f}s ({:.1f} examples/sec, {:.1f} MB/sec)\n"
+            .format(
+                self.examples,
+                elapsed,
+                _rate(self.examples, elapsed),
+                _rate(self.bytes["write"], elapsed) / 1024 / 1024))
+        out.write("{:<10} {:>9} {:>7} {:>9}\n".format(
+            "stage", "seconds", "share", "MB/sec"))
+        for stage in STAGES:
+            seconds = self.seconds[stage]
+            out.write("{:<10} {:>9.3f} {:>6.1f}% {:>9.1f}\n".format(
+                stage,
+                seconds,
+                seconds / staged * 100,
+                _rate(self.bytes[stage], seconds) / 1024 / 1024))
+
+def _rate(n, seconds):
+    return n / seconds if seconds > 0 else 0.0
+
+class StackSampler(threading.Thread):
+    """Samples the stack of a thread for use in flame graphs.
+
+    Samples are written in collapsed stack format (one `frame;frame
+    count` line per stack), which is read by flamegraph.pl and
+    speedscope.
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        super(StackSampler, self).__init__()
+        self.daemon = True
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.counts[_collapsed_stack(frame)] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+def _collapsed_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{} ({}:{})".format(
+            code.co_name,
+            os.path.basename(code.co_filename),
+            code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
 def main():
     args = _parse_args()
+    if args.benchmark:
+        _benchmark(args)
+    else:
+        _run(args)
+
+def _run(args, profile_dir=None):
+    if args.profile:
+        _profile(_prepare, args, profile_dir or args.output_dir)
+    else:
+        _prepare(args)
+
+def _prepare(args):
     labels = _init_labels(args)
     train, val = _init_examples(args)
-    _write_records("cats-train.record", train, labels, args)
-    _write_records("cats-val.record", val, labels, args)
+    stats = StageStats()
+    _write_records("cats-train.record", train, labels, stats, args)
+    _write_records("cats-val.record", val, labels, stats, args)
+    stats.report()
+
+def _benchmark(args):
+    profile_dir = args.output_dir
+    base_dir = tempfile.mkdtemp(prefix="prepare-dataset-benchmark-")
+    try:
+        print("Generating {} examples in {}".format(
+            args.benchmark_examples, base_dir))
+        _generate_dataset(base_dir, args)
+        args.images_dir = os.path.join(base_dir, "images")
+        args.annotations_dir = os.path.join(base_dir, "annotations")
+        args.labels = os.path.join(base_dir, "labels.pbtxt")
+        args.output_dir = base_dir
+        _run(args, profile_dir)
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+def _generate_dataset(base_dir, args):
+    import numpy as np
+    import PIL.Image
+    images_dir = os.path.join(base_dir, "images")
+    annotations_dir = os.path.join(base_dir, "annotations")
+    os.makedirs(images_dir)
+    os.makedirs(annotations_dir)
+    _write_benchmark_labels(os.path.join(base_dir, "labels.pbtxt"))
+    width, height = args.benchmark_image_size
+    rand = np.random.RandomState(519)
+    for i in range(args.benchmark_examples):
+        name = "example-{:06d}".format(i)
+        pixels = rand.randint(0, 256, (height, width, 3), dtype=np.uint8)
+        PIL.Image.fromarray(pixels).save(
+            os.path.join(images_dir, name + ".jpg"), "JPEG", quality=90)
+        objects = [
+            _random_object(rand, width, height)
+            for _ in range(rand.randint(1, 5))
+        ]
+        with open(os.path.join(annotations_dir, name + ".xml"), "wb") as f:
+            f.write(_annotation_xml(name + ".jpg", width, height, objects))
+
+def _write_benchmark_labels(path):
+    with open(path, "w") as f:
+        for i, name in enumerate(BENCHMARK_LABELS):
+            f.write("item {{\n  id: {}\n  name: '{}'\n}}\n\n".format(
+                i + 1, name))
+
+def _random_object(rand, width, height):
+    xmin, xmax = sorted(rand.randint(0, width, 2))
+    ymin, ymax = sorted(rand.randint(0, height, 2))
+    return {
+        "name": BENCHMARK_LABELS[rand.randint(len(BENCHMARK_LABELS))],
+        "pose": "Unspecified",
+        "truncated": "0",
+        "difficult": "0",
+        "bndbox": {
+            "xmin": str(xmin),
+            "ymin": str(ymin),
+            "xmax": str(xmax + 1),
+            "ymax": str(ymax + 1),
+        },
+    }
+
+def _annotation_xml(filename, width, height, objects):
+    root = etree.Element("annotation")
+    etree.SubElement(root, "filename").text = filename
+    size = etree.SubElement(root, "size_part")
+    etree.SubElement(size, "width").text = str(width)
+    etree.SubElement(size, "height").text = str(height)
+    etree.SubElement(size, "depth").text = "3"
+    for obj in objects:
+        _add_xml_fields(etree.SubElement(root, "object"), obj)
+    return etree.tostring(root)
+
+def _add_xml_fields(node, fields):
+    for name, val in sorted(fields.items()):
+        child = etree.SubElement(node, name)
+        if isinstance(val, dict):
+            _add_xml_fields(child, val)
+        else:
+            child.text = val
+
+def _profile(run, args, profile_dir):
+    prefix = os.path.join(profile_dir, "prepare-dataset")
+    sampler = StackSampler(threading.current_thread().ident)
+    profile = cProfile.Profile()
+    sampler.start()
+    profile.enable()
+    try:
+        run(args)
+    finally:
+        profile.disable()
+        sampler.stop()
+        profile.dump_stats(prefix + ".prof")
+        sampler.write(prefix + ".folded")
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(20)
+        print("Profile written to {0}.prof and {0}.folded".format(prefix))
 
 def _init_labels(args):
     return label_map_util.get_label_map_dict(args.labels)
@@ -44,15 +247,18 @@ def _split_examples(examples, args):
     val = int(len(examples) * args.val_split)
     return examples[val:], examples[:val]
 
-def _write_records(filename, examples, labels, args):
+def _write_records(filename, examples, labels, stats, args):
     path = os.path.join(args.output_dir, filename)
     writer = tf.python_io.TFRecordWriter(path)
     print("{} ({} examples):".format(path, len(examples)))
     if examples:
         with _progress(len(examples)) as bar:
             for example in examples:
-                record = _init_record(example, labels, args)
+                record = _init_record(example, labels, stats, args)
+                t0 = time.time()
                 writer.write(record)
+                stats.add("write", time.time() - t0, len(record))
+                stats.examples += 1
                 bar.update(1)
     writer.close()
 
@@ -61,12 +267,19 @@ def _progress(length):
     bar.is_hidden = False
     return bar
 
-def _init_record(example, labels, args):
-    ann = _init_annotation(example, args)
+def _init_record(example, labels, stats, args):
+    t0 = time.time()
+    ann, xml_size = _init_annotation(example, args)
+    t1 = time.time()
     image_filename = ann["filename"]
     image_path = os.path.join(args.images_dir, image_filename)
     image_bytes = open(image_path, "rb").read()
+    t2 = time.time()
     image_digest = hashlib.sha256(image_bytes).hexdigest()
+    t3 = time.time()
+    stats.add("xml", t1 - t0, xml_size)
+    stats.add("read", t2 - t1, len(image_bytes))
+    stats.add("sha256", t3 - t2, len(image_bytes))
     width = int(ann["size_part"]["width"])
     height = int(ann["size_part"]["height"])
     xmin = []
@@ -108,12 +321,16 @@ def _init_record(example, labels, args):
         "image/object/view": dataset_util.bytes_list_feature(poses),
     }
     example = tf.train.Example(features=tf.train.Features(feature=feature))
-    return example.SerializeToString()
+    record = example.SerializeToString()
+    stats.add("serialize", time.time() - t3, len(record))
+    return record
 
 def _init_annotation(example, args):
     path = os.path.join(args.annotations_dir, example + ".xml")
-    node = etree.fromstring(open(path, "r").read())
-    return dataset_util.recursive_parse_xml_to_dict(node)["annotation"]
+    xml = open(path, "rb").read()
+    node = etree.fromstring(xml)
+    ann = dataset_util.recursive_parse_xml_to_dict(node)["annotation"]
+    return ann, len(xml)
 
 def _parse_args():
     p = argparse.ArgumentParser()
@@ -138,7 +355,35 @@ def _parse_args():
         "--output-dir",
         default=".",
         help="Directory to write prepare dataset files (current directory)")
+    p.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Measure throughput using a generated dataset")
+    p.add_argument(
+        "--benchmark-examples", metavar="N",
+        default=500,
+        type=int,
+        help="Number of examples generated for --benchmark (500)")
+    p.add_argument(
+        "--benchmark-image-size", metavar="WxH",
+        default=(640, 480),
+        type=_parse_size,
+        help="Size of images generated for --benchmark (640x480)")
+    p.add_argument(
+        "--profile",
+        action="store_true",
+        help=(
+            "Write cProfile stats (prepare-dataset.prof) and sampled "
+            "stacks for flame graphs (prepare-dataset.folded) to "
+            "OUTPUT_DIR"))
     return p.parse_args()
 
+def _parse_size(s):
+    try:
+        width, height = s.lower().split("x")
+        return int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size '%s'" % s)
+
 if __name__ == "__main__":
     main()
@@ -17,6 +17,8 @@ import time
 import flask
 
 import app_util
+import framebus
+import retention
 
 log = logging.getLogger("collect")
 
@@ -44,10 +46,12 @@ def cameras():
 @app.route("/cameras/<key>/img.jpg")
 def image(key):
     camera = _camera(key)
-    latest_images[key] = img_bytes = _snapshot(camera)
-    return flask.Response(img_bytes, mimetype="image/jpeg")
+    latest_images[key] = frame = app_util.Frame(_snapshot(camera))
+    return flask.Response(frame.encoded, mimetype="image/jpeg")
 
 def _snapshot(camera):
+    if isinstance(camera, framebus.FrameBusCamera):
+        return _read_bus_frame(camera)
     with tempfile.NamedTemporaryFile(
                 prefix="collect-snashot-",
                 suffix=".jpg") as tmp:
@@ -59,14 +63,26 @@ def _snapshot(camera):
         else:
             return open(tmp.name, "rb").read()
 
+def _read_bus_frame(camera):
+    try:
+        frame = camera.read_frame()
+        # Copied as the frame is kept for saving.
+        img_bytes = frame.jpeg.tobytes()
+        frame.check()
+    except Exception:
+        log.exception("snapshot from %s", camera.key)
+        flask.abort(500)
+    else:
+        return img_bytes
+
 @app.route("/cameras/<key>/save", methods=["POST"])
 def save_image(key):
     try:
-        img_bytes = latest_images[key]
+        frame = latest_images[key]
     except KeyError:
         flask.abort(404)
     else:
-        _save_image(key, img_bytes)
+        _save_image(key, frame.encoded)
         return flask.Response(
             "",
             status=201,
@@ -98,9 +114,11 @@ def main():
     if args.dev:
         app_port = args.port + 1
         _start_dev_server(args, app_port)
+        app.run(host=args.host, port=app_port)
+    elif args.production:
+        app_util.serve_app(app, args.host, args.port, args.threads)
     else:
-        app_port = args.port
-    app.run(host=args.host, port=app_port)
+        app.run(host=args.host, port=args.port)
 
 def _copy_images_and_exit(src, dest):
     app_util.ensure_dir(dest)
@@ -123,14 +141,29 @@ def _init_app(args):
             for key in config.get("cameras", {})
         ]
         app.save_dir = args.save_dir
+        _maybe_start_retention(config, args)
+
+def _maybe_start_retention(config, args):
+    if "retention" not in config:
+        return
+    manager = retention.RetentionManager(config, save_dir=args.save_dir)
+    manager.start()
+    print(" * Retention applied to %s" % args.save_dir)
 
 def _init_camera(key, config, args):
-    camera = app_util.init_camera(key, config, args.use_image_proxy)
+    camera = app_util.init_camera(
+        key, config, args.use_image_proxy,
+        frame_bus_dir=_frame_bus_dir(args))
     print(
         " * Camera %s configured to read from %s"
         % (key, camera.src))
     return camera
 
+def _frame_bus_dir(args):
+    if not args.use_frame_bus:
+        return None
+    return args.frame_bus_dir or framebus.default_bus_dir()
+
 def _start_dev_server(args, app_port):
     app_home = os.path.join(HOME, "collect")
     server = app_util.DevServer(args.host, args.port, app_port, app_home)
@@ -147,6 +180,13 @@ def _parse_args():
         "--use-image-proxy",
         action="store_true",
         help="Use image-proxy to obtain images")
+    p.add_argument(
+        "--use-frame-bus",
+        action="store_true",
+        help="Read images from the local frame bus published by pump")
+    p.add_argument(
+        "--frame-bus-dir", metavar="PATH",
+        help="Frame bus directory (/dev/shm)")
     p.add_argument(
         "--host",
         default="0.0.0.0",
@@ -156,6 +196,15 @@ def _parse_args():
         default=8002,
         type=int,
         help="App port (8002)")
+    p.add_argument(
+        "--production",
+        action="store_true",
+        help="Serve app using a multi-threaded production server")
+    p.add_argument(
+        "--threads", metavar="N",
+        default=8,
+        type=int,
+        help="Number of server threads in production mode (8)")
     p.add_argument(
         "--save-dir",
         default="images",
@@ -6,23 +6,45 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import collections
+import contextlib
+import hashlib
+import json
+import logging
 import os
+import tempfile
 import threading
 
 import numpy as np
 import PIL
+import PIL.ImageColor
+import PIL.ImageDraw
 import six
 
 import tensorflow as tf
+from tensorflow.python.client import timeline
 
 from object_detection.utils import label_map_util
-from object_detection.utils import ops as utils_ops
 from object_detection.utils import visualization_utils as vis_util
 
-# Mask support is currently not working and this flag is used to
-# disable it.
+import app_util
+
+log = logging.getLogger("detect")
+
+# Instance masks are included in detect results for graphs that
+# provide them (e.g. Mask R-CNN). Set to False to ignore masks.
+#
+MASK_SUPPORT = True
+
+# Masks are only reframed and stored for detections scoring at least
+# MASK_SCORE_THRESHOLD. Mask pixels over MASK_THRESHOLD are set.
 #
-MASK_SUPPORT = False
+MASK_SCORE_THRESHOLD = 0.5
+MASK_THRESHOLD = 0.5
+MASK_ALPHA = 0.4
+
+# Shape of the blank image used to warm detectors.
+WARM_IMAGE_SHAPE = (480, 640, 3)
 
 class Detector(object):
 
@@ -33,28 +55,44 @@ class Detector(object):
         "detection_classes",
     )
 
-    def __init__(self, graph_path, labels_path, box_line_size=3):
-        self._sess = tf.Session()
-        self._load_graph_def(graph_path)
+    def __init__(self, graph_path, labels_path, box_line_size=3, cache=None,
+                 session_config=None):
+        # Each detector uses its own graph so that more than one
+        # detector can be used in a process.
+        graph = tf.Graph()
+        with graph.as_default():
+            self.graph_digest = self._load_graph_def(graph_path)
+        self._sess = tf.Session(graph=graph, config=session_config)
         self._init_tensors()
         self._category_index = self._init_category_index(labels_path)
         self._box_line_size = box_line_size
         self._lock = threading.Lock()
+        self._buffers = threading.local()
+        self._tracer = None
+        self.cache = cache
 
     def _init_tensors(self):
         self._detect_tensors = {
             name: self._graph_tensor(name + ":0")
             for name in self.detect_ops
         }
-        self._image_width_tensor = tf.placeholder(tf.int32)
-        self._image_height_tensor = tf.placeholder(tf.int32)
         self._image_tensor = self._graph_tensor("image_tensor:0")
-        self._maybe_apply_detect_masks()
+        self._maybe_init_mask_tensor()
+        self._init_detect_fn()
+
+    def _init_detect_fn(self):
+        self._detect_names = sorted(self._detect_tensors)
+        self._detect_fn = self._sess.make_callable(
+            [self._detect_tensors[name] for name in self._detect_names],
+            feed_list=[self._image_tensor],
+            accept_options=True)
 
     def _graph_tensor(self, name):
         return self._sess.graph.get_tensor_by_name(name)
 
-    def _maybe_apply_detect_masks(self):
+    def _maybe_init_mask_tensor(self):
+        # Box masks are fetched as is and reframed to the image for
+        # scoring detections only - see _format_result.
         if not MASK_SUPPORT:
             return
         try:
@@ -62,21 +100,7 @@ class Detector(object):
         except KeyError:
             return
         else:
-            self._apply_detect_masks(t)
-
-    def _apply_detect_masks(self, detect_masks_tensor):
-        ts = self._detect_tensors
-        masks = tf.squeeze(detect_masks_tensor, [0])
-        boxes = tf.squeeze(ts["detection_boxes"], [0])
-        num_detections = tf.cast(ts["num_detections"][0], tf.int32)
-        masks = tf.slice(masks, [0, 0, 0], [num_detections, -1, -1])
-        boxes = tf.slice(boxes, [0, 0], [num_detections, -1])
-        masks_reframed = utils_ops.reframe_box_masks_to_image_masks(
-            masks, boxes,
-            self._image_height_tensor,
-            self._image_width_tensor)
-        masks_reframed = tf.cast(tf.greater(masks_reframed, 0.5), tf.uint8)
-        ts["detection_masks"] = tf.expand_dims(masks_reframed, 0)
+            self._detect_tensors["detection_masks"] = t
 
     def __enter__(self):
         self._lock.acquire()
@@ -87,9 +111,11 @@ class Detector(object):
 
     @staticmethod
     def _load_graph_def(graph_path):
+        graph_bytes = open(graph_path, "rb").read()
         graph_def = tf.GraphDef()
-        graph_def.ParseFromString(open(graph_path, "rb").read())
+        graph_def.ParseFromString(graph_bytes)
         tf.import_graph_def(graph_def, name="")
+        return hashlib.sha256(graph_bytes).hexdigest()
 
     @staticmethod
     def _init_category_index(labels_path):
@@ -100,30 +126,126 @@ class Detector(object):
         ]
         return label_map_util.create_category_index(categories)
 
-    def detect(self, image_bytes):
-        image = self._init_image(image_bytes)
-        detect_result = self._run_detect(image)
-        self._apply_detect_result(detect_result, image)
+    def detect(self, image_bytes, roi=None, image=None):
+        """Detects objects in image_bytes.
+
+        If image is specified it's used as the decoded image_bytes and
+        is drawn on.
+        """
+        if image is None:
+            image = self.init_image(image_bytes)
+        detect_result = self.detect_image(image, image_bytes, roi)
+        self.apply_detect_result(detect_result, image)
         return detect_result, image
 
+    def detect_image(self, image, image_bytes, roi=None):
+        """Returns the detect result for a decoded image.
+
+        image_bytes are the encoded bytes of image and are used to
+        look up cached results. The image is not modified.
+        """
+        cache_key = self._cache_key(image_bytes, roi)
+        detect_result = self.cache.get(cache_key) if self.cache else None
+        if detect_result is None:
+            if roi:
+                detect_result = self._run_roi_detect(image, roi)
+            else:
+                detect_result = self._run_detect(image)
+            if self.cache:
+                self.cache.put(cache_key, detect_result)
+        return detect_result
+
+    def for_camera(self, _camera_config):
+        return self
+
+    def trace(self, tracer):
+        """Traces graph runs using tracer; None stops tracing."""
+        self._tracer = tracer
+
+    def warm(self):
+        """Runs the graph once so the first detection isn't slow."""
+        self._run_detect(np.zeros(WARM_IMAGE_SHAPE, dtype=np.uint8))
+
+    def close(self):
+        self._sess.close()
+
+    def metrics(self):
+        return {
+            "cache": self.cache.stats() if self.cache else None,
+        }
+
+    def _cache_key(self, image_bytes, roi):
+        if not self.cache:
+            return None
+        h = hashlib.sha256(image_bytes)
+        h.update(self.graph_digest.encode())
+        if roi:
+            h.update(roi.cache_key().encode())
+        return h.hexdigest()
+
     @staticmethod
-    def _init_image(image_bytes):
+    def init_image(image_bytes):
+        # Decodes straight to a uint8 HxWx3 array - one allocation per
+        # frame rather than via an intermediate int64 pixel list.
         image = PIL.Image.open(six.BytesIO(image_bytes))
-        width, height = image.size
-        image_np = np.array(image.getdata())
-        return image_np.reshape((height, width, 3)).astype(np.uint8)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return np.array(image, dtype=np.uint8)
 
     def _run_detect(self, image):
-        inputs = {
-            self._image_tensor: np.expand_dims(image, axis=0),
-            self._image_height_tensor: image.shape[0],
-            self._image_width_tensor: image.shape[1],
+        # A batch of one is a view of image and so isn't copied.
+        outputs = self._run(image[np.newaxis])
+        return self._format_result(outputs, image.shape)
+
+    def _run(self, batch):
+        tracer = self._tracer
+        if tracer is not None and tracer.claim():
+            run_metadata = tf.RunMetadata()
+            outputs = self._detect_fn(
+                batch,
+                options=tf.RunOptions(
+                    trace_level=tf.RunOptions.FULL_TRACE),
+                run_metadata=run_metadata)
+            tracer.add(run_metadata)
+        else:
+            outputs = self._detect_fn(batch)
+        return dict(zip(self._detect_names, outputs))
+
+    def _input_buffer(self, shape):
+        # Input buffers are per thread as workers share a detector.
+        try:
+            by_shape = self._buffers.by_shape
+        except AttributeError:
+            by_shape = self._buffers.by_shape = {}
+        try:
+            return by_shape[shape]
+        except KeyError:
+            buf = by_shape[shape] = np.empty(shape, dtype=np.uint8)
+            return buf
+
+    def _run_roi_detect(self, image, roi):
+        height, width = image.shape[:2]
+        windows = roi.windows(width, height)
+        _, _, tile_w, tile_h = windows[0]
+        batch = self._input_buffer((len(windows), tile_h, tile_w, 3))
+        for i, (x, y, w, h) in enumerate(windows):
+            roi.apply_mask(image, x, y, w, h, out=batch[i])
+        # Instance masks are not supported for tiled detection.
+        outputs = self._run(batch)
+        boxes, scores, classes = _merge_window_detections(
+            outputs, windows, width, height)
+        keep = roi.filter_boxes(boxes, width, height)
+        keep = keep[nms(boxes[keep], scores[keep], classes[keep],
+                        roi.nms_threshold, roi.max_detections)]
+        return {
+            "num_detections": len(keep),
+            "detection_classes": classes[keep].astype(np.uint8),
+            "detection_boxes": boxes[keep],
+            "detection_scores": scores[keep],
         }
-        outputs = self._sess.run(self._detect_tensors, feed_dict=inputs)
-        return self._format_result(outputs)
 
     @staticmethod
-    def _format_result(result):
+    def _format_result(result, image_shape):
         val = lambda name: result[name][0]
         formatted = {
             "num_detections": int(val("num_detections")),
@@ -132,19 +254,24 @@ class Detector(object):
             "detection_scores": val("detection_scores"),
         }
         if "detection_masks" in result:
-            formatted["detection_masks"] = val("detection_masks")[0]
+            formatted.update(_reframe_masks(
+                val("detection_masks"),
+                formatted["detection_boxes"],
+                formatted["detection_scores"],
+                formatted["num_detections"],
+                image_shape[:2]))
         return formatted
 
-    def _apply_detect_result(self, detect_result, image):
+    def apply_detect_result(self, detect_result, image):
         vis_util.visualize_boxes_and_labels_on_image_array(
             image,
             detect_result["detection_boxes"],
             detect_result["detection_classes"],
             detect_result["detection_scores"],
             self._category_index,
-            instance_masks=detect_result.get("detection_masks"),
             use_normalized_coordinates=True,
             line_thickness=self._box_line_size)
+        _blend_masks(image, detect_result)
 
     def write_image(self, image, path):
         image = PIL.Image.fromarray(image)
@@ -166,9 +293,579 @@ class Detector(object):
             if e.errno != 17: # exists
                 raise
 
+def session_config(intra_op_threads=0, inter_op_threads=0):
+    """Returns a session config using the specified threads.
+
+    0 lets TensorFlow choose the number of threads (one per core).
+    """
+    config = tf.ConfigProto()
+    config.intra_op_parallelism_threads = intra_op_threads
+    config.inter_op_parallelism_threads = inter_op_threads
+    return config
+
+class DetectorPool(object):
+    """Spreads detections over several detectors of the same graph.
+
+    Each detector runs the graph in its own session. Detections use
+    the detector with the fewest detections in progress. Used to run
+    a graph in more than one session with fewer threads each - see
+    session_tune.py.
+    """
+
+    def __init__(self, detectors):
+        self.detectors = detectors
+        self.graph_digest = detectors[0].graph_digest
+        self.cache = detectors[0].cache
+        self._lock = threading.Lock()
+        self._active = [0] * len(detectors)
+
+    @contextlib.contextmanager
+    def _acquire(self):
+        with self._lock:
+            i = self._active.index(min(self._active))
+            self._active[i] += 1
+        try:
+            yield self.detectors[i]
+        finally:
+            with self._lock:
+                self._active[i] -= 1
+
+    def detect(self, image_bytes, roi=None, image=None):
+        with self._acquire() as detector:
+            return detector.detect(image_bytes, roi, image)
+
+    def detect_image(self, image, image_bytes, roi=None):
+        with self._acquire() as detector:
+            return detector.detect_image(image, image_bytes, roi)
+
+    def apply_detect_result(self, detect_result, image):
+        self.detectors[0].apply_detect_result(detect_result, image)
+
+    def write_image(self, image, path):
+        self.detectors[0].write_image(image, path)
+
+    def for_camera(self, _camera_config):
+        return self
+
+    def trace(self, tracer):
+        for detector in self.detectors:
+            detector.trace(tracer)
+
+    def warm(self):
+        for detector in self.detectors:
+            detector.warm()
+
+    def close(self):
+        for detector in self.detectors:
+            detector.close()
+
+    def metrics(self):
+        metrics = self.detectors[0].metrics()
+        with self._lock:
+            metrics["sessions"] = {
+                "count": len(self.detectors),
+                "active": list(self._active),
+            }
+        return metrics
+
+class RunTracer(object):
+    """Collects Chrome traces for up to `runs` graph runs."""
+
+    def __init__(self, runs):
+        self.runs = runs
+        self._claimed = 0
+        self._events = []
+        self._lock = threading.Lock()
+
+    def claim(self):
+        with self._lock:
+            if self._claimed >= self.runs:
+                return False
+            self._claimed += 1
+            return True
+
+    def add(self, run_metadata):
+        trace = timeline.Timeline(run_metadata.step_stats)
+        events = json.loads(
+            trace.generate_chrome_trace_format())["traceEvents"]
+        with self._lock:
+            self._events.extend(events)
+
+    def chrome_trace(self):
+        """Returns collected runs in Chrome trace format."""
+        with self._lock:
+            return {"traceEvents": list(self._events)}
+
+class Cascade(object):
+    """Detects using a cheap screen detector and an expensive detector.
+
+    Frames are first run through the screen detector. Only frames with
+    a screen detection scoring at least `threshold` are run through
+    the full detector. Frames that don't pass the screen use the
+    screen result.
+
+    Routing is configured per camera with `route` in the camera
+    config: `cascade` (default) screens frames, `full` always uses
+    the full detector and `screen` only uses the screen detector.
+    `screen-threshold` overrides the threshold for a camera.
+    """
+
+    routes = ("cascade", "full", "screen")
+
+    def __init__(self, screen, full, threshold=0.5):
+        self.screen = screen
+        self.full = full
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._stats = {
+            "screened": 0,
+            "escalated": 0,
+            "full": 0,
+            "screen": 0,
+        }
+
+    def for_camera(self, camera_config):
+        route = camera_config.get("route", "cascade")
+        if route not in self.routes:
+            raise ValueError(
+                "unsupported route '%s' (expected one of: %s)"
+                % (route, ", ".join(self.routes)))
+        threshold = camera_config.get("screen-threshold", self.threshold)
+        return CascadeRoute(self, route, threshold)
+
+    def detect(self, image_bytes, roi=None, route="cascade", threshold=None,
+               image=None):
+        if threshold is None:
+            threshold = self.threshold
+        if image is None:
+            image = Detector.init_image(image_bytes)
+        detector, detect_result = self._route(
+            image, image_bytes, roi, route, threshold)
+        if detect_result is None:
+            detect_result = detector.detect_image(image, image_bytes, roi)
+        detector.apply_detect_result(detect_result, image)
+        return detect_result, image
+
+    def _route(self, image, image_bytes, roi, route, threshold):
+        """Returns the detector for image and its result if known."""
+        if route == "full":
+            self._incr("full")
+            return self.full, None
+        if route == "screen":
+            self._incr("screen")
+            return self.screen, None
+        screen_result = self.screen.detect_image(image, image_bytes, roi)
+        self._incr("screened")
+        scores = screen_result["detection_scores"]
+        if np.any(scores[:screen_result["num_detections"]] >= threshold):
+            self._incr("escalated")
+            return self.full, None
+        return self.screen, screen_result
+
+    def _incr(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def trace(self, tracer):
+        self.screen.trace(tracer)
+        self.full.trace(tracer)
+
+    def warm(self):
+        self.screen.warm()
+        self.full.warm()
+
+    def close(self):
+        self.screen.close()
+        self.full.close()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["escalation_rate"] = (
+            stats["escalated"] / stats["screened"]
+            if stats["screened"] else 0.0)
+        return {
+            "cascade": stats,
+            "screen": self.screen.metrics(),
+            "full": self.full.metrics(),
+        }
+
+class CascadeRoute(object):
+    """Cascade detection using a camera's route and threshold."""
+
+    def __init__(self, cascade, route, threshold):
+        self.cascade = cascade
+        self.route = route
+        self.threshold = threshold
+
+    def detect(self, image_bytes, roi=None, image=None):
+        return self.cascade.detect(
+            image_bytes, roi, self.route, self.threshold, image)
+
+def _reframe_masks(masks, boxes, scores, num_detections, image_size):
+    """Returns bit packed image masks for scoring detections.
+
+    Each box mask is resized to its box in image pixels, thresholded
+    and packed to bits. Masks are stored as concatenated bits with
+    offsets so that results remain a flat dict of arrays - use
+    `iter_masks` to read them.
+    """
+    height, width = image_size
+    scale = np.array([height, width, height, width], dtype=np.float32)
+    indices = np.flatnonzero(
+        scores[:num_detections] >= MASK_SCORE_THRESHOLD).astype(np.int32)
+    pixel_boxes = np.round(boxes[indices] * scale).astype(np.int32)
+    pixel_boxes[:, 2] = np.maximum(pixel_boxes[:, 2], pixel_boxes[:, 0] + 1)
+    pixel_boxes[:, 3] = np.maximum(pixel_boxes[:, 3], pixel_boxes[:, 1] + 1)
+    packed = []
+    for i, (y1, x1, y2, x2) in zip(indices, pixel_boxes):
+        box_mask = PIL.Image.fromarray(masks[i].astype(np.float32), "F")
+        box_mask = box_mask.resize((x2 - x1, y2 - y1), PIL.Image.BILINEAR)
+        packed.append(np.packbits(np.asarray(box_mask) > MASK_THRESHOLD))
+    offsets = np.zeros(len(packed) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(bits) for bits in packed])
+    return {
+        "detection_mask_indices": indices,
+        "detection_mask_boxes": pixel_boxes,
+        "detection_mask_offsets": offsets,
+        "detection_mask_bits": (
+            np.concatenate(packed) if packed
+            else np.zeros((0,), dtype=np.uint8)),
+    }
+
+def iter_masks(detect_result):
+    """Yields (detection index, pixel box, mask) for result masks.
+
+    Pixel boxes are (ymin, xmin, ymax, xmax) and masks are boolean
+    arrays the size of their box.
+    """
+    if "detection_mask_indices" not in detect_result:
+        return
+    bits = detect_result["detection_mask_bits"]
+    offsets = detect_result["detection_mask_offsets"]
+    for n, (i, box) in enumerate(zip(
+            detect_result["detection_mask_indices"],
+            detect_result["detection_mask_boxes"])):
+        y1, x1, y2, x2 = box
+        size = (y2 - y1) * (x2 - x1)
+        mask = np.unpackbits(bits[offsets[n]:offsets[n + 1]])[:size]
+        yield i, box, mask.reshape((y2 - y1, x2 - x1)).astype(bool)
+
+def _blend_masks(image, detect_result, alpha=MASK_ALPHA):
+    height, width = image.shape[:2]
+    classes = detect_result["detection_classes"]
+    for i, (y1, x1, y2, x2), mask in iter_masks(detect_result):
+        # Masks for boxes extending past the image are clipped.
+        mask = mask[:max(0, height - y1), :max(0, width - x1)]
+        region = image[y1:y1 + mask.shape[0], x1:x1 + mask.shape[1]]
+        color = np.array(_class_color(classes[i]), dtype=np.float32)
+        region[mask] = (region[mask] * (1 - alpha) + color * alpha).astype(
+            np.uint8)
+
+def _class_color(class_id):
+    # Same colors used for boxes by visualize_boxes_and_labels_...
+    colors = vis_util.STANDARD_COLORS
+    return PIL.ImageColor.getrgb(colors[class_id % len(colors)])
+
+class ROI(object):
+    """Region of interest used to limit and tile detection.
+
+    Configured for a camera using `roi` in the camera config:
+
+        "roi": {
+          "crop": [0.25, 0.0, 1.0, 0.75],
+          "mask": [[[0.3, 0.0], [1.0, 0.0], [1.0, 0.75], [0.3, 0.75]]],
+          "tiles": [2, 2],
+          "tile-overlap": 0.2
+        }
+
+    `crop` is a region (xmin, ymin, xmax, ymax) in normalized image
+    coordinates. `mask` is a list of polygons in normalized image
+    coordinates - pixels outside the polygons are blacked out and
+    detections centered outside them are dropped. `tiles` splits the
+    cropped region into columns and rows of equally sized tiles, which
+    overlap by `tile-overlap` and are detected in a single batch.
+    """
+
+    def __init__(self, crop=None, mask=None, tiles=(1, 1),
+                 tile_overlap=0.0, nms_threshold=0.5, max_detections=100):
+        self.crop = crop or (0.0, 0.0, 1.0, 1.0)
+        self.mask = mask
+        self.tiles = _validate_tiles(tiles)
+        self.tile_overlap = _validate_tile_overlap(tile_overlap)
+        self.nms_threshold = nms_threshold
+        self.max_detections = max_detections
+        self._mask_cache = {}
+
+    def cache_key(self):
+        return repr((
+            tuple(self.crop),
+            self.mask,
+            self.tiles,
+            self.tile_overlap,
+            self.nms_threshold,
+            self.max_detections))
+
+    @classmethod
+    def from_config(cls, config):
+        roi = config.get("roi")
+        if not roi:
+            return None
+        return cls(
+            crop=roi.get("crop"),
+            mask=roi.get("mask"),
+            tiles=roi.get("tiles", (1, 1)),
+            tile_overlap=roi.get("tile-overlap", 0.0),
+            nms_threshold=roi.get("nms-threshold", 0.5),
+            max_detections=roi.get("max-detections", 100))
+
+    def windows(self, width, height):
+        """Returns a list of (x, y, w, h) tile windows for image size."""
+        xmin, ymin, xmax, ymax = self.crop
+        x0, y0 = int(xmin * width), int(ymin * height)
+        crop_w = max(1, int(xmax * width) - x0)
+        crop_h = max(1, int(ymax * height) - y0)
+        cols, rows = self.tiles
+        tile_w = _tile_size(crop_w, cols, self.tile_overlap)
+        tile_h = _tile_size(crop_h, rows, self.tile_overlap)
+        return [
+            (x0 + x, y0 + y, tile_w, tile_h)
+            for y in _tile_offsets(crop_h, tile_h, rows)
+            for x in _tile_offsets(crop_w, tile_w, cols)
+        ]
+
+    def apply_mask(self, image, x, y, w, h, out=None):
+        """Returns the window of image with pixels outside mask cleared.
+
+        If out is specified, the window is written to it.
+        """
+        window = image[y:y + h, x:x + w]
+        if not self.mask:
+            if out is None:
+                return window
+            out[...] = window
+            return out
+        mask = self._image_mask(image.shape[1], image.shape[0])
+        return np.multiply(
+            window, mask[y:y + h, x:x + w, None],
+            out=out, casting="unsafe")
+
+    def _image_mask(self, width, height):
+        try:
+            return self._mask_cache[(width, height)]
+        except KeyError:
+            mask_image = PIL.Image.new("1", (width, height), 0)
+            draw = PIL.ImageDraw.Draw(mask_image)
+            for polygon in self.mask:
+                draw.polygon(
+                    [(px * width, py * height) for px, py in polygon],
+                    fill=1)
+            mask = self._mask_cache[(width, height)] = np.array(
+                mask_image, dtype=bool)
+            return mask
+
+    def filter_boxes(self, boxes, width, height):
+        """Returns indices of boxes centered inside the mask."""
+        if not self.mask or not len(boxes):
+            return np.arange(len(boxes))
+        mask = self._image_mask(width, height)
+        cy = ((boxes[:, 0] + boxes[:, 2]) / 2 * (height - 1)).astype(int)
+        cx = ((boxes[:, 1] + boxes[:, 3]) / 2 * (width - 1)).astype(int)
+        return np.flatnonzero(mask[cy, cx])
+
+class ResultCache(object):
+    """LRU cache of detect results keyed by image and graph digest.
+
+    Results are kept in memory up to `max_bytes` (array bytes). If
+    `cache_dir` is specified, results are also saved there and read
+    back when they aren't in memory.
+    """
+
+    def __init__(self, max_bytes, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+        if cache_dir:
+            app_util.ensure_dir(cache_dir)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                result = self._entries.pop(key)
+            except KeyError:
+                pass
+            else:
+                self._entries[key] = result
+                self._stats["hits"] += 1
+                return result
+        result = self._read_disk(key)
+        with self._lock:
+            if result is None:
+                self._stats["misses"] += 1
+            else:
+                self._stats["disk_hits"] += 1
+                self._put_memory(key, result)
+        return result
+
+    def put(self, key, result):
+        with self._lock:
+            self._put_memory(key, result)
+        self._write_disk(key, result)
+
+    def _put_memory(self, key, result):
+        size = _result_bytes(result)
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= _result_bytes(old)
+        self._entries[key] = result
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= _result_bytes(evicted)
+            self._stats["evictions"] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def _read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with np.load(self._disk_path(key)) as data:
+                result = {name: data[name] for name in data.files}
+        except (IOError, ValueError):
+            return None
+        result["num_detections"] = int(result["num_detections"])
+        return result
+
+    def _write_disk(self, key, result):
+        if not self.cache_dir:
+            return
+        # Results are cached on a best effort basis - a failed write
+        # (e.g. a full disk) only costs a later detect.
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **result)
+            os.rename(tmp, self._disk_path(key))
+        except Exception as e:
+            log.warning("unable to write cached result %s: %s", key, e)
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (
+            (stats["hits"] + stats["disk_hits"]) / lookups
+            if lookups else 0.0)
+        return stats
+
+def _result_bytes(result):
+    return sum(
+        val.nbytes for val in result.values()
+        if isinstance(val, np.ndarray))
+
+def init_cache(size_mb, cache_dir=None):
+    if size_mb <= 0 and not cache_dir:
+        return None
+    return ResultCache(max(0, size_mb) * 1024 * 1024, cache_dir)
+
+def _validate_tiles(tiles):
+    tiles = tuple(tiles)
+    if len(tiles) != 2 or not all(
+            isinstance(n, six.integer_types) and n > 0 for n in tiles):
+        raise ValueError(
+            "invalid roi tiles %r (expected [COLUMNS, ROWS] of positive "
+            "integers)" % (tiles,))
+    return tiles
+
+def _validate_tile_overlap(overlap):
+    # Tiles must advance across the region - see _tile_size.
+    if (not isinstance(overlap, (float,) + six.integer_types) or
+            not 0 <= overlap < 1):
+        raise ValueError(
+            "invalid roi tile-overlap %r (expected 0 <= overlap < 1)"
+            % (overlap,))
+    return overlap
+
+def _tile_size(size, count, overlap):
+    if count <= 1:
+        return size
+    return int(np.ceil(size / (count - (count - 1) * overlap)))
+
+def _tile_offsets(size, tile_size, count):
+    if count <= 1:
+        return [0]
+    return [
+        int(round(i * (size - tile_size) / (count - 1)))
+        for i in range(count)
+    ]
+
+def _merge_window_detections(outputs, windows, width, height):
+    """Returns boxes, scores and classes for all windows.
+
+    Boxes are converted from normalized window coordinates to
+    normalized image coordinates.
+    """
+    n = outputs["num_detections"].astype(int)
+    valid = np.arange(outputs["detection_scores"].shape[1]) < n[:, None]
+    win = np.array(windows, dtype=np.float32)
+    x, y, w, h = win[:, 0], win[:, 1], win[:, 2], win[:, 3]
+    offset = np.stack([y / height, x / width, y / height, x / width], 1)
+    scale = np.stack([h / height, w / width, h / height, w / width], 1)
+    boxes = outputs["detection_boxes"] * scale[:, None] + offset[:, None]
+    return (
+        boxes[valid],
+        outputs["detection_scores"][valid],
+        outputs["detection_classes"][valid])
+
+def nms(boxes, scores, classes, iou_threshold=0.5, max_detections=100):
+    """Returns indices of boxes kept by per-class non-max suppression.
+
+    Boxes are (ymin, xmin, ymax, xmax) in normalized coordinates.
+    Boxes of different classes are offset so they never overlap,
+    which lets all classes be suppressed in one pass. Indices are
+    ordered by descending score.
+    """
+    if not len(boxes):
+        return np.zeros((0,), dtype=int)
+    shifted = boxes + (classes.astype(np.float32) * 2)[:, None]
+    y1, x1, y2, x2 = shifted.T
+    areas = (y2 - y1) * (x2 - x1)
+    order = np.argsort(-scores)
+    keep = []
+    while order.size and len(keep) < max_detections:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        inter = (
+            np.clip(np.minimum(y2[i], y2[rest]) -
+                    np.maximum(y1[i], y1[rest]), 0, None) *
+            np.clip(np.minimum(x2[i], x2[rest]) -
+                    np.maximum(x1[i], x1[rest]), 0, None))
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=int)
+
 def main():
     args = _init_args()
-    detector = Detector(args.graph, args.labels)
+    cache = init_cache(args.cache_size, args.cache_dir)
+    detector = _init_detector(args, cache)
     for image_path in _image_paths(args):
         detect_image_path = _detect_image_path_for_input(image_path, args)
         if args.skip_existing and os.path.exists(detect_image_path):
@@ -176,6 +873,24 @@ def main():
             continue
         print("Detecting objects in {}".format(image_path))
         _detect_objects(image_path, detect_image_path, detector)
+    if cache:
+        _print_cache_stats(cache)
+
+def _init_detector(args, cache):
+    if args.session_layout == "default":
+        return Detector(args.graph, args.labels, cache=cache)
+    import session_tune
+    store = session_tune.LayoutStore(args.session_layout_file)
+    if args.session_layout == "auto":
+        session_tune.ensure_tuned(
+            store, args.graph, args.labels,
+            lambda: (
+                session_tune.load_images(args.images_dir) or
+                session_tune.blank_images()),
+            workers=1)
+    layout = session_tune.init_layout(args.session_layout, args.graph, store)
+    return session_tune.init_detector(
+        args.graph, args.labels, layout, cache=cache)
 
 def _image_paths(args):
     src = args.images_dir
@@ -191,7 +906,15 @@ def _detect_objects(image_path, detect_image_path, detector):
     _result, detect_image = detector.detect(image_bytes)
     detector.write_image(detect_image, detect_image_path)
 
+def _print_cache_stats(cache):
+    stats = cache.stats()
+    print(
+        "Result cache: {hits} hits, {disk_hits} disk hits, {misses} misses, "
+        "{evictions} evictions ({hit_rate:.1%} hit rate)".format(**stats))
+
 def _init_args():
+    # Imported here as session_tune imports this module.
+    import session_tune
     p = argparse.ArgumentParser()
     p.add_argument(
         "--images-dir",
@@ -213,6 +936,28 @@ def _init_args():
         "--skip-existing",
         action="store_true",
         help="Skip detection if detect image already exists")
+    p.add_argument(
+        "--cache-size", metavar="MB",
+        default=0,
+        type=int,
+        help="Memory for cached detect results; 0 disables the cache (0)")
+    p.add_argument(
+        "--cache-dir", metavar="PATH",
+        help="Directory to save cached detect results in")
+    p.add_argument(
+        "--session-layout", metavar="LAYOUT",
+        default="default",
+        type=session_tune.layout_spec,
+        help=(
+            "Detector session threading: 'default' (default), 'auto' to "
+            "use the layout tuned for this host and graph, tuning it if "
+            "needed, or SESSIONS,INTRA,INTER; see session_tune.py"))
+    p.add_argument(
+        "--session-layout-file", metavar="PATH",
+        default=session_tune.DEFAULT_LAYOUT_FILE,
+        help=(
+            "File to store tuned session layouts in (%s)"
+            % session_tune.DEFAULT_LAYOUT_FILE))
     return p.parse_args()
 
 if __name__ == "__main__":
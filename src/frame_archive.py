@@ -0,0 +1,352 @@
+"""Append-only archive of encoded camera frames.
+
+Frames for a camera are appended to segment files
+(`<camera>-<seq>.seg`), each paired with an index file
+(`<camera>-<seq>.idx`) of fixed size records giving the step, time,
+offset, length, kind and extension of each frame. Segments are rolled
+over once they exceed a size limit.
+
+Archives are read using `ArchiveReader`, which maps segment and index
+files into memory for random access by camera, step, kind and time.
+
+To extract frames as image files (e.g. for use with detect.py or
+cats/prepare_dataset.py) run:
+
+    python frame_archive.py --archive-dir archive --output-dir images
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+import app_util
+
+log = logging.getLogger("frame_archive")
+
+INDEX_RECORD = struct.Struct("<qdQQ8s8s")
+
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+
+SEGMENT_PATTERN = re.compile(r"^(.+)-(\d{6})\.seg$")
+
+Frame = collections.namedtuple(
+    "Frame", [
+        "camera", "step", "time", "kind", "ext",
+        "segment", "offset", "length"
+    ])
+
+class FrameArchive(object):
+    """Appends frames for a camera to segment files in archive_dir."""
+
+    def __init__(self, archive_dir, camera,
+                 segment_size=DEFAULT_SEGMENT_SIZE):
+        self.archive_dir = archive_dir
+        self.camera = camera
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._seq = None
+        self._data = None
+        self._index = None
+        app_util.ensure_dir(archive_dir)
+
+    def append(self, step, kind, ext, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            self._ensure_segment(len(data))
+            offset = self._data.tell()
+            self._data.write(data)
+            self._data.flush()
+            self._index.write(INDEX_RECORD.pack(
+                step,
+                timestamp,
+                offset,
+                len(data),
+                _encode_field(kind),
+                _encode_field(ext)))
+            self._index.flush()
+
+    def _ensure_segment(self, next_len):
+        if self._data is None:
+            self._open_segment(self._last_seq())
+        if (self._data.tell() > 0 and
+                self._data.tell() + next_len > self.segment_size):
+            self._close_segment()
+            self._open_segment(self._seq + 1)
+
+    def _last_seq(self):
+        seqs = [
+            seq for camera, seq in _iter_segments(self.archive_dir)
+            if camera == self.camera
+        ]
+        return max(seqs) if seqs else 0
+
+    def _open_segment(self, seq):
+        base = _segment_base(self.archive_dir, self.camera, seq)
+        _truncate_partial(base)
+        self._data = open(base + ".seg", "ab")
+        self._index = open(base + ".idx", "ab")
+        self._data.seek(0, os.SEEK_END)
+        self._seq = seq
+
+    def _close_segment(self):
+        self._data.close()
+        self._index.close()
+        self._data = None
+        self._index = None
+
+    def close(self):
+        with self._lock:
+            if self._data is not None:
+                self._close_segment()
+
+def _truncate_partial(base):
+    """Truncates segment base to its last complete frame.
+
+    An append interrupted by a crash can leave a partial index record
+    or frame data that isn't indexed. Appending after either would
+    misalign the index, so both are truncated.
+    """
+    idx_size = _file_size(base + ".idx")
+    seg_size = _file_size(base + ".seg")
+    records = idx_size // INDEX_RECORD.size
+    end = 0
+    with open(base + ".idx", "ab+") as f:
+        while records:
+            f.seek((records - 1) * INDEX_RECORD.size)
+            _, _, offset, length, _, _ = INDEX_RECORD.unpack(
+                f.read(INDEX_RECORD.size))
+            end = offset + length
+            if end <= seg_size:
+                break
+            records -= 1
+            end = 0
+    if records * INDEX_RECORD.size != idx_size or end != seg_size:
+        log.warning(
+            "truncating partial frame data in %s to %i frame(s)",
+            base, records)
+        _truncate(base + ".idx", records * INDEX_RECORD.size)
+        _truncate(base + ".seg", end)
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def _truncate(path, size):
+    with open(path, "ab") as f:
+        f.truncate(size)
+
+class ArchiveReader(object):
+    """Reads frames from an archive directory using mmap."""
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self._maps = {}
+
+    def frames(self, camera=None, kind=None, step=None,
+               start_time=None, end_time=None):
+        """Yields Frame records matching the specified criteria."""
+        for seg_camera, seq in sorted(_iter_segments(self.archive_dir)):
+            if camera is not None and seg_camera != camera:
+                continue
+            base = _segment_base(self.archive_dir, seg_camera, seq)
+            index = self._map(base + ".idx")
+            if index is None:
+                continue
+            for i in range(len(index) // INDEX_RECORD.size):
+                frame = _frame(seg_camera, base, index, i)
+                if step is not None and frame.step != step:
+                    continue
+                if start_time is not None and frame.time < start_time:
+                    continue
+                if end_time is not None and frame.time >= end_time:
+                    continue
+                if kind is not None and frame.kind != kind:
+                    continue
+                yield frame
+
+    def read(self, frame):
+        """Returns the encoded bytes for frame."""
+        data = self._map(frame.segment)
+        return data[frame.offset:frame.offset + frame.length]
+
+    def _map(self, path):
+        try:
+            return self._maps[path]
+        except KeyError:
+            mapped = self._maps[path] = _mmap_file(path)
+            return mapped
+
+    def close(self):
+        for mapped in self._maps.values():
+            if mapped is not None:
+                mapped.close()
+        self._maps.clear()
+
+def segments(archive_dir):
+    """Returns a dict of camera to sorted segment bases in archive_dir.
+
+    The last segment for each camera is the one being appended to.
+    """
+    by_camera = {}
+    for camera, seq in sorted(_iter_segments(archive_dir)):
+        by_camera.setdefault(camera, []).append(
+            _segment_base(archive_dir, camera, seq))
+    return by_camera
+
+def segment_frames(base):
+    """Returns a list of Frame records for segment base."""
+    camera = SEGMENT_PATTERN.match(os.path.basename(base) + ".seg").group(1)
+    index = _mmap_file(base + ".idx")
+    if index is None:
+        return []
+    try:
+        return [
+            _frame(camera, base, index, i)
+            for i in range(len(index) // INDEX_RECORD.size)
+        ]
+    finally:
+        index.close()
+
+def _frame(camera, base, index, i):
+    step, f_time, offset, length, kind, ext = INDEX_RECORD.unpack_from(
+        index, i * INDEX_RECORD.size)
+    return Frame(
+        camera, step, f_time, _decode_field(kind), _decode_field(ext),
+        base + ".seg", offset, length)
+
+def rewrite_segment(base, frames):
+    """Rewrites segment base to contain only frames.
+
+    frames must be records read from the segment. The new segment and
+    index files replace the originals using rename, so readers holding
+    maps of the originals are not affected.
+    """
+    data = _mmap_file(base + ".seg")
+    try:
+        with open(base + ".seg.tmp", "wb") as seg_out, \
+             open(base + ".idx.tmp", "wb") as idx_out:
+            for frame in frames:
+                offset = seg_out.tell()
+                seg_out.write(data[frame.offset:frame.offset + frame.length])
+                idx_out.write(INDEX_RECORD.pack(
+                    frame.step,
+                    frame.time,
+                    offset,
+                    frame.length,
+                    _encode_field(frame.kind),
+                    _encode_field(frame.ext)))
+    finally:
+        if data is not None:
+            data.close()
+    os.rename(base + ".seg.tmp", base + ".seg")
+    os.rename(base + ".idx.tmp", base + ".idx")
+
+def remove_segment(base):
+    for ext in (".idx", ".seg"):
+        try:
+            os.remove(base + ext)
+        except OSError:
+            pass
+
+def _mmap_file(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _iter_segments(archive_dir):
+    try:
+        names = os.listdir(archive_dir)
+    except OSError:
+        return
+    for name in names:
+        m = SEGMENT_PATTERN.match(name)
+        if m:
+            yield m.group(1), int(m.group(2))
+
+def _segment_base(archive_dir, camera, seq):
+    return os.path.join(archive_dir, "{}-{:06d}".format(camera, seq))
+
+def _encode_field(val):
+    return val.encode("utf-8")[:8]
+
+def _decode_field(val):
+    return val.rstrip(b"\0").decode("utf-8")
+
+def frame_filename(frame):
+    """Returns the file name used for frame when extracted."""
+    return "archive-{}-{:06d}-{}{}".format(
+        frame.camera, frame.step, frame.kind, frame.ext)
+
+def extract(archive_dir, output_dir, **filters):
+    """Writes matching archive frames to output_dir as image files."""
+    app_util.ensure_dir(output_dir)
+    reader = ArchiveReader(archive_dir)
+    count = 0
+    try:
+        for frame in reader.frames(**filters):
+            path = os.path.join(output_dir, frame_filename(frame))
+            with open(path, "wb") as f:
+                f.write(reader.read(frame))
+            count += 1
+    finally:
+        reader.close()
+    return count
+
+def main():
+    args = _parse_args()
+    count = extract(
+        args.archive_dir,
+        args.output_dir,
+        camera=args.camera,
+        kind=args.kind,
+        step=args.step,
+        start_time=args.start_time,
+        end_time=args.end_time)
+    print("Extracted {} frame(s) to {}".format(count, args.output_dir))
+
+def _parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--archive-dir", metavar="PATH",
+        default="archive",
+        help="Archive directory (archive)")
+    p.add_argument(
+        "--output-dir", metavar="PATH",
+        default="images",
+        help="Directory to extract frames to (images)")
+    p.add_argument(
+        "--camera",
+        help="Extract frames for CAMERA only")
+    p.add_argument(
+        "--kind",
+        help="Extract frames of KIND only (e.g. orig or detected)")
+    p.add_argument(
+        "--step", metavar="N",
+        type=int,
+        help="Extract frames for scan step N only")
+    p.add_argument(
+        "--start-time", metavar="TIMESTAMP",
+        type=float,
+        help="Extract frames archived at or after TIMESTAMP")
+    p.add_argument(
+        "--end-time", metavar="TIMESTAMP",
+        type=float,
+        help="Extract frames archived before TIMESTAMP")
+    return p.parse_args()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+"""Shared-memory frame bus for apps running on the same host.
+
+A publisher (pump.py with `--frame-bus`) writes camera frames to a
+ring buffer per camera in a memory-mapped file under the bus dir
+(`/dev/shm` by default). Readers (scan.py and collect.py with
+`--use-frame-bus`) map the same file read-only and use frames in
+place without copying them or reading files.
+
+Each slot holds a JPEG encoded frame and, if the publisher decodes
+frames, the frame as an RGB array. Frames are decoded once by the
+publisher rather than by each app.
+
+Ring file layout:
+
+    header    magic, version, slot count, encoded and decoded
+              sizes, sequence of the last published frame
+    slots     slot header (sequence, time, lengths, frame ID),
+              encoded region, decoded region
+
+A slot's sequence is cleared while it's written and set once the
+frame is complete. Readers check the sequence after using a frame
+(see `Frame.check`) to detect frames overwritten in the meantime.
+
+A ring is never resized in place. When a publisher's geometry changes,
+it writes a new ring file and renames it over the old one. Readers
+notice that the file changed and map the new ring, and their mapping
+of the old file stays valid until then.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import app_util
+import tracing
+
+log = logging.getLogger("framebus")
+
+MAGIC = b"FRAMEBUS"
+VERSION = 1
+
+HEADER = struct.Struct("<8sIIQQQ")
+HEADER_SIZE = 64
+SEQ_OFFSET = HEADER.size - 8
+
+SLOT_HEADER = struct.Struct("<QdQII32s")
+SLOT_HEADER_SIZE = 64
+
+DEFAULT_SLOTS = 4
+DEFAULT_ENCODED_SIZE = 4 * 1024 * 1024
+DEFAULT_MAX_FRAME = (1920, 1080)
+
+# Frames older than this are considered stale (e.g. the publisher has
+# stopped) and aren't read.
+DEFAULT_MAX_AGE = 60
+
+READ_RETRIES = 3
+
+def default_bus_dir():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+def bus_path(bus_dir, camera):
+    return os.path.join(bus_dir, "framebus-%s" % camera)
+
+class FrameOverwritten(Exception):
+    pass
+
+class Frame(object):
+    """A frame read from a ring.
+
+    `jpeg` is a memoryview of the encoded frame and `image` is a
+    read-only array view of the decoded frame, or None if the
+    publisher doesn't decode frames. Both refer to shared memory and
+    are only valid until the slot is reused - use `check` after using
+    them and copy anything that's kept.
+    """
+
+    __slots__ = (
+        "seq", "time", "frame_id", "jpeg", "image",
+        "_ring", "_slot_offset")
+
+    def __init__(self, seq, f_time, frame_id, jpeg, image, ring,
+                 slot_offset):
+        self.seq = seq
+        self.time = f_time
+        self.frame_id = frame_id
+        self.jpeg = jpeg
+        self.image = image
+        self._ring = ring
+        self._slot_offset = slot_offset
+
+    def check(self):
+        """Raises FrameOverwritten if the frame slot has been reused."""
+        if self._ring.slot_seq(self._slot_offset) != self.seq:
+            raise FrameOverwritten(self.seq)
+
+class _Ring(object):
+
+    def __init__(self, mapped, slots, encoded_size, decoded_size,
+                 ident=None):
+        self.mapped = mapped
+        self.slots = slots
+        self.encoded_size = encoded_size
+        self.decoded_size = decoded_size
+        self.slot_size = SLOT_HEADER_SIZE + encoded_size + decoded_size
+        # Device and inode of the mapped file.
+        self.ident = ident
+
+    def header_ok(self):
+        return HEADER.unpack_from(self.mapped, 0)[:5] == (
+            MAGIC, VERSION, self.slots, self.encoded_size,
+            self.decoded_size)
+
+    def slot_offset(self, seq):
+        return HEADER_SIZE + (seq % self.slots) * self.slot_size
+
+    def seq(self):
+        return struct.unpack_from("<Q", self.mapped, SEQ_OFFSET)[0]
+
+    def slot_seq(self, slot_offset):
+        return struct.unpack_from("<Q", self.mapped, slot_offset)[0]
+
+    @staticmethod
+    def file_size(slots, encoded_size, decoded_size):
+        return HEADER_SIZE + slots * (
+            SLOT_HEADER_SIZE + encoded_size + decoded_size)
+
+class FramePublisher(object):
+    """Publishes frames for a camera to a ring in bus_dir."""
+
+    def __init__(self, bus_dir, camera, slots=DEFAULT_SLOTS,
+                 encoded_size=DEFAULT_ENCODED_SIZE,
+                 max_frame=DEFAULT_MAX_FRAME, decode=False):
+        self.path = bus_path(bus_dir, camera)
+        self.camera = camera
+        self.decode = decode
+        self.max_frame = max_frame
+        self._size_warned = False
+        width, height = max_frame
+        decoded_size = width * height * 3 if decode else 0
+        self._lock = threading.Lock()
+        self._ring = self._init_ring(slots, encoded_size, decoded_size)
+        self._seq = self._ring.seq()
+
+    def _init_ring(self, slots, encoded_size, decoded_size):
+        app_util.ensure_dir(os.path.dirname(self.path))
+        size = _Ring.file_size(slots, encoded_size, decoded_size)
+        geometry = (MAGIC, VERSION, slots, encoded_size, decoded_size)
+        mapped = _map_existing_ring(self.path, size, geometry)
+        if mapped is None:
+            mapped = self._create_ring(size, geometry)
+        return _Ring(mapped, slots, encoded_size, decoded_size)
+
+    def _create_ring(self, size, geometry):
+        # The ring at path may be mapped by readers, so it's replaced
+        # rather than resized in place.
+        fd, tmp = tempfile.mkstemp(
+            prefix=os.path.basename(self.path) + ".",
+            dir=os.path.dirname(self.path) or ".")
+        try:
+            os.fchmod(fd, 0o644)
+            os.ftruncate(fd, size)
+            mapped = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(mapped, 0, *(geometry + (0,)))
+        os.rename(tmp, self.path)
+        return mapped
+
+    def publish(self, jpeg, frame_id=None, timestamp=None):
+        """Publishes a JPEG encoded frame and returns its sequence."""
+        ring = self._ring
+        if len(jpeg) > ring.encoded_size:
+            raise ValueError(
+                "frame for %s is too large (%i bytes, max %i)"
+                % (self.camera, len(jpeg), ring.encoded_size))
+        image = self._decode(jpeg) if self.decode else None
+        with self._lock:
+            seq = self._seq + 1
+            offset = ring.slot_offset(seq)
+            mapped = ring.mapped
+            # Clear slot seq so readers don't use a partial frame.
+            struct.pack_into("<Q", mapped, offset, 0)
+            data_offset = offset + SLOT_HEADER_SIZE
+            mapped[data_offset:data_offset + len(jpeg)] = jpeg
+            height, width = 0, 0
+            if image is not None:
+                height, width = image.shape[:2]
+                decoded_offset = data_offset + ring.encoded_size
+                dest = np.frombuffer(
+                    mapped, np.uint8, image.size, decoded_offset)
+                dest[:] = image.ravel()
+            SLOT_HEADER.pack_into(
+                mapped, offset,
+                seq,
+                timestamp or time.time(),
+                len(jpeg),
+                width,
+                height,
+                (frame_id or "").encode("ascii"))
+            struct.pack_into("<Q", mapped, SEQ_OFFSET, seq)
+            self._seq = seq
+        return seq
+
+    def _decode(self, jpeg):
+        import PIL.Image
+        import six
+        # Size is read from the JPEG header by open, so oversized
+        # frames are skipped before they're decoded.
+        image = PIL.Image.open(six.BytesIO(jpeg))
+        width, height = image.size
+        max_width, max_height = self.max_frame
+        if width > max_width or height > max_height:
+            if not self._size_warned:
+                log.warning(
+                    "frames for %s (%ix%i) exceed max decoded frame size "
+                    "(%ix%i) - publishing encoded frames only",
+                    self.camera, width, height, max_width, max_height)
+                self._size_warned = True
+            return None
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return np.asarray(image, dtype=np.uint8)
+
+    def close(self):
+        with self._lock:
+            self._ring.mapped.close()
+
+def _map_existing_ring(path, size, geometry):
+    """Maps the ring at path for writing if it has geometry."""
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except OSError:
+        return None
+    try:
+        if os.fstat(fd).st_size != size:
+            return None
+        mapped = mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+    if HEADER.unpack_from(mapped, 0)[:5] != geometry:
+        mapped.close()
+        return None
+    return mapped
+
+class FrameReader(object):
+    """Reads frames for a camera from a ring in bus_dir."""
+
+    def __init__(self, bus_dir, camera):
+        self.path = bus_path(bus_dir, camera)
+        self.camera = camera
+        self._ring = None
+
+    def latest(self):
+        """Returns the last published frame or None if there isn't one."""
+        ring = self._ensure_ring()
+        if ring is None:
+            return None
+        for _ in range(READ_RETRIES):
+            seq = ring.seq()
+            if seq == 0:
+                return None
+            frame = self._read_slot(ring, seq)
+            if frame is not None:
+                return frame
+        return None
+
+    def _ensure_ring(self):
+        # The ring is reopened when the file at path is replaced (see
+        # FramePublisher._create_ring) or no longer matches the mapped
+        # geometry. Old mappings aren't closed as frames read from them
+        # may still be in use.
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._ring = None
+            return None
+        ring = self._ring
+        if ring is not None and (
+                _file_ident(st) != ring.ident or
+                st.st_size < len(ring.mapped) or
+                not ring.header_ok()):
+            log.info("frame bus ring %s changed - reopening", self.path)
+            ring = None
+        if ring is None:
+            ring = self._ring = _open_ring(self.path)
+        return ring
+
+    @staticmethod
+    def _read_slot(ring, seq):
+        offset = ring.slot_offset(seq)
+        (slot_seq, f_time, length, width, height,
+         frame_id) = SLOT_HEADER.unpack_from(ring.mapped, offset)
+        if slot_seq != seq:
+            # Slot is being written.
+            return None
+        data_offset = offset + SLOT_HEADER_SIZE
+        jpeg = memoryview(ring.mapped)[data_offset:data_offset + length]
+        image = None
+        if width and height:
+            image = np.frombuffer(
+                ring.mapped, np.uint8, width * height * 3,
+                data_offset + ring.encoded_size).reshape(height, width, 3)
+        return Frame(
+            seq, f_time, frame_id.rstrip(b"\0").decode("ascii") or None,
+            jpeg, image, ring, offset)
+
+def _open_ring(path):
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return None
+    with f:
+        st = os.fstat(f.fileno())
+        if st.st_size < HEADER_SIZE:
+            return None
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, slots, encoded_size, decoded_size, _seq = (
+        HEADER.unpack_from(mapped, 0))
+    if magic != MAGIC or version != VERSION:
+        log.warning("%s is not a version %i frame bus", path, VERSION)
+        mapped.close()
+        return None
+    if len(mapped) < _Ring.file_size(slots, encoded_size, decoded_size):
+        mapped.close()
+        return None
+    return _Ring(
+        mapped, slots, encoded_size, decoded_size, _file_ident(st))
+
+def _file_ident(st):
+    return st.st_dev, st.st_ino
+
+@app_util.register_backend
+class FrameBusCamera(app_util.CameraBase):
+    """Camera that reads frames published to the local frame bus."""
+
+    backend = "framebus"
+    capabilities = frozenset(["local", "shared-memory"])
+    latency = 0.0001
+
+    def __init__(self, key, config, bus_dir=None,
+                 max_age=DEFAULT_MAX_AGE):
+        super(FrameBusCamera, self).__init__(key, config)
+        self.src = bus_path(bus_dir or default_bus_dir(), key)
+        self.max_age = max_age
+        self._reader = FrameReader(bus_dir or default_bus_dir(), key)
+
+    @classmethod
+    def from_config(cls, key, config, bus_dir=None, **_opts):
+        return cls(key, app_util.camera_config(key, config), bus_dir)
+
+    @classmethod
+    def available(cls, key, _config, bus_dir=None, **_opts):
+        # A ring left behind by a stopped publisher isn't enough - the
+        # bus is only available while frames are being published.
+        frame = FrameReader(bus_dir or default_bus_dir(), key).latest()
+        return (
+            frame is not None and
+            time.time() - frame.time <= DEFAULT_MAX_AGE)
+
+    def read_frame(self):
+        """Returns the latest frame from the bus.
+
+        Raises CameraError if a frame isn't available or is stale.
+        """
+        frame = self._reader.latest()
+        if frame is None:
+            self._error("no frames available in %s" % self.src)
+        if time.time() - frame.time > self.max_age:
+            self._error(
+                "last frame in %s is %is old"
+                % (self.src, time.time() - frame.time))
+        return frame
+
+    def _error(self, msg):
+        raise app_util.CameraError(self.key, self.config, (1, "", msg))
+
+    def _capture(self, path, timeout):
+        frame = self.read_frame()
+        jpeg = bytes(frame.jpeg)
+        frame.check()
+        with open(path, "wb") as f:
+            f.write(jpeg)
+        if frame.frame_id:
+            tracing.write_sidecar(path, frame.frame_id, self.key)
+        return b"", b""
+
+class FrameBusProxy(object):
+    """Image proxy that publishes images to the local frame bus.
+
+    Used by pump.py in place of `ImageProxy`.
+    """
+
+    def __init__(self, bus_dir=None, decode=False,
+                 max_frame=DEFAULT_MAX_FRAME):
+        self.bus_dir = bus_dir or default_bus_dir()
+        self.decode = decode
+        self.max_frame = max_frame
+        self._publishers = {}
+        self._lock = threading.Lock()
+        log.info("publishing images to frame bus in %s", self.bus_dir)
+
+    def __str__(self):
+        return "frame bus %s" % self.bus_dir
+
+    def copy(self, name, src, sidecar=False):
+        with open(src, "rb") as f:
+            jpeg = f.read()
+        frame_id = tracing.read_sidecar(src) if sidecar else None
+        self._publisher(name).publish(jpeg, frame_id)
+
+    def _publisher(self, name):
+        with self._lock:
+            try:
+                return self._publishers[name]
+            except KeyError:
+                publisher = self._publishers[name] = FramePublisher(
+                    self.bus_dir, name,
+                    max_frame=self.max_frame,
+                    decode=self.decode)
+                return publisher
+
+    def close(self):
+        with self._lock:
+            for publisher in self._publishers.values():
+                publisher.close()
+            self._publishers.clear()
@@ -0,0 +1,280 @@
+# pylint: disable=import-error
+
+"""Rolling-window detection counts for scan.
+
+Counts are kept per time bucket, camera and class in fixed-size ring
+arrays - a ring of `buckets` buckets of `bucket_seconds` each covers
+the rolling window. For each bucket the arrays hold the number of
+scans and, per camera and class, the sum and max of detections across
+those scans.
+
+Counts are saved periodically to an npz file and read back on start
+so windows survive restarts. They're also served as JSON over HTTP:
+
+    GET /counts?window=SECONDS&camera=NAME&class=NAME
+
+        Per camera and class totals over the window (all buckets by
+        default). camera and class may be repeated to filter.
+
+    GET /series?window=SECONDS&camera=NAME&class=NAME
+
+        Per bucket counts over the window for one class, summed across
+        cameras unless camera is specified.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib import parse as urlparse
+
+DEFAULT_BUCKET_SECONDS = 60
+DEFAULT_BUCKETS = 24 * 60
+DEFAULT_FLUSH_INTERVAL = 60
+
+class CountAggregator(object):
+
+    def __init__(self, class_names, cameras,
+                 bucket_seconds=DEFAULT_BUCKET_SECONDS,
+                 buckets=DEFAULT_BUCKETS):
+        self.class_names = list(class_names)
+        self.cameras = sorted(cameras)
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self._class_index = {
+            name: i for i, name in enumerate(self.class_names)
+        }
+        self._camera_index = {
+            name: i for i, name in enumerate(self.cameras)
+        }
+        shape = (buckets, len(self.cameras), len(self.class_names))
+        # Bucket number (time // bucket_seconds) held by each slot; -1
+        # for unused slots.
+        self._bucket_ids = np.full(buckets, -1, dtype=np.int64)
+        self._scans = np.zeros(shape[:2], dtype=np.int32)
+        self._sums = np.zeros(shape, dtype=np.int32)
+        self._maxes = np.zeros(shape, dtype=np.int32)
+        self._lock = threading.Lock()
+
+    def add(self, camera, class_counts, scan_time=None):
+        """Adds per class counts for a camera scan.
+
+        class_counts is a sequence of counts indexed like class_names.
+        """
+        cam = self._camera_index[camera]
+        counts = np.asarray(class_counts, dtype=np.int32)
+        with self._lock:
+            slot = self._slot(scan_time or time.time())
+            self._scans[slot, cam] += 1
+            self._sums[slot, cam] += counts
+            np.maximum(self._maxes[slot, cam], counts, self._maxes[slot, cam])
+
+    def _slot(self, t):
+        bucket_id = int(t // self.bucket_seconds)
+        slot = bucket_id % self.buckets
+        if self._bucket_ids[slot] != bucket_id:
+            self._bucket_ids[slot] = bucket_id
+            self._scans[slot] = 0
+            self._sums[slot] = 0
+            self._maxes[slot] = 0
+        return slot
+
+    def _window_slots(self, window, now):
+        """Returns slots for buckets within window, oldest first."""
+        last = int(now // self.bucket_seconds)
+        if window:
+            n = min(self.buckets, int(np.ceil(window / self.bucket_seconds)))
+        else:
+            n = self.buckets
+        ids = self._bucket_ids
+        slots = np.flatnonzero((ids > last - n) & (ids <= last))
+        return slots[np.argsort(ids[slots])]
+
+    def counts(self, window=None, cameras=None, classes=None, now=None):
+        """Returns per camera and class totals over window seconds.
+
+        Classes without detections are omitted.
+        """
+        cams = self._indexes(cameras, self._camera_index, self.cameras)
+        cls = self._indexes(classes, self._class_index, self.class_names)
+        with self._lock:
+            slots = self._window_slots(window, now or time.time())
+            scans = self._scans[slots][:, cams].sum(axis=0)
+            sums = self._sums[slots][:, cams][:, :, cls].sum(axis=0)
+            maxes = self._maxes[slots][:, cams][:, :, cls].max(
+                axis=0, initial=0)
+        cameras_out = {}
+        for i, cam in enumerate(cams):
+            cameras_out[self.cameras[cam]] = {
+                "scans": int(scans[i]),
+                "classes": {
+                    self.class_names[c]: {
+                        "total": int(sums[i, j]),
+                        "max": int(maxes[i, j]),
+                        "mean": float(sums[i, j]) / int(scans[i]),
+                    }
+                    for j, c in enumerate(cls)
+                    if sums[i, j]
+                },
+            }
+        return {
+            "window": window or self.buckets * self.bucket_seconds,
+            "cameras": cameras_out,
+        }
+
+    def series(self, class_name, window=None, cameras=None, now=None):
+        """Returns per bucket counts of class_name over window seconds."""
+        cls = self._class_index[class_name]
+        cams = self._indexes(cameras, self._camera_index, self.cameras)
+        with self._lock:
+            slots = self._window_slots(window, now or time.time())
+            times = self._bucket_ids[slots] * self.bucket_seconds
+            scans = self._scans[slots][:, cams].sum(axis=1)
+            sums = self._sums[slots][:, cams, cls].sum(axis=1)
+            maxes = self._maxes[slots][:, cams, cls].max(axis=1, initial=0)
+        return {
+            "class": class_name,
+            "bucket": self.bucket_seconds,
+            "buckets": [
+                {
+                    "time": int(times[i]),
+                    "scans": int(scans[i]),
+                    "total": int(sums[i]),
+                    "max": int(maxes[i]),
+                }
+                for i in range(len(slots))
+            ],
+        }
+
+    @staticmethod
+    def _indexes(names, index, all_names):
+        if not names:
+            return list(range(len(all_names)))
+        try:
+            return [index[name] for name in names]
+        except KeyError as e:
+            raise ValueError("unknown name %s" % e)
+
+    def save(self, path):
+        with self._lock:
+            arrays = {
+                "bucket_ids": self._bucket_ids.copy(),
+                "scans": self._scans.copy(),
+                "sums": self._sums.copy(),
+                "maxes": self._maxes.copy(),
+            }
+        tmp = path + ".tmp.npz"
+        np.savez(
+            tmp,
+            class_names=np.asarray(self.class_names),
+            cameras=np.asarray(self.cameras),
+            bucket_seconds=self.bucket_seconds,
+            **arrays)
+        os.rename(tmp, path)
+
+    def load(self, path):
+        """Loads counts saved to path.
+
+        Returns False if path doesn't exist or was saved with
+        different classes, cameras or buckets.
+        """
+        try:
+            data = np.load(path)
+        except IOError:
+            return False
+        with data:
+            if (data["class_names"].tolist() != self.class_names or
+                    data["cameras"].tolist() != self.cameras or
+                    int(data["bucket_seconds"]) != self.bucket_seconds or
+                    len(data["bucket_ids"]) != self.buckets):
+                return False
+            with self._lock:
+                self._bucket_ids[:] = data["bucket_ids"]
+                self._scans[:] = data["scans"]
+                self._sums[:] = data["sums"]
+                self._maxes[:] = data["maxes"]
+        return True
+
+class Flusher(threading.Thread):
+    """Saves an aggregator to path every interval seconds."""
+
+    def __init__(self, aggregator, path, interval=DEFAULT_FLUSH_INTERVAL):
+        super(Flusher, self).__init__()
+        self.daemon = True
+        self.aggregator = aggregator
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        try:
+            self.aggregator.save(self.path)
+        except Exception as e:
+            sys.stderr.write(
+                "Error saving counts to %s: %s\n" % (self.path, e))
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.flush()
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        aggregator = self.server.aggregator
+        try:
+            window = float(query["window"][0]) if "window" in query else None
+            if url.path == "/counts":
+                result = aggregator.counts(
+                    window, query.get("camera"), query.get("class"))
+            elif url.path == "/series":
+                if "class" not in query:
+                    raise ValueError("missing class")
+                result = aggregator.series(
+                    query["class"][0], window, query.get("camera"))
+            else:
+                self._send(404, {"error": "not found"})
+                return
+        except (KeyError, ValueError) as e:
+            self._send(400, {"error": str(e)})
+        else:
+            self._send(200, result)
+
+    def _send(self, status, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_args):
+        pass
+
+def start_server(aggregator, host, port):
+    """Serves aggregator counts over HTTP in a background thread."""
+    server = _Server((host, port), _Handler)
+    server.aggregator = aggregator
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
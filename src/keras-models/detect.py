@@ -0,0 +1,23 @@
+# pylint: disable=import-error
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import importlib
+
+DETECTORS = {
+    "mrcnn": "mrcnn_detector",
+    "retinanet": "retinanet_detector",
+}
+
+def init_detector(name):
+    try:
+        module_name = DETECTORS[name]
+    except KeyError:
+        raise SystemExit(
+            "unsupported detector '%s' (expected one of: %s)"
+            % (name, ", ".join(sorted(DETECTORS))))
+    detector = importlib.import_module(module_name)
+    detector.init()
+    return detector
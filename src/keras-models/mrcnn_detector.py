@@ -4,19 +4,17 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import csv
 import os
 import sys
 
-import matplotlib
-matplotlib.use('Agg')
-
-import matplotlib.pyplot as plt
-
+import cv2
+import numpy as np
 import skimage.io
 
 import mrcnn.model as modellib
-from mrcnn import visualize
+
+import render
+import results
 
 sys.path.insert(0, "samples")
 
@@ -39,13 +37,15 @@ CLASS_NAMES = [
     'sink', 'refrigerator', 'book', 'clock', 'vase', 'scissors',
     'teddy bear', 'hair drier', 'toothbrush']
 
+CLASS_COLORS = render.class_colors(len(CLASS_NAMES))
+
 def init():
     pass
 
-def init_model(model_path):
+def init_model(model_path, batch_size=1):
     class InferenceConfig(coco.CocoConfig):
         GPU_COUNT = 1
-        IMAGES_PER_GPU = 1
+        IMAGES_PER_GPU = batch_size
     config = InferenceConfig()
     model = modellib.MaskRCNN(
         mode="inference",
@@ -54,49 +54,87 @@ def init_model(model_path):
     model.load_weights(model_path, by_name=True)
     return model
 
-def detect(input_path, model, object_class):
-    image = skimage.io.imread(input_path)
-    result = model.detect([image], verbose=1)[0]
-    _write_result_csv(result, _result_csv_path(input_path))
-    _write_detected_image(result, image, _detected_image_path(input_path))
-    return _count_objects(result, object_class)
-
-def _result_csv_path(input_path):
+def detect(input_path, model, object_class, result_format="npz"):
+    return detect_batch([input_path], model, object_class, result_format)[0]
+
+def detect_batch(input_paths, model, object_class, result_format="npz",
+                 encoded_images=None, per_class=False, write_images=True):
+    """Detects objects in images and returns object_class counts.
+
+    If encoded_images is specified, images are decoded from it rather
+    than read from input_paths, which are then only used to name
+    detection outputs. If per_class is True, counts of each class in
+    CLASS_NAMES are returned for each image instead. If write_images
+    is False, detected images aren't rendered or written.
+    """
+    if encoded_images is None:
+        images = [skimage.io.imread(path) for path in input_paths]
+    else:
+        images = [_decode_image(data) for data in encoded_images]
+    counts = []
+    for batch_paths, batch_images in _batches(
+            input_paths, images, model.config.BATCH_SIZE):
+        detected = model.detect(_pad_batch(batch_images, model), verbose=1)
+        for input_path, image, result in zip(
+                batch_paths, batch_images, detected):
+            _write_results(result, input_path, result_format)
+            if write_images:
+                _write_detected_image(
+                    result, image, _detected_image_path(input_path))
+            if per_class:
+                counts.append(_class_counts(result))
+            else:
+                counts.append(_count_objects(result, object_class))
+    return counts
+
+def _decode_image(data):
+    # Mask R-CNN expects RGB images.
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("unable to decode image")
+    return image[:, :, ::-1]
+
+def _batches(input_paths, images, batch_size):
+    for i in range(0, len(images), batch_size):
+        yield input_paths[i:i + batch_size], images[i:i + batch_size]
+
+def _pad_batch(images, model):
+    # Mask R-CNN requires exactly BATCH_SIZE images per call - results
+    # for padding images are ignored.
+    padding = model.config.BATCH_SIZE - len(images)
+    return images + [images[-1]] * padding
+
+def _write_results(result, input_path, result_format):
     output_base, _ = os.path.splitext(input_path)
-    return output_base + "-result.csv"
-
-def _write_result_csv(result, path):
-    with open(path, "w") as f:
-        out = csv.writer(f)
-        out.writerow(["Class", "Score", "Region"])
-        for class_id, score, roi in zip(
-                result["class_ids"], result["scores"], result["rois"]):
-            out.writerow([
-                CLASS_NAMES[class_id],
-                score,
-                ",".join([str(i) for i in roi.tolist()])
-            ])
+    results.write_results(
+        output_base,
+        CLASS_NAMES,
+        result["class_ids"],
+        result["scores"],
+        result["rois"],
+        result_format)
 
 def _detected_image_path(input_path):
     output_base, _ = os.path.splitext(input_path)
     return output_base + "-detected.png"
 
 def _write_detected_image(result, image, path):
-    plt.show = _write_image_fn(path)
-    visualize.display_instances(
-        image,
-        result['rois'],
-        result['masks'],
-        result['class_ids'],
-        CLASS_NAMES,
-        result['scores'])
-
-def _write_image_fn(path):
-    return lambda: plt.savefig(
-        path,
-        bbox_inches="tight",
-        pad_inches=0,
-        transparent=True)
+    render.write_image(_render_detected_image(result, image), path)
+
+def _render_detected_image(result, image):
+    out = image[:, :, :3].copy()
+    masks = result["masks"]
+    for i, (class_id, score, roi) in enumerate(zip(
+            result["class_ids"], result["scores"], result["rois"])):
+        color = CLASS_COLORS[class_id]
+        render.blend_mask(out, masks[:, :, i], color)
+        y1, x1, y2, x2 = roi
+        caption = "{} {:.3f}".format(CLASS_NAMES[class_id], score)
+        render.draw_box(out, (x1, y1, x2, y2), color, caption)
+    return out
+
+def _class_counts(result):
+    return np.bincount(result["class_ids"], minlength=len(CLASS_NAMES))
 
 def _count_objects(result, object_class):
     return sum([
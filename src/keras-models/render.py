@@ -0,0 +1,58 @@
+# pylint: disable=import-error
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import colorsys
+import os
+
+import cv2
+import numpy as np
+
+MASK_ALPHA = 0.5
+
+def class_colors(n):
+    """Returns n distinct RGB colors as uint8 arrays.
+
+    Colors are evenly spaced in hue so that a class is always drawn
+    in the same color.
+    """
+    return [
+        (np.array(colorsys.hsv_to_rgb(i / n, 1.0, 1.0)) * 255).astype(
+            np.uint8)
+        for i in range(n)
+    ]
+
+def blend_mask(image, mask, color, alpha=MASK_ALPHA):
+    """Alpha blends color into image where mask is set (in place)."""
+    mask = mask.astype(bool)
+    image[mask] = (
+        image[mask] * (1 - alpha) + np.asarray(color) * alpha
+    ).astype(np.uint8)
+
+def draw_box(image, box, color, caption=None, thickness=2):
+    """Draws box (x1, y1, x2, y2) with optional caption (in place)."""
+    x1, y1, x2, y2 = [int(val) for val in box]
+    color = tuple(int(val) for val in color)
+    cv2.rectangle(image, (x1, y1), (x2, y2), color, thickness, cv2.LINE_AA)
+    if caption:
+        cv2.putText(
+            image, caption, (x1, max(y1 - 5, 10)),
+            cv2.FONT_HERSHEY_PLAIN, 1, (0, 0, 0), 2)
+        cv2.putText(
+            image, caption, (x1, max(y1 - 5, 10)),
+            cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255), 1)
+
+def encode_image(image, ext=".png"):
+    """Returns encoded bytes for RGB image using format for ext."""
+    ok, encoded = cv2.imencode(ext, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+    if not ok:
+        raise ValueError("cannot encode image as %s" % ext)
+    return encoded.tobytes()
+
+def write_image(image, path):
+    """Writes RGB image to path using the format for the path extension."""
+    _, ext = os.path.splitext(path)
+    with open(path, "wb") as f:
+        f.write(encode_image(image, ext or ".png"))
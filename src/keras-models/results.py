@@ -0,0 +1,63 @@
+# pylint: disable=import-error
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+
+import numpy as np
+
+RESULT_FORMATS = ("npz", "csv", "none")
+
+def write_results(output_base, class_names, class_ids, scores, boxes,
+                  format="npz"):
+    """Writes detection results for an image in a single operation.
+
+    The default `npz` format stores class ids, scores and boxes as
+    arrays, along with the class names for the ids. `csv` writes a
+    row per detection with class name, score and box region. `none`
+    doesn't write results.
+    """
+    if format == "none":
+        return
+    if format == "npz":
+        _write_npz(output_base + "-result.npz", class_names, class_ids,
+                   scores, boxes)
+    elif format == "csv":
+        _write_csv(output_base + "-result.csv", class_names, class_ids,
+                   scores, boxes)
+    else:
+        raise ValueError(
+            "unsupported result format '%s' (expected one of: %s)"
+            % (format, ", ".join(RESULT_FORMATS)))
+
+def _write_npz(path, class_names, class_ids, scores, boxes):
+    np.savez(
+        path,
+        class_ids=np.asarray(class_ids),
+        class_names=np.asarray(class_names),
+        scores=np.asarray(scores),
+        boxes=np.asarray(boxes))
+
+def _write_csv(path, class_names, class_ids, scores, boxes):
+    with open(path, "w") as f:
+        out = csv.writer(f)
+        out.writerow(["Class", "Score", "Region"])
+        out.writerows([
+            (class_names[class_id],
+             score,
+             ",".join([str(i) for i in box]))
+            for class_id, score, box in zip(
+                np.asarray(class_ids).tolist(),
+                np.asarray(scores).tolist(),
+                np.asarray(boxes).tolist())
+        ])
+
+def read_results(path):
+    """Reads results written in npz format.
+
+    Returns a dict of class_ids, class_names, scores and boxes.
+    """
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
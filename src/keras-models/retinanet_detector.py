@@ -4,14 +4,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import csv
 import os
 
-import matplotlib
-matplotlib.use('Agg')
-
-import matplotlib.pyplot as plt
-
 import cv2
 import keras
 import numpy as np
@@ -22,6 +16,9 @@ from keras_retinanet.utils import image as image_util
 from keras_retinanet.utils import colors as colors_util
 from keras_retinanet.utils import visualization as vis_util
 
+import render
+import results
+
 LABELS_TO_NAMES = {
     0: 'person',
     1: 'bicycle',
@@ -104,6 +101,12 @@ LABELS_TO_NAMES = {
     78: 'hair drier',
     79: 'toothbrush'}
 
+NAMES_TO_LABELS = {name: label for label, name in LABELS_TO_NAMES.items()}
+
+CLASS_NAMES = [LABELS_TO_NAMES[i] for i in range(len(LABELS_TO_NAMES))]
+
+SCORE_THRESHOLD = 0.5
+
 def init():
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
@@ -112,53 +115,102 @@ def init():
     #os.environ["CUDA_VISIBLE_DEVICES"] = "1"
     keras.backend.tensorflow_backend.set_session(sess)
 
-def init_model(model_path):
+def init_model(model_path, _batch_size=1):
     model = keras.models.load_model(
         model_path,
         custom_objects=resnet.custom_objects)
     return model
 
-def detect(input_path, model, object_class):
-    output_base, _ = os.path.splitext(input_path)
-    detected_count = 0
-    image = image_util.read_image_bgr(input_path)
-    draw = image.copy()
-    draw = cv2.cvtColor(draw, cv2.COLOR_BGR2RGB)
-    image = image_util.preprocess_image(image)
-    image, scale = image_util.resize_image(image)
+def detect(input_path, model, object_class, result_format="npz"):
+    return detect_batch([input_path], model, object_class, result_format)[0]
+
+def detect_batch(input_paths, model, object_class, result_format="npz",
+                 encoded_images=None, per_class=False, write_images=True):
+    """Detects objects in images and returns object_class counts.
+
+    If encoded_images is specified, images are decoded from it rather
+    than read from input_paths, which are then only used to name
+    detection outputs. If per_class is True, counts of each class in
+    CLASS_NAMES are returned for each image instead. If write_images
+    is False, detected images aren't rendered or written.
+    """
+    if encoded_images is None:
+        images = [image_util.read_image_bgr(path) for path in input_paths]
+    else:
+        images = [_decode_image(data) for data in encoded_images]
+    inputs, scales = zip(*[_init_input(image) for image in images])
     _, _, boxes, nms_classification = model.predict_on_batch(
-        np.expand_dims(image, axis=0))
-    predicted_labels = np.argmax(nms_classification[0, :, :], axis=1)
-    scores = nms_classification[
-        0,
-        np.arange(nms_classification.shape[1]),
-        predicted_labels]
-    boxes /= scale
-    with open(output_base + "-result.csv", "w") as csv_f:
-        csv_out = csv.writer(csv_f)
-        csv_out.writerow(["Class", "Score", "Region"])
-        for idx, (label, score) in enumerate(zip(predicted_labels, scores)):
-            if score < 0.5:
-                continue
-            color = colors_util.label_color(label)
-            box = boxes[0, idx, :].astype(int)
-            vis_util.draw_box(draw, box, color=color)
-            label_name = LABELS_TO_NAMES[label]
-            caption = "{} {:.3f}".format(label_name, score)
-            vis_util.draw_caption(draw, box, caption)
-            csv_out.writerow([
-                label_name,
-                score,
-                ",".join([str(i) for i in box.tolist()])
-            ])
-            if label_name == object_class:
-                detected_count += 1
-    plt.figure(figsize=(15, 15))
-    plt.axis('off')
-    plt.imshow(draw)
-    plt.savefig(
-        output_base + "-detected.png",
-        bbox_inches="tight",
-        pad_inches=0,
-        transparent=True)
-    return detected_count
+        _stack_padded(inputs))
+    return [
+        _apply_result(
+            input_path,
+            image,
+            boxes[i],
+            nms_classification[i],
+            scales[i],
+            object_class,
+            result_format,
+            per_class,
+            write_images)
+        for i, (input_path, image) in enumerate(zip(input_paths, images))
+    ]
+
+def _decode_image(data):
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("unable to decode image")
+    return image
+
+def _init_input(image):
+    return image_util.resize_image(image_util.preprocess_image(image))
+
+def _stack_padded(inputs):
+    # Images are padded on the bottom and right to a common shape,
+    # which leaves detected box coordinates unchanged.
+    height = max(x.shape[0] for x in inputs)
+    width = max(x.shape[1] for x in inputs)
+    batch = np.zeros(
+        (len(inputs), height, width, inputs[0].shape[2]),
+        dtype=inputs[0].dtype)
+    for i, x in enumerate(inputs):
+        batch[i, :x.shape[0], :x.shape[1], :] = x
+    return batch
+
+def _apply_result(input_path, image, boxes, nms_classification, scale,
+                  object_class, result_format, per_class=False,
+                  write_images=True):
+    output_base, _ = os.path.splitext(input_path)
+    labels, scores, boxes = _filter_detections(
+        boxes, nms_classification, scale)
+    results.write_results(
+        output_base, CLASS_NAMES, labels, scores, boxes, result_format)
+    if write_images:
+        draw = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        _draw_detections(draw, labels, scores, boxes)
+        render.write_image(draw, output_base + "-detected.png")
+    if per_class:
+        return np.bincount(labels, minlength=len(CLASS_NAMES))
+    return _count_objects(labels, object_class)
+
+def _filter_detections(boxes, nms_classification, scale):
+    labels = np.argmax(nms_classification, axis=1)
+    scores = nms_classification[np.arange(len(labels)), labels]
+    keep = scores >= SCORE_THRESHOLD
+    return (
+        labels[keep],
+        scores[keep],
+        (boxes[keep] / scale).astype(int))
+
+def _draw_detections(draw, labels, scores, boxes):
+    for label, score, box in zip(labels, scores, boxes):
+        vis_util.draw_box(draw, box, color=colors_util.label_color(label))
+        caption = "{} {:.3f}".format(LABELS_TO_NAMES[label], score)
+        vis_util.draw_caption(draw, box, caption)
+
+def _count_objects(labels, object_class):
+    try:
+        label = NAMES_TO_LABELS[object_class]
+    except KeyError:
+        return 0
+    counts = np.bincount(labels, minlength=len(CLASS_NAMES))
+    return int(counts[label])
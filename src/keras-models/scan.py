@@ -10,38 +10,63 @@ import shutil
 import sys
 import time
 
+from multiprocessing.pool import ThreadPool
+
 import yaml
 
 from guild import op_util
 from guild import util
 
+import aggregate
 import detect
 import snapshot
 
 class Context(object):
 
-    def __init__(self, detector, model, object_class, cameras, events):
+    def __init__(self, detector, model, object_class, cameras, events,
+                 result_format="npz", save_snapshots=False,
+                 save_detected_images=True, aggregator=None):
         self.detector = detector
         self.model = model
         self.object_class = object_class
+        self.result_format = result_format
+        self.save_snapshots = save_snapshots
+        self.save_detected_images = save_detected_images
         self.cameras = cameras
         self.events = events
+        self.snapshot_pool = ThreadPool(max(1, len(cameras)))
+        self.aggregator = aggregator
         self.step = 0
 
+    def close(self):
+        self.snapshot_pool.close()
+        if self.aggregator:
+            self.aggregator.close()
+        for camera in self.cameras.values():
+            camera.close()
+        self.events.close()
+
 def main():
     args = _init_args()
     _maybe_copy_config(args)
     config = _init_config(args)
     detector = detect.init_detector(config["detector"])
-    model = detector.init_model(config["model"])
-    cameras = _init_cameras(config["cameras"])
+    cameras = _init_cameras(
+        config["cameras"],
+        config.get("snapshot-timeout"))
+    model = detector.init_model(config["model"], len(cameras))
     events = _init_events()
+    aggregator = _init_aggregator(config, detector, cameras)
     context = Context(
         detector,
         model,
         config["object-class"],
         cameras,
-        events)
+        events,
+        config.get("result-format", "npz"),
+        config.get("save-snapshots", False),
+        config.get("save-detected-images", True),
+        aggregator)
     util.loop(
         lambda: _scan_once(context),
         lambda seconds: _wait(seconds, context),
@@ -69,40 +94,126 @@ def _init_config(args):
     except IOError as e:
         raise SystemExit(e)
 
-def _init_cameras(config):
+def _init_cameras(config, timeout):
     return {
-        name: _init_camera(config[name])
+        name: _init_camera(config[name], timeout)
         for name in config
     }
 
-def _init_camera(config):
+def _init_camera(config, timeout):
     return snapshot.init_camera(
         config["host"],
         config["port"],
         config["user"],
-        config["password"])
+        config["password"],
+        config.get("timeout", timeout))
+
+class Aggregator(object):
+    """Aggregates scan counts with periodic flushes and a query server."""
+
+    def __init__(self, counts, path, flush_interval, host, port):
+        self.counts = counts
+        self._flusher = aggregate.Flusher(counts, path, flush_interval)
+        self._flusher.start()
+        self._server = aggregate.start_server(counts, host, port)
+
+    def add(self, camera, class_counts, scan_time):
+        self.counts.add(camera, class_counts, scan_time)
+
+    def close(self):
+        self._server.shutdown()
+        self._flusher.stop()
+
+def _init_aggregator(config, detector, cameras):
+    agg_config = config.get("aggregate")
+    if not agg_config:
+        return None
+    counts = aggregate.CountAggregator(
+        detector.CLASS_NAMES,
+        cameras,
+        agg_config.get("bucket", aggregate.DEFAULT_BUCKET_SECONDS),
+        agg_config.get("buckets", aggregate.DEFAULT_BUCKETS))
+    path = agg_config.get("path", "counts.npz")
+    if counts.load(path):
+        sys.stderr.write("Loaded counts from %s\n" % path)
+    # Counts are only served locally unless a host is configured.
+    host = agg_config.get("host", "127.0.0.1")
+    port = agg_config.get("port", 8005)
+    sys.stderr.write("Serving counts at http://%s:%i/counts\n" % (host, port))
+    return Aggregator(
+        counts,
+        path,
+        agg_config.get("flush-interval", aggregate.DEFAULT_FLUSH_INTERVAL),
+        host,
+        port)
 
 def _init_events():
     return op_util.TFEvents(os.getcwd())
 
 def _scan_once(context):
+    start = time.time()
     context.step += 1
-    counts = {}
     scan_dir = os.path.join("scans", str(int(time.time())))
     sys.stderr.write("Scan #%i\n" % context.step)
-    os.makedirs(scan_dir)
-    for name in sorted(context.cameras):
-        camera = context.cameras[name]
-        snapshot_path = os.path.join(scan_dir, name + ".jpg")
-        snapshot.snapshot(camera, snapshot_path)
-        counts["scans/" + name] = context.detector.detect(
-            snapshot_path,
-            context.model,
-            context.object_class)
-    counts["scans/total"] = sum(counts.values())
-    context.events.add_scalars(counts.items(), context.step)
+    if _writes_scan_files(context):
+        os.makedirs(scan_dir)
+    snapshots = _snapshot_cameras(context, scan_dir)
+    snapshot_stop = time.time()
+    names = sorted(snapshots)
+    # Input paths name detector outputs - snapshots are detected from
+    # memory and are only written to input paths if save-snapshots is
+    # set.
+    class_counts = context.detector.detect_batch(
+        [os.path.join(scan_dir, name + ".jpg") for name in names],
+        context.model,
+        context.object_class,
+        context.result_format,
+        [snapshots[name] for name in names],
+        per_class=True,
+        write_images=context.save_detected_images) if names else []
+    if context.aggregator:
+        for name, counts in zip(names, class_counts):
+            context.aggregator.add(name, counts, start)
+    object_class = _class_index(context)
+    scalars = {
+        "scans/" + name: (
+            int(counts[object_class]) if object_class is not None else 0)
+        for name, counts in zip(names, class_counts)
+    }
+    scalars["scans/total"] = sum(scalars.values())
+    stop = time.time()
+    scalars["scans/duration"] = stop - start
+    scalars["scans/snapshot_duration"] = snapshot_stop - start
+    scalars["scans/detect_duration"] = stop - snapshot_stop
+    context.events.add_scalars(scalars.items(), context.step)
     context.events.flush()
 
+def _writes_scan_files(context):
+    return (
+        context.save_snapshots or
+        context.save_detected_images or
+        context.result_format != "none")
+
+def _class_index(context):
+    try:
+        return context.detector.CLASS_NAMES.index(context.object_class)
+    except ValueError:
+        return None
+
+def _snapshot_cameras(context, scan_dir):
+    snapshots = {}
+    for name, result in sorted(snapshot.snapshot_all(
+            context.cameras,
+            context.snapshot_pool).items()):
+        if isinstance(result, snapshot.SnapshotError):
+            sys.stderr.write("Error snapshotting %s: %s\n" % (name, result))
+            continue
+        if context.save_snapshots:
+            with open(os.path.join(scan_dir, name + ".jpg"), "wb") as f:
+                f.write(result)
+        snapshots[name] = result
+    return snapshots
+
 def _timestamp():
     return int(time.time())
 
@@ -111,7 +222,7 @@ def _wait(seconds, context):
         time.sleep(seconds)
     except KeyboardInterrupt:
         sys.stderr.write("Stopping")
-        context.events.close()
+        context.close()
         sys.stderr.write("\n")
         return True
     else:
@@ -6,8 +6,86 @@ from __future__ import print_function
 
 import argparse
 import os
+import threading
 
-import amcrest
+import requests
+
+from requests import adapters
+from requests import auth
+
+SNAPSHOT_URL = "http://%s:%i/cgi-bin/snapshot.cgi?channel=%i"
+
+# Start of image marker that begins every JPEG.
+JPEG_SOI = b"\xff\xd8"
+
+# (connect, read) timeouts in seconds for each snapshot request.
+DEFAULT_TIMEOUT = (3.05, 10)
+
+class SnapshotError(Exception):
+    pass
+
+class Camera(object):
+    """Amcrest camera snapshotted over a persistent HTTP session.
+
+    Connections are kept alive and reused across snapshots. A camera
+    may be snapshotted concurrently from up to `pool_size` threads.
+    Cameras use digest auth and fall back to basic auth if the camera
+    rejects digest auth.
+    """
+
+    def __init__(self, host, port, user, password, channel=0,
+                 timeout=DEFAULT_TIMEOUT, pool_size=2):
+        self.host = host
+        self.url = SNAPSHOT_URL % (host, port, channel)
+        self.timeout = timeout
+        self._user = user
+        self._password = password
+        self._session = _init_session(pool_size)
+        self._session.auth = auth.HTTPDigestAuth(user, password)
+        self._auth_lock = threading.Lock()
+
+    def snapshot(self):
+        """Returns a snapshot as JPEG encoded bytes."""
+        resp = self._get()
+        if resp.status_code == 401 and self._fallback_to_basic_auth():
+            resp = self._get()
+        if resp.status_code != 200:
+            raise SnapshotError(
+                "snapshot from %s failed (HTTP %i)"
+                % (self.host, resp.status_code))
+        if not resp.content.startswith(JPEG_SOI):
+            # Cameras may reply 200 with an error page, which would
+            # otherwise fail when decoded for detection.
+            raise SnapshotError(
+                "snapshot from %s is not a JPEG image (%s)"
+                % (self.host, resp.headers.get("Content-Type", "unknown")))
+        return resp.content
+
+    def _get(self):
+        try:
+            return self._session.get(self.url, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise SnapshotError("snapshot from %s failed: %s" % (self.host, e))
+
+    def _fallback_to_basic_auth(self):
+        with self._auth_lock:
+            if isinstance(self._session.auth, auth.HTTPBasicAuth):
+                return False
+            self._session.auth = auth.HTTPBasicAuth(
+                self._user, self._password)
+            return True
+
+    def close(self):
+        self._session.close()
+
+def _init_session(pool_size):
+    session = requests.Session()
+    adapter = adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        max_retries=0)
+    session.mount("http://", adapter)
+    return session
 
 def main():
     args = _init_args()
@@ -15,12 +93,18 @@ def main():
         args.cam_host,
         args.cam_port,
         args.cam_user,
-        args.cam_password)
+        args.cam_password,
+        args.timeout)
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
     image_path = os.path.join(args.output_dir, "snapshot.jpg")
     print("Generating snapshot.jpg with camera at '%s'" % args.cam_host)
-    snapshot(camera, image_path)
+    try:
+        snapshot(camera, image_path)
+    except SnapshotError as e:
+        raise SystemExit(e)
+    finally:
+        camera.close()
 
 def _init_args():
     p = argparse.ArgumentParser()
@@ -29,14 +113,49 @@ def _init_args():
     p.add_argument("--cam-user", default="admin")
     p.add_argument("--cam-password", default="admin")
     p.add_argument("--output-dir", default="images")
+    p.add_argument("--timeout", default=DEFAULT_TIMEOUT[1], type=float)
     return p.parse_args()
 
-def init_camera(host, port, user, password):
-    ac = amcrest.AmcrestCamera(host, port, user, password)
-    return ac.camera
+def init_camera(host, port, user, password, timeout=None, pool_size=2):
+    return Camera(
+        host, port, user, password,
+        timeout=_init_timeout(timeout),
+        pool_size=pool_size)
+
+def _init_timeout(timeout):
+    if timeout is None:
+        return DEFAULT_TIMEOUT
+    return (min(DEFAULT_TIMEOUT[0], timeout), timeout)
+
+def snapshot(camera, image_path=None):
+    """Returns a snapshot from camera as JPEG encoded bytes.
+
+    If image_path is specified, the snapshot is also written to it.
+    """
+    data = camera.snapshot()
+    if image_path:
+        with open(image_path, "wb") as f:
+            f.write(data)
+    return data
+
+def snapshot_all(cameras, pool):
+    """Snapshots cameras concurrently using pool.
+
+    Each snapshot uses the timeout its camera was initialized with.
+
+    cameras is a dict of name to camera. Returns a dict of name to
+    JPEG encoded bytes, or to the SnapshotError for a failed snapshot.
+    """
+    names = sorted(cameras)
+    return dict(zip(names, pool.map(
+        lambda name: _try_snapshot(cameras[name]),
+        names)))
 
-def snapshot(camera, image_path):
-    camera.snapshot(0, image_path)
+def _try_snapshot(camera):
+    try:
+        return snapshot(camera)
+    except SnapshotError as e:
+        return e
 
 if __name__ == "__main__":
     main()
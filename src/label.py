@@ -8,73 +8,538 @@ from __future__ import print_function
 import argparse
 import errno
 import fnmatch
+import json
 import logging
 import os
 import signal
+import sqlite3
 import subprocess
 import sys
 import threading
 
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+
+import flask
+import werkzeug.serving
+
 log = logging.getLogger()
 
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
 from guild import _api as gapi
 
 import app_util
 
-class ImageWatcher(threading.Thread):
+class DirWatcher(threading.Thread):
+    """Base class for threads that handle files added to a directory.
 
-    def __init__(self, src_dir, dest_dir):
-        super(ImageWatcher, self).__init__()
+    Uses inotify to receive file events when inotify_simple is
+    available, otherwise polls the directory for changes. Subclasses
+    override `_handle(names)` to process added names and may
+    override `_sync()` and `_handle_removed(names)`.
+    """
+
+    poll_interval = 2.0
+    watch_flags = ("CREATE", "MOVED_TO")
+    remove_flags = ()
+
+    def __init__(self, src_dir):
+        super(DirWatcher, self).__init__()
         self.src_dir = src_dir
-        self.dest_dir = dest_dir
         self._stop_event = threading.Event()
+        self._src_mtime = None
+        self._inotify = None
 
     def start(self):
-        self._link()
-        super(ImageWatcher, self).start()
+        self._inotify = self._init_inotify()
+        self._sync()
+        super(DirWatcher, self).start()
+
+    def _init_inotify(self):
+        if inotify_simple is None:
+            log.debug("inotify not available, polling %s", self.src_dir)
+            return None
+        app_util.ensure_dir(self.src_dir)
+        inotify = inotify_simple.INotify()
+        inotify.add_watch(
+            self.src_dir,
+            self._flags_mask(self.watch_flags + self.remove_flags))
+        return inotify
+
+    @staticmethod
+    def _flags_mask(names):
+        mask = 0
+        for name in names:
+            mask |= getattr(inotify_simple.flags, name)
+        return mask
 
     def run(self):
-        while True:
-            if self._stop_event.wait(2.0):
-                break
-            self._link()
+        if self._inotify:
+            self._watch()
+        else:
+            self._poll()
+
+    def _watch(self):
+        timeout = int(self.poll_interval * 1000)
+        remove_mask = self._flags_mask(self.remove_flags)
+        try:
+            while not self._stop_event.is_set():
+                events = self._inotify.read(timeout=timeout)
+                self._handle_events(events, remove_mask)
+        finally:
+            self._inotify.close()
+
+    def _handle_events(self, events, remove_mask):
+        added = []
+        removed = []
+        for event in events:
+            if not event.name:
+                continue
+            if event.mask & remove_mask:
+                removed.append(event.name)
+            else:
+                added.append(event.name)
+        if removed:
+            self._handle_removed(removed)
+        if added:
+            self._handle(added)
+
+    def _poll(self):
+        while not self._stop_event.wait(self.poll_interval):
+            self._sync()
 
     def stop(self):
         self._stop_event.set()
         self.join()
 
-    def _link(self):
-        for name in _safe_listdir(self.src_dir):
+    def _sync(self):
+        mtime = _safe_mtime(self.src_dir)
+        if mtime is not None and mtime == self._src_mtime:
+            return
+        self._src_mtime = mtime
+        self._handle(_safe_listdir(self.src_dir))
+
+    def _handle(self, names):
+        """Handles names added to src_dir (ignored by default)."""
+        pass
+
+    def _handle_removed(self, names):
+        """Handles names removed from src_dir (ignored by default)."""
+        pass
+
+class ImageWatcher(DirWatcher):
+    """Links images from src_dir into dest_dir as they appear.
+
+    Only names matching pattern are linked. Names already linked are
+    tracked in memory so each file is linked once. If an annotation
+    index is provided, linked images are added to it.
+    """
+
+    def __init__(self, src_dir, dest_dir, index=None, pattern="*.jpg"):
+        super(ImageWatcher, self).__init__(src_dir)
+        self.dest_dir = dest_dir
+        self.index = index
+        self.pattern = pattern
+        self._linked = set()
+
+    def start(self):
+        self._linked.update(
+            fnmatch.filter(_safe_listdir(self.dest_dir), self.pattern))
+        if self.index:
+            self.index.add_images(self._linked)
+        super(ImageWatcher, self).start()
+
+    def _handle(self, names):
+        linked = []
+        for name in fnmatch.filter(names, self.pattern):
+            if name in self._linked:
+                continue
             src = os.path.join(self.src_dir, name)
             dest = os.path.join(self.dest_dir, name)
-            _safe_link(src, dest)
+            if _safe_link(src, dest, quiet=True):
+                linked.append(name)
+            self._linked.add(name)
+        _log_linked(linked)
+        if self.index and linked:
+            self.index.add_images(linked)
+
+class AnnotationWatcher(DirWatcher):
+    """Updates an annotation index as VOC annotations are saved.
+
+    When polling, annotation mtimes are compared with those recorded
+    in the index so that annotations changed in place are re-read.
+    """
+
+    watch_flags = ("CLOSE_WRITE", "MOVED_TO")
+    remove_flags = ("DELETE", "MOVED_FROM")
+
+    def __init__(self, src_dir, index):
+        super(AnnotationWatcher, self).__init__(src_dir)
+        self.index = index
+
+    def _sync(self):
+        names = [
+            name for name in _safe_listdir(self.src_dir)
+            if name.endswith(".xml")
+        ]
+        mtimes = self.index.annotation_mtimes()
+        self._handle_removed(set(mtimes) - set(names))
+        self._handle([
+            name for name in names
+            if _safe_mtime(self._path(name)) != mtimes.get(name)
+        ])
+
+    def _path(self, name):
+        return os.path.join(self.src_dir, name)
+
+    def _handle(self, names):
+        for name in names:
+            if not name.endswith(".xml"):
+                continue
+            path = self._path(name)
+            try:
+                image, classes = _read_annotation(path)
+            except Exception as e:
+                log.warning("error reading annotation %s: %s", path, e)
+            else:
+                if not self.index.set_annotation(
+                        name, image, classes, _safe_mtime(path)):
+                    log.debug(
+                        "ignoring annotation %s for unknown image %s",
+                        path, image)
+
+    def _handle_removed(self, names):
+        for name in names:
+            self.index.remove_annotation(name)
+
+def _read_annotation(path):
+    root = ElementTree.parse(path).getroot()
+    image = root.findtext("filename")
+    if not image:
+        image = os.path.splitext(os.path.basename(path))[0] + ".jpg"
+    classes = {}
+    for obj in root.iter("object"):
+        name = obj.findtext("name")
+        if name:
+            classes[name] = classes.get(name, 0) + 1
+    return image, classes
+
+class AnnotationIndex(object):
+    """Index of labeled and unlabeled images kept in SQLite.
+
+    Image, labeled and per-class object totals are maintained in a
+    `total` table as images and annotations change, so progress can
+    be read without counting rows. The next unlabeled image is read
+    using the `image_annotation` index.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS image (
+            name TEXT PRIMARY KEY,
+            annotation TEXT,
+            annotation_mtime REAL);
+        CREATE INDEX IF NOT EXISTS image_annotation
+            ON image (annotation);
+        CREATE TABLE IF NOT EXISTS image_class (
+            image TEXT,
+            class TEXT,
+            count INTEGER,
+            PRIMARY KEY (image, class));
+        CREATE TABLE IF NOT EXISTS total (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(self.schema)
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def add_images(self, names):
+        with self._lock, self._db:
+            self._add_images(names)
+
+    def _add_images(self, names):
+        cur = self._db.executemany(
+            "INSERT OR IGNORE INTO image (name) VALUES (?)",
+            [(name,) for name in names])
+        self._incr("images", cur.rowcount)
+
+    def set_annotation(self, annotation, image, classes, mtime):
+        """Sets the annotation for image.
+
+        Returns False if image isn't in the index, in which case the
+        annotation isn't recorded.
+        """
+        with self._lock, self._db:
+            self._remove_annotation(annotation)
+            if not self._has_image(image):
+                return False
+            self._clear_image_annotation(image)
+            self._db.execute(
+                "UPDATE image SET annotation = ?, annotation_mtime = ? "
+                "WHERE name = ?", (annotation, mtime, image))
+            self._incr("labeled", 1)
+            self._db.executemany(
+                "INSERT INTO image_class (image, class, count) "
+                "VALUES (?, ?, ?)",
+                [(image, name, count) for name, count in classes.items()])
+            for name, count in classes.items():
+                self._incr("class:" + name, count)
+        return True
+
+    def _has_image(self, image):
+        return self._db.execute(
+            "SELECT 1 FROM image WHERE name = ?",
+            (image,)).fetchone() is not None
+
+    def remove_annotation(self, annotation):
+        with self._lock, self._db:
+            self._remove_annotation(annotation)
+
+    def _remove_annotation(self, annotation):
+        row = self._db.execute(
+            "SELECT name FROM image WHERE annotation = ?",
+            (annotation,)).fetchone()
+        if row:
+            self._clear_image_annotation(row[0])
+
+    def _clear_image_annotation(self, image):
+        row = self._db.execute(
+            "SELECT annotation FROM image WHERE name = ?",
+            (image,)).fetchone()
+        if not row or row[0] is None:
+            return
+        classes = self._db.execute(
+            "SELECT class, count FROM image_class WHERE image = ?",
+            (image,)).fetchall()
+        for name, count in classes:
+            self._incr("class:" + name, -count)
+        self._db.execute(
+            "DELETE FROM image_class WHERE image = ?", (image,))
+        self._db.execute(
+            "UPDATE image SET annotation = NULL, annotation_mtime = NULL "
+            "WHERE name = ?", (image,))
+        self._incr("labeled", -1)
+
+    def _incr(self, key, n):
+        if not n:
+            return
+        self._db.execute(
+            "INSERT OR IGNORE INTO total (key, value) VALUES (?, 0)",
+            (key,))
+        self._db.execute(
+            "UPDATE total SET value = value + ? WHERE key = ?", (n, key))
+
+    def annotation_mtimes(self):
+        with self._lock:
+            return dict(self._db.execute(
+                "SELECT annotation, annotation_mtime FROM image "
+                "WHERE annotation IS NOT NULL"))
+
+    def progress(self):
+        with self._lock:
+            totals = dict(self._db.execute("SELECT key, value FROM total"))
+        images = totals.pop("images", 0)
+        labeled = totals.pop("labeled", 0)
+        return {
+            "images": images,
+            "labeled": labeled,
+            "unlabeled": images - labeled,
+            "classes": {
+                key[6:]: val for key, val in totals.items()
+                if key.startswith("class:") and val
+            },
+        }
+
+    def next_unlabeled(self, after=None):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT name FROM image "
+                "WHERE annotation IS NULL AND rowid > "
+                "  COALESCE((SELECT rowid FROM image WHERE name = ?), 0) "
+                "ORDER BY rowid LIMIT 1", (after,)).fetchone()
+        return row[0] if row else None
 
 def _safe_listdir(d):
     try:
         return os.listdir(d)
-    except IOError as e:
+    except OSError as e:
         if e.errno != errno.ENOENT:
             raise
         return []
 
-def _safe_link(src, dest):
+def _safe_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+def _safe_link(src, dest, quiet=False):
     dest_dir = os.path.dirname(dest)
     try:
         os.symlink(os.path.relpath(src, dest_dir), dest)
-    except IOError as e:
+    except OSError as e:
         if e.errno != errno.EEXIST:
             raise
+        return False
     else:
-        sys.stderr.write("Linked {}\n".format(os.path.basename(src)))
+        if not quiet:
+            sys.stderr.write("Linked {}\n".format(os.path.basename(src)))
+        return True
+
+def _log_linked(names):
+    if len(names) == 1:
+        sys.stderr.write("Linked {}\n".format(names[0]))
+    elif names:
+        sys.stderr.write("Linked {} images\n".format(len(names)))
+
+class RunImageIndex(object):
+    """Persistent index of images in run directories.
+
+    The index records the mtime, subdirectories and matching image
+    names of each scanned run directory. A directory is only listed
+    again when its mtime changes, so updating the index for runs
+    that haven't changed costs one stat per directory.
+    """
+
+    def __init__(self, path, pattern):
+        self.path = path
+        self.pattern = pattern
+        self._runs = self._load()
+
+    def _load(self):
+        try:
+            data = json.load(open(self.path))
+        except (IOError, ValueError):
+            return {}
+        if data.get("pattern") != self.pattern:
+            return {}
+        return data.get("runs", {})
+
+    def update(self, runs, workers=8):
+        pool = ThreadPool(max(1, workers))
+        try:
+            scanned = pool.map(
+                self._scan_run,
+                [(run.id, run.path) for run in runs])
+        finally:
+            pool.close()
+            pool.join()
+        self._runs = dict(scanned)
+
+    def _scan_run(self, run):
+        run_id, run_dir = run
+        cached = self._runs.get(run_id, {})
+        if cached.get("path") != run_dir:
+            cached = {}
+        dirs = {}
+        self._scan_dir(run_dir, "", cached.get("dirs", {}), dirs)
+        return run_id, {"path": run_dir, "dirs": dirs}
+
+    def _scan_dir(self, root, rel_dir, cached, dirs):
+        path = os.path.join(root, rel_dir)
+        mtime = _safe_mtime(path)
+        if mtime is None:
+            return
+        entry = cached.get(rel_dir)
+        if entry is None or entry[0] != mtime:
+            subdirs, files = _list_dir(path)
+            entry = [mtime, subdirs, fnmatch.filter(files, self.pattern)]
+        dirs[rel_dir] = entry
+        for name in entry[1]:
+            self._scan_dir(root, os.path.join(rel_dir, name), cached, dirs)
+
+    def images(self):
+        for _run_id, run in sorted(self._runs.items()):
+            for rel_dir, (_mtime, _subdirs, names) in sorted(
+                    run["dirs"].items()):
+                for name in names:
+                    yield name, os.path.join(run["path"], rel_dir, name)
+
+    def save(self):
+        data = {
+            "pattern": self.pattern,
+            "runs": self._runs,
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.rename(tmp, self.path)
+
+def _list_dir(path):
+    subdirs = []
+    files = []
+    for name in _safe_listdir(path):
+        if name == ".guild":
+            continue
+        name_path = os.path.join(path, name)
+        if os.path.isdir(name_path):
+            if not os.path.islink(name_path):
+                subdirs.append(name)
+        else:
+            files.append(name)
+    return sorted(subdirs), sorted(files)
+
+class ProgressServer(threading.Thread):
+
+    def __init__(self, host, port, index):
+        super(ProgressServer, self).__init__()
+        app.index = index
+        self._server = werkzeug.serving.make_server(
+            host, port, app, threaded=True)
+
+    def run(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self.join()
+
+app = flask.Flask(__name__)
+
+@app.route("/progress")
+def progress():
+    return _json_response(flask.current_app.index.progress())
+
+@app.route("/next")
+def next_image():
+    after = flask.request.args.get("after")
+    image = flask.current_app.index.next_unlabeled(after)
+    return _json_response({"image": image})
+
+def _json_response(val):
+    return flask.Response(
+        json.dumps(val),
+        mimetype="application/json",
+        headers=[("Access-Control-Allow-Origin", "*")])
 
 def main():
     args = _init_args()
     _maybe_collect_op_images(args)
-    watcher = _init_watcher(args)
-    watcher.start()
+    index = AnnotationIndex(args.progress_db)
+    watchers = _init_watchers(args, index)
+    for watcher in watchers:
+        watcher.start()
+    progress_server = ProgressServer(args.host, args.progress_port, index)
+    progress_server.start()
     sys.stderr.write(
         "Running labeling app at http://{}:{}\n".format(
             args.host, args.port))
+    sys.stderr.write(
+        "Labeling progress available at http://{}:{}/progress\n".format(
+            args.host, args.progress_port))
     proc = subprocess.Popen(
         ["php", "-S", "{}:{}".format(args.host, args.port)],
         stdout=subprocess.PIPE,
@@ -92,35 +557,42 @@ def main():
         else:
             sys.stderr.write(out.decode())
     exit_code = proc.wait()
-    watcher.stop()
+    for watcher in watchers:
+        watcher.stop()
+    progress_server.stop()
+    index.close()
     sys.exit(exit_code)
 
-def _init_watcher(args):
-    src_dir = args.image_dir
-    dest_dir = os.path.join(args.app_dir, "data/images")
-    return ImageWatcher(src_dir, dest_dir)
+def _init_watchers(args, index):
+    images_dir = os.path.join(args.app_dir, "data/images")
+    annotations_dir = os.path.join(args.app_dir, "data/annotations")
+    return [
+        ImageWatcher(args.image_dir, images_dir, index, args.image_pattern),
+        AnnotationWatcher(annotations_dir, index),
+    ]
 
 def _maybe_collect_op_images(args):
     if not args.image_op:
         return
-    for run in gapi.runs_list(
-            ops=[args.image_op],
-            status=["running", "completed", "terminated"]):
-        _link_to_images(run.path, args.image_dir, args.image_pattern)
-
-def _link_to_images(src, dest, pattern):
-    for name, path in _iter_images(src, pattern):
-        app_util.ensure_dir(dest)
-        _safe_link(path, os.path.join(dest, name))
-
-def _iter_images(src, pattern):
-    for root, dirs, files in os.walk(src):
-        try:
-            dirs.remove(".guild")
-        except ValueError:
-            pass
-        for name in fnmatch.filter(files, pattern):
-            yield name, os.path.join(root, name)
+    runs = gapi.runs_list(
+        ops=[args.image_op],
+        status=["running", "completed", "terminated"])
+    index = RunImageIndex(args.image_index, args.image_pattern)
+    index.update(runs, args.scan_workers)
+    index.save()
+    _link_images(index.images(), args.image_dir)
+
+def _link_images(images, dest):
+    app_util.ensure_dir(dest)
+    existing = set(_safe_listdir(dest))
+    linked = []
+    for name, path in images:
+        if name in existing:
+            continue
+        if _safe_link(path, os.path.join(dest, name), quiet=True):
+            linked.append(name)
+        existing.add(name)
+    _log_linked(linked)
 
 def _init_args():
     p = argparse.ArgumentParser()
@@ -133,6 +605,15 @@ def _init_args():
         default=8003,
         type=int,
         help="App port (8003)")
+    p.add_argument(
+        "--progress-port",
+        default=8005,
+        type=int,
+        help="Labeling progress endpoint port (8005)")
+    p.add_argument(
+        "--progress-db",
+        default="label-progress.db",
+        help="Labeling progress database (label-progress.db)")
     p.add_argument(
         "--image-dir",
         default="images",
@@ -144,6 +625,15 @@ def _init_args():
     p.add_argument(
         "--image-op",
         help="Use images from IMAGE_OP runs")
+    p.add_argument(
+        "--image-index",
+        default="image-index.json",
+        help="Index of IMAGE_OP run images (image-index.json)")
+    p.add_argument(
+        "--scan-workers",
+        default=8,
+        type=int,
+        help="Number of IMAGE_OP runs to scan in parallel (8)")
     p.add_argument(
         "--app-dir",
         default="app",
@@ -0,0 +1,113 @@
+"""Sampling profiler for app threads.
+
+`ThreadSampler` periodically samples the stacks of a set of threads
+without instrumenting them, which makes it suitable for use in running
+apps. Samples are exported in speedscope format
+(https://www.speedscope.app) or as collapsed stacks for flamegraph.pl.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import sys
+import threading
+import time
+
+DEFAULT_INTERVAL = 0.005
+
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+class ThreadSampler(threading.Thread):
+    """Samples the stacks of threads at a regular interval.
+
+    threads is a dict of thread ident to name.
+    """
+
+    def __init__(self, threads, interval=DEFAULT_INTERVAL):
+        super(ThreadSampler, self).__init__()
+        self.daemon = True
+        self.threads = threads
+        self.interval = interval
+        self._frames = {}
+        self._samples = {ident: [] for ident in threads}
+        self._stop_event = threading.Event()
+        self._start_time = None
+        self._stop_time = None
+
+    def run(self):
+        self._start_time = time.time()
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, samples in self._samples.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    samples.append(self._stack(frame))
+        self._stop_time = time.time()
+
+    def _stack(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            key = code.co_name, code.co_filename, code.co_firstlineno
+            try:
+                stack.append(self._frames[key])
+            except KeyError:
+                i = self._frames[key] = len(self._frames)
+                stack.append(i)
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def speedscope(self, name="profile"):
+        """Returns samples as a speedscope file dict."""
+        frames = [None] * len(self._frames)
+        for (func, path, line), i in self._frames.items():
+            frames[i] = {
+                "name": func,
+                "file": path,
+                "line": line,
+            }
+        duration = (self._stop_time or time.time()) - self._start_time
+        return {
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": name,
+            "exporter": name,
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": self.threads[ident],
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": duration,
+                    "samples": samples,
+                    "weights": [self.interval] * len(samples),
+                }
+                for ident, samples in sorted(self._samples.items())
+            ],
+        }
+
+    def collapsed(self):
+        """Returns samples as collapsed stack lines.
+
+        Stacks are prefixed with the thread name.
+        """
+        names = {}
+        for (func, path, line), i in self._frames.items():
+            names[i] = "{} ({}:{})".format(func, os.path.basename(path), line)
+        counts = collections.Counter()
+        for ident, samples in self._samples.items():
+            for stack in samples:
+                counts[";".join(
+                    [self.threads[ident]] + [names[i] for i in stack])] += 1
+        return [
+            "{} {}".format(stack, count)
+            for stack, count in counts.most_common()
+        ]
@@ -8,6 +8,7 @@ from __future__ import print_function
 import argparse
 import logging
 import os
+import shutil
 import signal
 import subprocess
 import sys
@@ -16,12 +17,17 @@ import threading
 import time
 
 import app_util
+import framebus
+import tracing
 
 log = logging.getLogger("pump")
 
 DEFAULT_HOST = "localhost"
 DEFAULT_IMAGE_DIR = "/tmp/pump-images"
 
+# Backends that read frames published by pump.
+CONSUMER_BACKENDS = ("framebus", "proxy")
+
 class ImageProxyError(Exception):
     pass
 
@@ -44,10 +50,25 @@ class ImageProxy(object):
     def __str__(self):
         return "image proxy %s" % self._host
 
-    def copy(self, name, src):
+    def copy(self, name, src, sidecar=False):
         _, ext = os.path.splitext(src)
-        dest = "{}:{}/{}{}".format(self._host, self._path, name, ext)
-        cmd = self._rsync_cmd_base + [src, dest]
+        if sidecar:
+            # Image and sidecar are copied in one transfer to the image
+            # dir, which requires src to be named for the camera.
+            # Updates are delayed so both files are put in place
+            # together.
+            if os.path.basename(src) != name + ext:
+                raise ValueError(
+                    "image %s must be named %s%s to copy trace sidecar"
+                    % (src, name, ext))
+            opts = ["--delay-updates"]
+            srcs = [src, tracing.sidecar_path(src)]
+            dest = "{}:{}/".format(self._host, self._path)
+        else:
+            opts = []
+            srcs = [src]
+            dest = "{}:{}/{}{}".format(self._host, self._path, name, ext)
+        cmd = self._rsync_cmd_base + opts + srcs + [dest]
         p = subprocess.Popen(
             cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         out, err = p.communicate()
@@ -56,11 +77,12 @@ class ImageProxy(object):
 
 class CameraPump(threading.Thread):
 
-    def __init__(self, camera, proxy, interval):
+    def __init__(self, camera, proxy, interval, tracer=None):
         super(CameraPump, self).__init__()
         self.camera = camera
         self.proxy = proxy
         self.interval = interval
+        self.tracer = tracer or tracing.Tracer("pump")
         self._stop_event = threading.Event()
 
     def run(self):
@@ -72,6 +94,9 @@ class CameraPump(threading.Thread):
                 break
 
     def _snapshot_and_copy(self):
+        if self.tracer.enabled:
+            self._traced_snapshot_and_copy()
+            return
         with tempfile.NamedTemporaryFile(
                 prefix="pump-snashot-",
                 suffix=".jpg") as tmp:
@@ -86,6 +111,30 @@ class CameraPump(threading.Thread):
                 except Exception as e:
                     self._handle_proxy_error(e)
 
+    def _traced_snapshot_and_copy(self):
+        # Snapshot is named for the camera so that it can be copied
+        # with its sidecar.
+        tmp_dir = tempfile.mkdtemp(prefix="pump-snapshot-")
+        try:
+            path = os.path.join(tmp_dir, self.camera.key + ".jpg")
+            frame_id = tracing.new_frame_id()
+            key = self.camera.key
+            log.info("snapshot from %s (frame %s)", self.camera, frame_id)
+            try:
+                with self.tracer.span(frame_id, key, "capture"):
+                    self.camera.snapshot(path)
+            except Exception as e:
+                self._handle_camera_error(e)
+                return
+            tracing.write_sidecar(path, frame_id, key)
+            try:
+                with self.tracer.span(frame_id, key, "push"):
+                    self.proxy.copy(key, path, sidecar=True)
+            except Exception as e:
+                self._handle_proxy_error(e)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
     def _handle_camera_error(self, e):
         if self._stop_event.is_set():
             return
@@ -120,43 +169,63 @@ def main():
         _test_image(args.test, config)
     else:
         print("Running image pump (press Ctrl-C to stop)")
+        tracer = tracing.Tracer("pump", args.trace_dir)
+        tracer.start()
         pumps = _start_pumps(
             config,
             args.interval,
             args.host,
-            args.image_path)
-        _init_signal_handlers(pumps)
+            args.image_path,
+            tracer,
+            _init_frame_bus(args))
+        _init_signal_handlers(pumps, tracer)
         signal.pause()
 
 def _test_image(key, config):
     if config.get("cameras", {}).get(key) is None:
         print("No such camera: %s" % key)
         sys.exit(1)
-    cam = app_util.init_camera(key, config)
+    cam = _init_camera(key, config)
     snapshot_path = os.path.join(tempfile.gettempdir(), key + ".jpg")
     print("Snapshotting %s to %s" % (key, snapshot_path))
     cam.snapshot(snapshot_path)
 
-def _start_pumps(config, interval, host, image_path):
+def _init_camera(key, config):
+    return app_util.init_camera(key, config, exclude=CONSUMER_BACKENDS)
+
+def _start_pumps(config, interval, host, image_path, tracer=None,
+                 frame_bus=None):
     pumps = []
-    proxy = ImageProxy(config, host, image_path)
+    proxy = frame_bus or ImageProxy(config, host, image_path)
     for key in config.get("cameras", {}):
-        camera = app_util.init_camera(key, config)
+        camera = _init_camera(key, config)
         log.debug("camera %s config: %s", key, camera.config)
-        pump = CameraPump(camera, proxy, interval)
+        pump = CameraPump(camera, proxy, interval, tracer)
         pump.start()
         pumps.append(pump)
     return pumps
 
-def _init_signal_handlers(pumps):
-    stop = lambda *_args: _stop(pumps)
+def _init_frame_bus(args):
+    if not args.frame_bus:
+        return None
+    return framebus.FrameBusProxy(
+        args.frame_bus_dir,
+        args.frame_bus_decode,
+        args.frame_bus_max_frame)
+
+def _init_signal_handlers(pumps, tracer):
+    stop = lambda *_args: _stop(pumps, tracer)
     signal.signal(signal.SIGINT, stop)
     signal.signal(signal.SIGTERM, stop)
 
-def _stop(cameras):
+def _stop(cameras, tracer):
     print("\b\bStopping")
     for c in cameras:
         c.stop()
+    for c in cameras:
+        c.join()
+        c.camera.close()
+    tracer.close()
 
 def _init_args():
     p = argparse.ArgumentParser()
@@ -175,6 +244,29 @@ def _init_args():
         default=5.0,
         type=float,
         help="Seconds between snapshots (5)")
+    p.add_argument(
+        "--frame-bus",
+        action="store_true",
+        help=(
+            "Publish images to the local frame bus rather than the image "
+            "proxy"))
+    p.add_argument(
+        "--frame-bus-dir", metavar="PATH",
+        help="Frame bus directory (/dev/shm)")
+    p.add_argument(
+        "--frame-bus-decode",
+        action="store_true",
+        help="Publish decoded images with encoded images to the frame bus")
+    p.add_argument(
+        "--frame-bus-max-frame", metavar="WxH",
+        default=framebus.DEFAULT_MAX_FRAME,
+        type=app_util.parse_image_size,
+        help=(
+            "Max size of decoded images published to the frame bus "
+            "(1920x1080)"))
+    p.add_argument(
+        "--trace-dir", metavar="PATH",
+        help="Write frame trace spans to PATH (disabled by default)")
     p.add_argument(
         "--test",
         help="Test a camera and exit")
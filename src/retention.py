@@ -0,0 +1,340 @@
+"""Retention and compaction of archived and collected camera images.
+
+Retention is configured in the `retention` section of config.json:
+
+    "retention": {
+      "interval": "10m",
+      "quota": "50G",
+      "policy": [
+        {"max-age": "24h"},
+        {"max-age": "7d", "every": "1m"},
+        {"every": "1h"}
+      ]
+    }
+
+A policy is a list of tiers ordered by age. Frames younger than a
+tier's `max-age` are kept at most once per `every` interval (all
+frames are kept if `every` is omitted). Frames older than the last
+tier's `max-age` are removed. A camera may override the policy with
+`retention-policy` in its camera config.
+
+When `quota` is exceeded, the oldest archive segments and collected
+images are removed until the total size is under the quota.
+
+Retention is applied by `RetentionManager` in a background thread at
+low CPU and I/O priority. To apply it once from the command line run:
+
+    python retention.py --archive-dir archive --save-dir images
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+
+import app_util
+import frame_archive
+
+log = logging.getLogger("retention")
+
+DEFAULT_INTERVAL = 600
+
+DURATION_UNITS = {
+    "": 1,
+    "s": 1,
+    "m": 60,
+    "h": 60 * 60,
+    "d": 24 * 60 * 60,
+    "w": 7 * 24 * 60 * 60,
+}
+
+SIZE_UNITS = {
+    "": 1,
+    "K": 1024,
+    "M": 1024 ** 2,
+    "G": 1024 ** 3,
+    "T": 1024 ** 4,
+}
+
+COLLECTED_IMAGE_PATTERN = re.compile(
+    r"^(.+)-(\d+)\.(?:jpe?g|png)$", re.IGNORECASE)
+
+class RetentionError(Exception):
+    pass
+
+class Policy(object):
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+
+    @classmethod
+    def from_config(cls, config):
+        # An empty policy keeps everything.
+        return cls([
+            (_parse_optional(tier.get("max-age"), parse_duration),
+             _parse_optional(tier.get("every"), parse_duration))
+            for tier in config
+        ] or [(None, None)])
+
+    def select(self, items, now, seen=None):
+        """Returns items to keep.
+
+        items is a list of (time, kind, item) tuples sorted by time.
+        One item of each kind is kept for each `every` interval of a
+        tier. To select across several calls, provide the same `seen`
+        set for each call.
+        """
+        keep = []
+        seen = set() if seen is None else seen
+        for item_time, kind, item in items:
+            tier = self._tier(now - item_time)
+            if tier is None:
+                continue
+            every = self.tiers[tier][1]
+            if every:
+                bucket = (tier, kind, int(item_time // every))
+                if bucket in seen:
+                    continue
+                seen.add(bucket)
+            keep.append(item)
+        return keep
+
+    def _tier(self, age):
+        for i, (max_age, _every) in enumerate(self.tiers):
+            if max_age is None or age < max_age:
+                return i
+        return None
+
+class RetentionManager(threading.Thread):
+    """Applies retention to archive_dir and save_dir periodically."""
+
+    def __init__(self, config, archive_dir=None, save_dir=None):
+        super(RetentionManager, self).__init__()
+        self.daemon = True
+        retention = config.get("retention", {})
+        self.archive_dir = archive_dir
+        self.save_dir = save_dir
+        self.interval = _parse_optional(
+            retention.get("interval"), parse_duration) or DEFAULT_INTERVAL
+        self.quota = _parse_optional(retention.get("quota"), parse_size)
+        self._default_policy = Policy.from_config(
+            retention.get("policy", []))
+        self._camera_policies = {
+            key: Policy.from_config(cam["retention-policy"])
+            for key, cam in config.get("cameras", {}).items()
+            if "retention-policy" in cam
+        }
+        self._stop_event = threading.Event()
+
+    def policy(self, camera):
+        return self._camera_policies.get(camera, self._default_policy)
+
+    def run(self):
+        _lower_priority()
+        while True:
+            try:
+                self.apply()
+            except Exception:
+                log.exception("applying retention")
+            if self._stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        self._stop_event.set()
+
+    def apply(self, now=None):
+        now = now or time.time()
+        if self.archive_dir:
+            self._compact_archive(now)
+        if self.save_dir:
+            self._compact_save_dir(now)
+        if self.quota:
+            self._enforce_quota()
+
+    def _compact_archive(self, now):
+        for camera, bases in frame_archive.segments(self.archive_dir).items():
+            policy = self.policy(camera)
+            seen = set()
+            # The last segment is being appended to and is left as is.
+            for base in bases[:-1]:
+                self._compact_segment(base, policy, now, seen)
+
+    @staticmethod
+    def _compact_segment(base, policy, now, seen):
+        frames = frame_archive.segment_frames(base)
+        keep = policy.select(
+            [(frame.time, frame.kind, frame) for frame in frames],
+            now, seen)
+        if not keep:
+            log.debug("removing segment %s", base)
+            frame_archive.remove_segment(base)
+        elif len(keep) < len(frames):
+            log.debug(
+                "compacting segment %s (%i of %i frames)",
+                base, len(keep), len(frames))
+            frame_archive.rewrite_segment(base, keep)
+
+    def _compact_save_dir(self, now):
+        by_camera = {}
+        for _name, path, camera, item_time in _collected_images(
+                self.save_dir):
+            by_camera.setdefault(camera, []).append((item_time, "", path))
+        for camera, items in by_camera.items():
+            items.sort()
+            keep = set(self.policy(camera).select(items, now))
+            for _time, _kind, path in items:
+                if path not in keep:
+                    _remove(path)
+
+    def _enforce_quota(self):
+        units = self._storage_units()
+        total = sum(unit[1] for unit in units)
+        for _time, size, remove in sorted(units, key=lambda unit: unit[0]):
+            if total <= self.quota:
+                break
+            remove()
+            total -= size
+        if total > self.quota:
+            log.warning(
+                "image storage (%i bytes) exceeds quota (%i bytes)",
+                total, self.quota)
+
+    def _storage_units(self):
+        units = []
+        if self.archive_dir:
+            for bases in frame_archive.segments(self.archive_dir).values():
+                for i, base in enumerate(bases):
+                    size = (
+                        _file_size(base + ".seg") +
+                        _file_size(base + ".idx"))
+                    if i == len(bases) - 1:
+                        # Active segment counts towards quota but is kept.
+                        units.append((float("inf"), size, lambda: None))
+                    else:
+                        units.append((
+                            _segment_time(base),
+                            size,
+                            _remove_segment_fn(base)))
+        if self.save_dir:
+            for _name, path, _camera, item_time in _collected_images(
+                    self.save_dir):
+                units.append((item_time, _file_size(path), _remove_fn(path)))
+        return units
+
+def _collected_images(save_dir):
+    # Only images named by collect (<camera>-<ms>.<ext>) are yielded so
+    # that other files in save_dir are never removed.
+    for name in _safe_listdir(save_dir):
+        m = COLLECTED_IMAGE_PATTERN.match(name)
+        if m:
+            path = os.path.join(save_dir, name)
+            yield name, path, m.group(1), int(m.group(2)) / 1000
+
+def _segment_time(base):
+    frames = frame_archive.segment_frames(base)
+    return frames[-1].time if frames else 0
+
+def _remove_segment_fn(base):
+    return lambda: frame_archive.remove_segment(base)
+
+def _remove_fn(path):
+    return lambda: _remove(path)
+
+def _remove(path):
+    log.debug("removing %s", path)
+    try:
+        os.remove(path)
+    except OSError as e:
+        log.warning("error removing %s: %s", path, e)
+
+def _safe_listdir(d):
+    try:
+        return os.listdir(d)
+    except OSError:
+        return []
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def _lower_priority():
+    """Lowers CPU and I/O priority of the current thread where supported.
+
+    CPU and I/O priorities are per thread on Linux so this doesn't
+    affect other threads in the process.
+    """
+    get_native_id = getattr(threading, "get_native_id", None)
+    if get_native_id is None:
+        return
+    tid = get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+    except (AttributeError, OSError) as e:
+        log.debug("unable to lower CPU priority: %s", e)
+    with open(os.devnull, "w") as null:
+        try:
+            subprocess.check_call(
+                ["ionice", "-c", "3", "-p", str(tid)],
+                stdout=null, stderr=null)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.debug("unable to lower I/O priority: %s", e)
+
+def parse_duration(s):
+    return _parse_units(s, DURATION_UNITS, "duration")
+
+def parse_size(s):
+    return _parse_units(s, SIZE_UNITS, "size")
+
+def _parse_units(s, units, desc):
+    if isinstance(s, (int, float)):
+        return s
+    m = re.match(r"^\s*([0-9.]+)\s*([a-zA-Z]?)\s*$", str(s))
+    if not m:
+        raise RetentionError("invalid %s '%s'" % (desc, s))
+    val, unit = m.groups()
+    try:
+        mult = units[unit if unit in units else unit.upper()]
+    except KeyError:
+        raise RetentionError("invalid %s unit in '%s'" % (desc, s))
+    return float(val) * mult
+
+def _parse_optional(val, parse):
+    return None if val is None else parse(val)
+
+def main():
+    args = _parse_args()
+    app_util.init_logging(args.debug)
+    config = app_util.load_config(args.config)
+    manager = RetentionManager(config, args.archive_dir, args.save_dir)
+    _lower_priority()
+    manager.apply()
+
+def _parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--config", metavar="PATH",
+        default="config.json",
+        help="App config (config.json)")
+    p.add_argument(
+        "--archive-dir", metavar="PATH",
+        help="Scan archive directory to apply retention to")
+    p.add_argument(
+        "--save-dir", metavar="PATH",
+        help="Collected images directory to apply retention to")
+    p.add_argument(
+        "--debug",
+        action="store_true",
+        help="Print debug info")
+    return p.parse_args()
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,9 @@ from __future__ import print_function
 
 import argparse
 import base64
+import contextlib
+import hmac
+import io
 import json
 import logging
 import os
@@ -14,8 +17,10 @@ import shutil
 import signal
 import subprocess
 import sys
+import tempfile
 import threading
 import time
+import zipfile
 
 import flask
 
@@ -23,11 +28,22 @@ from guild import op_util
 
 import app_util
 import detect
+import frame_archive
+import framebus
+import profiling
+import retention
+import session_tune
+import tracing
 
 log = logging.getLogger("scan")
 
 HOME = os.path.abspath(os.path.dirname(__file__))
 
+MAX_PROFILE_SECONDS = 60
+MAX_PROFILE_TRACE_RUNS = 100
+
+_profile_lock = threading.Lock()
+
 class PerformanceStats(object):
 
     def __init__(self, root_key="performance"):
@@ -76,18 +92,163 @@ class StatsLog(object):
         with self._lock:
             self.log.scalars(scalars)
 
+class ModelReloader(threading.Thread):
+    """Reloads the detector when its model files change.
+
+    A new detector is loaded and warmed in the background and then
+    swapped in for subsequent frames. Frames being detected when the
+    swap occurs finish on the previous detector, which is closed once
+    it's no longer in use. If the new detector can't be loaded, the
+    current detector is used as is.
+
+    Model files are checked for changes every `interval` seconds; 0
+    disables checks. A reload may also be requested using `reload`.
+    """
+
+    def __init__(self, init_detector, paths, interval=0):
+        super(ModelReloader, self).__init__()
+        self.daemon = True
+        self.paths = paths
+        self.interval = interval
+        self._init_detector = init_detector
+        self._lock = threading.Lock()
+        self._in_use = {}
+        self._reload_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._tracer = None
+        self._loaded_sig = self._paths_sig()
+        self._detector = init_detector()
+        self._stats = {
+            "reloads": 0,
+            "reload_errors": 0,
+            "loaded": time.time(),
+        }
+
+    def for_camera(self, camera_config):
+        return ReloaderRoute(self, camera_config)
+
+    @contextlib.contextmanager
+    def detector(self):
+        with self._lock:
+            detector = self._detector
+            self._in_use[detector] = self._in_use.get(detector, 0) + 1
+        try:
+            yield detector
+        finally:
+            with self._lock:
+                self._in_use[detector] -= 1
+                retired = (
+                    self._in_use[detector] == 0 and
+                    detector is not self._detector)
+                if self._in_use[detector] == 0:
+                    del self._in_use[detector]
+            if retired:
+                detector.close()
+
+    def reload(self):
+        """Requests a reload in the background."""
+        self._reload_event.set()
+
+    def run(self):
+        last_sig = self._loaded_sig
+        while not self._stop_event.is_set():
+            requested = self._reload_event.wait(self.interval or None)
+            if self._stop_event.is_set():
+                break
+            self._reload_event.clear()
+            sig = self._paths_sig()
+            # Files are reloaded once they've stopped changing to avoid
+            # loading a partially written graph.
+            if requested or (sig != self._loaded_sig and sig == last_sig):
+                self._reload(sig)
+            last_sig = sig
+
+    def _reload(self, sig):
+        log.info("reloading detector from %s", ", ".join(self.paths))
+        try:
+            detector = self._init_detector()
+            detector.warm()
+        except Exception as e:
+            if log.getEffectiveLevel() <= logging.DEBUG:
+                log.exception("reload")
+            log.error("error reloading detector: %s", e)
+            with self._lock:
+                self._stats["reload_errors"] += 1
+                # Don't retry until the files change again.
+                self._loaded_sig = sig
+            return
+        with self._lock:
+            old = self._detector
+            detector.trace(self._tracer)
+            self._detector = detector
+            self._loaded_sig = sig
+            self._stats["reloads"] += 1
+            self._stats["loaded"] = time.time()
+            retired = old not in self._in_use
+        if retired:
+            old.close()
+        print(" * Detector reloaded")
+
+    def trace(self, tracer):
+        with self._lock:
+            self._tracer = tracer
+            self._detector.trace(tracer)
+
+    def _paths_sig(self):
+        return tuple(_safe_mtime(path) for path in self.paths)
+
+    def stop(self):
+        self._stop_event.set()
+        self._reload_event.set()
+
+    def metrics(self):
+        with self.detector() as detector:
+            metrics = detector.metrics()
+        with self._lock:
+            metrics["model"] = dict(self._stats)
+        return metrics
+
+class ReloaderRoute(object):
+    """Detects using the current detector of a reloader."""
+
+    def __init__(self, reloader, camera_config):
+        self.reloader = reloader
+        self.camera_config = camera_config
+        # Validate camera config against the initial detector.
+        with reloader.detector() as detector:
+            detector.for_camera(camera_config)
+
+    def detect(self, image_bytes, roi=None, image=None):
+        with self.reloader.detector() as detector:
+            return detector.for_camera(self.camera_config).detect(
+                image_bytes, roi, image)
+
+def _safe_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
 class Worker(threading.Thread):
 
     def __init__(self, camera, detector, log, working_dir, interval,
-                 archive_steps=0):
+                 archive_steps=0, archive=None, tracer=None):
         super(Worker, self).__init__()
         self.key = camera.key
         self.camera = camera
-        self.detector = detector
+        self.detector = detector.for_camera(camera.config)
         self.log = log
         self.working_dir = working_dir
         self.interval = interval
         self.archive_steps = archive_steps
+        self.archive = archive
+        self.roi = detect.ROI.from_config(camera.config)
+        self.tracer = tracer or tracing.Tracer("scan")
+        self.detect_frame_id = None
+        self._served_frame_id = None
+        self._frame_id = None
+        self._frame = None
+        self._detect_frame = None
         self._stats = PerformanceStats()
         self._stop_event = threading.Event()
         self._image_path = os.path.join(
@@ -119,21 +280,62 @@ class Worker(threading.Thread):
                 self._handle_detect_error(e)
 
     def _snapshot(self):
+        self._frame = None
+        if isinstance(self.camera, framebus.FrameBusCamera):
+            self._read_bus_frame()
+            if self._archive_step():
+                # The frame refers to the bus slot, which may be reused
+                # while it's archived - archive a checked copy.
+                jpeg = bytes(self._frame.jpeg)
+                self._frame.check()
+                self._archive(self._image_path, "orig", jpeg)
+            return
+        if self.tracer.enabled:
+            self._traced_snapshot()
+        else:
+            self.camera.snapshot(self._image_path)
+        self._maybe_archive(self._image_path, "orig")
+
+    def _read_bus_frame(self):
+        # Bus frames are used in place rather than written to
+        # _image_path - see _detect.
+        start = time.time()
+        self._frame = self.camera.read_frame()
+        if self.tracer.enabled:
+            self._frame_id = (
+                self._frame.frame_id or tracing.new_frame_id())
+            self.tracer.record(
+                self._frame_id, self.key, "pull", start, time.time())
+
+    def _traced_snapshot(self):
+        # Frames from an image proxy carry the ID assigned on capture
+        # in a sidecar, otherwise frames are captured here.
+        from_proxy = isinstance(self.camera, app_util.CameraProxy)
+        tracing.remove_sidecar(self._image_path)
+        start = time.time()
         self.camera.snapshot(self._image_path)
-        self._maybe_archive(self._image_path, "-orig")
-
-    def _maybe_archive(self, path, suffix):
-        if self.archive_steps > 0 and (self._step % self.archive_steps) == 0:
-            self._archive(path, suffix)
-
-    def _archive(self, path, suffix):
-        path_dir = os.path.dirname(path)
+        end = time.time()
+        frame_id = from_proxy and tracing.read_sidecar(self._image_path)
+        self._frame_id = frame_id or tracing.new_frame_id()
+        self.tracer.record(
+            self._frame_id, self.key, "pull" if from_proxy else "capture",
+            start, end)
+
+    def _maybe_archive(self, path, kind, data=None):
+        if self._archive_step():
+            self._archive(path, kind, data)
+
+    def _archive_step(self):
+        return bool(
+            self.archive and self.archive_steps > 0 and
+            (self._step % self.archive_steps) == 0)
+
+    def _archive(self, path, kind, data=None):
         _, ext = os.path.splitext(path)
-        dest_name = (
-            "archive-{}-{:06d}{}{}".format(
-            self.key, self._step, suffix, ext))
-        dest = os.path.join(path_dir, dest_name)
-        shutil.copy(path, dest)
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        self.archive.append(self._step, kind, ext, data)
 
     def _handle_camera_error(self, e):
         if self._stop_event.is_set():
@@ -147,16 +349,45 @@ class Worker(threading.Thread):
         log.error("camera %s: %s", self.camera, msg)
 
     def _detect(self):
-        with open(self._image_path, "rb") as f:
-            image_bytes = f.read()
-        _result, detect_image = self.detector.detect(image_bytes)
-        with self._detect_image_lock:
-            self.detector.write_image(detect_image, self._detect_image_path)
-        self._maybe_archive(self._detect_image_path, "-detected")
+        frame = self._input_frame()
+        frame_id = self._frame_id
+        with self.tracer.span(frame_id, self.key, "detect"):
+            _result, detect_image = self.detector.detect(
+                frame.encoded, self.roi, frame.writable_image())
+        if self._frame is not None:
+            self._frame.check()
+        # The detect image is encoded once and shared by the detect
+        # image file, archive and app.
+        detect_frame = app_util.Frame(format="png", image=detect_image)
+        with self.tracer.span(frame_id, self.key, "write"):
+            png = detect_frame.encode("png")
+            with self._detect_image_lock:
+                with open(self._detect_image_path, "wb") as f:
+                    f.write(png)
+                self._detect_frame = detect_frame
+                self.detect_frame_id = frame_id
+        self._maybe_archive(self._detect_image_path, "detected", png)
+
+    def _input_frame(self):
+        if self._frame is not None:
+            return app_util.Frame(self._frame.jpeg, image=self._frame.image)
+        return app_util.Frame.from_file(self._image_path)
 
     def read_detect_image(self):
         with self._detect_image_lock:
-            return open(self._detect_image_path, "rb").read()
+            start = time.time()
+            if self._detect_frame is not None:
+                image_bytes = self._detect_frame.encode("png")
+            else:
+                image_bytes = open(self._detect_image_path, "rb").read()
+            # A frame is served once to each client that polls for it,
+            # so only the first serve is traced.
+            if self.detect_frame_id != self._served_frame_id:
+                self._served_frame_id = self.detect_frame_id
+                self.tracer.record(
+                    self.detect_frame_id, self.key, "serve", start,
+                    time.time())
+            return image_bytes
 
     def _handle_detect_error(self, e):
         if self._stop_event.is_set():
@@ -168,6 +399,11 @@ class Worker(threading.Thread):
     def stop(self):
         self._stop_event.set()
 
+    def close(self):
+        self.camera.close()
+        if self.archive:
+            self.archive.close()
+
 app = flask.Flask(
     __name__,
     static_url_path="",
@@ -198,6 +434,95 @@ def detected(key):
     else:
         return flask.Response(image_bytes, mimetype="image/png")
 
+@app.route("/reload", methods=["POST"])
+def reload():
+    _check_admin_token()
+    flask.current_app.detector.reload()
+    return flask.Response(
+        json.dumps({"reloading": True}),
+        status=202,
+        mimetype="application/json")
+
+@app.route("/metrics")
+def metrics():
+    metrics = flask.current_app.detector.metrics()
+    metrics["cameras"] = {
+        cam.key: cam.info() for cam in flask.current_app.cameras
+    }
+    return flask.Response(
+        json.dumps(metrics),
+        mimetype="application/json",
+        headers=[("Access-Control-Allow-Origin", "*")])
+
+@app.route("/admin/profile", methods=["POST"])
+def profile():
+    """Profiles worker threads for a period and returns the results.
+
+    The response is a zip file containing a speedscope profile and
+    collapsed stacks of sampled worker threads and, if `trace-runs` is
+    specified, a Chrome trace of up to that many graph runs.
+    """
+    _check_admin_token()
+    seconds = _float_arg("seconds", 10, MAX_PROFILE_SECONDS)
+    trace_runs = int(_float_arg("trace-runs", 0, MAX_PROFILE_TRACE_RUNS))
+    if not _profile_lock.acquire(False):
+        flask.abort(409, "profile already in progress")
+    try:
+        sampler, tracer = _run_profile(seconds, trace_runs)
+    finally:
+        _profile_lock.release()
+    return flask.Response(
+        _profile_zip(sampler, tracer),
+        mimetype="application/zip",
+        headers=[(
+            "Content-Disposition",
+            "attachment; filename=scan-profile-%i.zip" % time.time())])
+
+def _check_admin_token():
+    expected = flask.current_app.admin_token
+    if not expected:
+        flask.abort(404)
+    token = (
+        flask.request.headers.get("X-Admin-Token") or
+        flask.request.args.get("token") or "")
+    if not hmac.compare_digest(token.encode(), expected.encode()):
+        flask.abort(403)
+
+def _float_arg(name, default, max_val):
+    try:
+        val = float(flask.request.args.get(name, default))
+    except ValueError:
+        flask.abort(400, "invalid %s" % name)
+    return max(0, min(val, max_val))
+
+def _run_profile(seconds, trace_runs):
+    detector = flask.current_app.detector
+    tracer = detect.RunTracer(trace_runs) if trace_runs else None
+    sampler = profiling.ThreadSampler({
+        w.ident: w.key for w in flask.current_app.workers if w.ident
+    })
+    log.info(
+        "profiling workers for %.1fs (trace runs: %i)", seconds, trace_runs)
+    detector.trace(tracer)
+    sampler.start()
+    try:
+        time.sleep(seconds)
+    finally:
+        sampler.stop()
+        detector.trace(None)
+    return sampler, tracer
+
+def _profile_zip(sampler, tracer):
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(
+            "profile.speedscope.json",
+            json.dumps(sampler.speedscope("scan")))
+        zf.writestr("profile.folded", "\n".join(sampler.collapsed()))
+        if tracer:
+            zf.writestr("trace.json", json.dumps(tracer.chrome_trace()))
+    return out.getvalue()
+
 def _find_worker(key):
     for worker in flask.current_app.workers:
         if worker.key == key:
@@ -207,44 +532,131 @@ def _find_worker(key):
 def main():
     args = _parse_args()
     _init_logging(args)
-    cameras = _init_cameras(args)
-    detector = _init_detector(args)
+    config = app_util.load_config(args.config)
+    cameras = _init_cameras(config, args)
+    _maybe_tune_sessions(cameras, args)
+    detector = _init_reloader(args)
     log = _init_log(args)
-    workers = _start_workers(cameras, detector, log, args)
-    _init_signal_handlers(workers)
-    _start_app(cameras, workers, args)
+    tracer = _init_tracer(args)
+    workers = _start_workers(cameras, detector, log, tracer, args)
+    _maybe_start_retention(config, args)
+    _init_signal_handlers(workers, detector, tracer)
+    _start_app(cameras, detector, workers, args)
 
 def _init_logging(args):
     app_util.init_logging(args.debug)
 
-def _init_cameras(args):
-    config = app_util.load_config(args.config)
+def _init_cameras(config, args):
     return [
         _init_camera(key, config, args)
         for key in config.get("cameras", {})
     ]
 
 def _init_camera(key, config, args):
-    camera = app_util.init_camera(key, config, args.use_image_proxy)
+    camera = app_util.init_camera(
+        key, config, args.use_image_proxy,
+        sidecar=bool(args.trace_dir),
+        frame_bus_dir=_frame_bus_dir(args))
     log.debug("camera %s config: %s", key, camera.config)
     print(
         " * Camera %s configured to read from %s"
         % (key, camera.src))
     return camera
 
+def _frame_bus_dir(args):
+    if not args.use_frame_bus:
+        return None
+    return args.frame_bus_dir or framebus.default_bus_dir()
+
+def _maybe_tune_sessions(cameras, args):
+    if args.session_layout != "auto":
+        return
+    store = session_tune.LayoutStore(args.session_layout_file)
+    images_fn = lambda: _tune_images(cameras, args)
+    workers = max(1, len(cameras))
+    for graph, labels in _graphs(args):
+        session_tune.ensure_tuned(store, graph, labels, images_fn, workers)
+
+def _tune_images(cameras, args):
+    if args.tune_frames_dir:
+        images = session_tune.load_images(args.tune_frames_dir)
+        if not images:
+            raise SystemExit("no JPEG frames in %s" % args.tune_frames_dir)
+        return images
+    # Sample a frame from each camera, falling back to blank frames if
+    # cameras aren't available.
+    images = []
+    tmp = tempfile.mkdtemp(prefix="scan-tune-")
+    try:
+        for camera in cameras:
+            path = os.path.join(tmp, "%s.jpg" % camera.key)
+            try:
+                camera.snapshot(path)
+                with open(path, "rb") as f:
+                    images.append(detect.Detector.init_image(f.read()))
+            except Exception as e:
+                log.warning(
+                    "unable to sample %s for session tuning: %s",
+                    camera.key, e)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return images or session_tune.blank_images()
+
+def _graphs(args):
+    graphs = [(args.graph, args.labels)]
+    if args.screen_graph:
+        graphs.append((args.screen_graph, args.screen_labels or args.labels))
+    return graphs
+
+def _init_reloader(args):
+    reloader = ModelReloader(
+        lambda: _init_detector(args),
+        _model_paths(args),
+        args.reload_interval)
+    reloader.start()
+    return reloader
+
+def _model_paths(args):
+    paths = [args.graph, args.labels]
+    if args.screen_graph:
+        paths.append(args.screen_graph)
+        if args.screen_labels:
+            paths.append(args.screen_labels)
+    return paths
+
 def _init_detector(args):
-    d = detect.Detector(
-        args.graph,
-        args.labels,
-        args.box_line_size)
+    store = session_tune.LayoutStore(args.session_layout_file)
+    d = _init_graph_detector(args.graph, args.labels, store, args)
+    if args.screen_graph:
+        screen = _init_graph_detector(
+            args.screen_graph,
+            args.screen_labels or args.labels,
+            store,
+            args)
+        d = detect.Cascade(screen, d, args.screen_threshold)
     d.step = 0
     return d
 
+def _init_graph_detector(graph, labels, store, args):
+    layout = session_tune.init_layout(args.session_layout, graph, store)
+    log.info("using %s for %s", session_tune.format_layout(layout), graph)
+    return session_tune.init_detector(
+        graph,
+        labels,
+        layout,
+        box_line_size=args.box_line_size,
+        cache=detect.init_cache(args.cache_size, args.cache_dir))
+
 def _init_log(args):
     app_util.ensure_dir(args.log_dir)
     return StatsLog(args.log_dir)
 
-def _start_workers(cameras, detector, log, args):
+def _init_tracer(args):
+    tracer = tracing.Tracer("scan", args.trace_dir)
+    tracer.start()
+    return tracer
+
+def _start_workers(cameras, detector, log, tracer, args):
     workers = []
     app_util.ensure_dir(args.image_dir)
     for camera in cameras:
@@ -254,34 +666,58 @@ def _start_workers(cameras, detector, log, args):
             log,
             args.image_dir,
             args.interval,
-            args.archive_steps)
+            args.archive_steps,
+            _init_archive(camera, args),
+            tracer)
         worker.start()
         workers.append(worker)
     return workers
 
-def _init_signal_handlers(workers):
-    stop = lambda *_args: _stop(workers)
+def _init_archive(camera, args):
+    if args.archive_steps <= 0:
+        return None
+    return frame_archive.FrameArchive(
+        args.archive_dir,
+        camera.key,
+        args.archive_segment_size * 1024 * 1024)
+
+def _maybe_start_retention(config, args):
+    if "retention" not in config or args.archive_steps <= 0:
+        return
+    manager = retention.RetentionManager(config, archive_dir=args.archive_dir)
+    manager.start()
+    print(" * Retention applied to %s" % args.archive_dir)
+
+def _init_signal_handlers(workers, detector, tracer):
+    stop = lambda *_args: _stop(workers, detector, tracer)
     signal.signal(signal.SIGINT, stop)
     signal.signal(signal.SIGTERM, stop)
 
-def _stop(workers):
+def _stop(workers, detector, tracer):
     print("\b\bStopping")
+    detector.stop()
     for w in workers:
         w.stop()
     for w in workers:
         w.join()
+        w.close()
+    tracer.close()
     sys.exit(0)
 
-def _start_app(cameras, workers, args):
+def _start_app(cameras, detector, workers, args):
     app.cameras = cameras
+    app.detector = detector
     app.workers = workers
     app.image_dir = os.path.abspath(args.image_dir)
+    app.admin_token = args.admin_token
     if args.dev:
         app_port = args.port + 1
         _start_dev_server(args, app_port)
+        app.run(host=args.host, port=app_port)
+    elif args.production:
+        app_util.serve_app(app, args.host, args.port, args.threads)
     else:
-        app_port = args.port
-    app.run(host=args.host, port=app_port)
+        app.run(host=args.host, port=args.port)
 
 def _start_dev_server(args, app_port):
     app_home = os.path.join(HOME, "scan")
@@ -299,11 +735,27 @@ def _parse_args():
         "--use-image-proxy",
         action="store_true",
         help="Use image-proxy to obtain images")
+    p.add_argument(
+        "--use-frame-bus",
+        action="store_true",
+        help="Read images from the local frame bus published by pump")
+    p.add_argument(
+        "--frame-bus-dir", metavar="PATH",
+        help="Frame bus directory (/dev/shm)")
     p.add_argument(
         "--archive-steps", metavar="N",
         default=0,
         type=int,
         help="Archive at every Nth scan step; 0 disables archives (0)")
+    p.add_argument(
+        "--archive-dir", metavar="PATH",
+        default="archive",
+        help="Directory to write archive segments in (archive)")
+    p.add_argument(
+        "--archive-segment-size", metavar="MB",
+        default=256,
+        type=int,
+        help="Size at which archive segments are rolled over (256)")
     p.add_argument(
         "--graph", metavar="PATH",
         default="frozen_inference_graph.pb",
@@ -312,6 +764,45 @@ def _parse_args():
         "--labels", metavar="PATH",
         default="labels.pbtxt",
         help="Path to label proto")
+    p.add_argument(
+        "--screen-graph", metavar="PATH",
+        help=(
+            "Path to frozen detection graph used to screen frames; only "
+            "frames with screen detections are run through GRAPH"))
+    p.add_argument(
+        "--screen-labels", metavar="PATH",
+        help="Path to label proto for SCREEN_GRAPH (LABELS)")
+    p.add_argument(
+        "--screen-threshold", metavar="SCORE",
+        default=0.5,
+        type=float,
+        help="Minimum screen detection score to run GRAPH (0.5)")
+    p.add_argument(
+        "--reload-interval", metavar="SECONDS",
+        default=10.0,
+        type=float,
+        help=(
+            "Seconds between checks for changed graph and label files; "
+            "0 disables checks (10)"))
+    p.add_argument(
+        "--session-layout", metavar="LAYOUT",
+        default="default",
+        type=session_tune.layout_spec,
+        help=(
+            "Detector session threading: 'default' (default), 'auto' to "
+            "use the layout tuned for this host and graph, tuning it if "
+            "needed, or SESSIONS,INTRA,INTER; see session_tune.py"))
+    p.add_argument(
+        "--session-layout-file", metavar="PATH",
+        default=session_tune.DEFAULT_LAYOUT_FILE,
+        help=(
+            "File to store tuned session layouts in (%s)"
+            % session_tune.DEFAULT_LAYOUT_FILE))
+    p.add_argument(
+        "--tune-frames-dir", metavar="PATH",
+        help=(
+            "Directory of sample JPEG frames used to tune session layouts "
+            "(a frame from each camera by default)"))
     p.add_argument(
         "--host",
         default="0.0.0.0",
@@ -321,6 +812,15 @@ def _parse_args():
         default=8004,
         type=int,
         help="App port (8004)")
+    p.add_argument(
+        "--production",
+        action="store_true",
+        help="Serve app using a multi-threaded production server")
+    p.add_argument(
+        "--threads", metavar="N",
+        default=8,
+        type=int,
+        help="Number of server threads in production mode (8)")
     p.add_argument(
         "--image-dir", metavar="PATH",
         default="images",
@@ -339,6 +839,25 @@ def _parse_args():
         default=4,
         type=int,
         help="Bounding box line width (4)")
+    p.add_argument(
+        "--cache-size", metavar="MB",
+        default=0,
+        type=int,
+        help="Memory for cached detect results; 0 disables the cache (0)")
+    p.add_argument(
+        "--cache-dir", metavar="PATH",
+        help="Directory to save cached detect results in")
+    p.add_argument(
+        "--trace-dir", metavar="PATH",
+        help=(
+            "Write frame trace spans to PATH (disabled by default); "
+            "see tracing.py"))
+    p.add_argument(
+        "--admin-token", metavar="TOKEN",
+        default=os.getenv("SCAN_ADMIN_TOKEN"),
+        help=(
+            "Token required for admin endpoints (/admin/profile and /reload); "
+            "admin endpoints are disabled if not set (SCAN_ADMIN_TOKEN)"))
     p.add_argument(
         "--debug",
         action="store_true",
@@ -0,0 +1,363 @@
+"""Auto-tuning of TensorFlow session threading for detectors.
+
+By default a detector session uses as many intra- and inter-op threads
+as there are cores. When several workers detect at once this
+oversubscribes cores. A session layout sets the number of sessions a
+graph is run in (see `detect.DetectorPool`) and the intra- and
+inter-op threads used by each session.
+
+Layouts are tuned by detecting sample frames from `workers` threads
+using each candidate layout and picking the layout with the highest
+throughput. Tuned layouts are stored per host and graph in a layout
+file and are applied on startup by scan.py and detect.py with
+`--session-layout auto`.
+
+To tune a graph from the command line run:
+
+    python session_tune.py --graph frozen_inference_graph.pb \\
+      --labels labels.pbtxt --workers 4
+
+Each session loads its own copy of the graph, so layouts with more
+than one session use more memory.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import glob
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+
+import app_util
+import detect
+
+log = logging.getLogger("session_tune")
+
+Layout = collections.namedtuple("Layout", ["sessions", "intra_op", "inter_op"])
+
+# One session with TensorFlow's default threading.
+DEFAULT_LAYOUT = Layout(1, 0, 0)
+
+DEFAULT_LAYOUT_FILE = "session-layouts.json"
+
+DEFAULT_DURATION = 3.0
+
+INTER_OP_CHOICES = (1, 2)
+
+MAX_SAMPLE_FRAMES = 8
+
+def parse_layout(s):
+    """Parses a layout spec in the form SESSIONS,INTRA,INTER."""
+    try:
+        layout = Layout(*[int(part) for part in s.split(",")])
+    except (TypeError, ValueError):
+        raise ValueError(
+            "invalid session layout '%s' (expected SESSIONS,INTRA,INTER)"
+            % s)
+    if layout.sessions < 1 or layout.intra_op < 0 or layout.inter_op < 0:
+        raise ValueError("invalid session layout '%s'" % s)
+    return layout
+
+def layout_spec(s):
+    """Validates a layout spec for use as an argparse type."""
+    if s in ("default", "auto"):
+        return s
+    try:
+        parse_layout(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return s
+
+def format_layout(layout):
+    return "%i session(s), %s intra-op, %s inter-op thread(s)" % (
+        layout.sessions,
+        layout.intra_op or "default",
+        layout.inter_op or "default")
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+def host_key():
+    # Core count is part of the key as layouts don't carry over when
+    # a host is resized.
+    return "%s-%icpu" % (socket.gethostname(), cpu_count())
+
+def graph_digest(graph_path):
+    with open(graph_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class LayoutStore(object):
+    """Tuned layouts stored per host and graph in a JSON file."""
+
+    def __init__(self, path=DEFAULT_LAYOUT_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def get(self, digest, workers=None):
+        """Returns the layout tuned for digest on this host or None.
+
+        If workers is specified, layouts tuned for a different number
+        of workers aren't returned.
+        """
+        entry = self._host_entries().get(digest)
+        if entry is None:
+            return None
+        if workers is not None and entry.get("workers") != workers:
+            return None
+        return _entry_layout(entry)
+
+    def latest(self):
+        """Returns the layout most recently tuned on this host or None."""
+        entries = self._host_entries().values()
+        if not entries:
+            return None
+        return _entry_layout(max(entries, key=lambda entry: entry["tuned"]))
+
+    def put(self, digest, layout, rate, workers):
+        with self._lock:
+            layouts = self._load()
+            layouts.setdefault(host_key(), {})[digest] = {
+                "sessions": layout.sessions,
+                "intra-op": layout.intra_op,
+                "inter-op": layout.inter_op,
+                "rate": rate,
+                "workers": workers,
+                "tuned": time.time(),
+            }
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(layouts, f, indent=2, sort_keys=True)
+            os.rename(tmp, self.path)
+
+    def _host_entries(self):
+        return self._load().get(host_key(), {})
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+        except ValueError as e:
+            log.warning("ignoring invalid layout file %s: %s", self.path, e)
+            return {}
+
+def _entry_layout(entry):
+    return Layout(entry["sessions"], entry["intra-op"], entry["inter-op"])
+
+def init_detector(graph_path, labels_path, layout=DEFAULT_LAYOUT, **kw):
+    """Returns a detector for graph_path that uses layout.
+
+    Keyword args are passed through to each `detect.Detector`.
+    """
+    if layout == DEFAULT_LAYOUT:
+        return detect.Detector(graph_path, labels_path, **kw)
+    config = detect.session_config(layout.intra_op, layout.inter_op)
+    detectors = [
+        detect.Detector(graph_path, labels_path, session_config=config, **kw)
+        for _ in range(layout.sessions)
+    ]
+    if len(detectors) == 1:
+        return detectors[0]
+    return detect.DetectorPool(detectors)
+
+def candidate_layouts(cpus, workers):
+    """Returns layouts to try for `workers` concurrent detections.
+
+    Sessions never exceed workers and sessions times intra-op threads
+    never exceed cpus. The default layout is always included.
+    """
+    layouts = [DEFAULT_LAYOUT]
+    for sessions in _powers_of_two(min(workers, cpus)):
+        for intra_op in _powers_of_two(cpus // sessions):
+            for inter_op in INTER_OP_CHOICES:
+                layouts.append(Layout(sessions, intra_op, inter_op))
+    return layouts
+
+def _powers_of_two(n):
+    # Includes n itself for core counts that aren't a power of two.
+    vals = []
+    val = 1
+    while val <= n:
+        vals.append(val)
+        val *= 2
+    if vals and vals[-1] != n:
+        vals.append(n)
+    return vals
+
+def benchmark_layout(graph_path, labels_path, layout, images, workers,
+                     duration=DEFAULT_DURATION):
+    """Returns detections per second using layout.
+
+    images are decoded frames, which are detected for `duration`
+    seconds from `workers` threads.
+    """
+    detector = init_detector(graph_path, labels_path, layout)
+    try:
+        detector.warm()
+        counts = [0] * workers
+        errors = []
+        stop = threading.Event()
+        def run(i):
+            n = 0
+            try:
+                while not stop.is_set():
+                    detector.detect_image(
+                        images[(i + n) % len(images)], None)
+                    n += 1
+            except Exception as e:
+                # Other workers are stopped and the error is raised
+                # below - a failed layout has no meaningful rate.
+                errors.append(e)
+                stop.set()
+            counts[i] = n
+        threads = [
+            threading.Thread(target=run, args=(i,))
+            for i in range(workers)
+        ]
+        start = time.time()
+        for t in threads:
+            t.start()
+        stop.wait(duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return sum(counts) / (time.time() - start)
+    finally:
+        detector.close()
+
+def tune(graph_path, labels_path, images, workers,
+         duration=DEFAULT_DURATION, cpus=None):
+    """Returns the best layout, its rate and the rates of all layouts."""
+    rates = []
+    for layout in candidate_layouts(cpus or cpu_count(), workers):
+        rate = benchmark_layout(
+            graph_path, labels_path, layout, images, workers, duration)
+        log.info("%s: %.1f detections/s", format_layout(layout), rate)
+        rates.append((layout, rate))
+    best, best_rate = max(rates, key=lambda layout_rate: layout_rate[1])
+    return best, best_rate, rates
+
+def ensure_tuned(store, graph_path, labels_path, images_fn, workers,
+                 duration=DEFAULT_DURATION):
+    """Tunes graph_path unless a layout is stored for it.
+
+    images_fn is called to get sample images only if the graph is
+    tuned. Returns the layout for the graph.
+    """
+    digest = graph_digest(graph_path)
+    layout = store.get(digest, workers)
+    if layout is not None:
+        return layout
+    log.info(
+        "tuning session layout for %s with %i worker(s)",
+        graph_path, workers)
+    layout, rate, _ = tune(
+        graph_path, labels_path, images_fn(), workers, duration)
+    store.put(digest, layout, rate, workers)
+    log.info("using %s (%.1f detections/s)", format_layout(layout), rate)
+    return layout
+
+def init_layout(spec, graph_path, store):
+    """Returns the layout for graph_path given a layout spec.
+
+    spec is "default", "auto" or SESSIONS,INTRA,INTER. For "auto" the
+    layout stored for the graph is used, or if there isn't one (e.g.
+    a graph reloaded after startup) the layout most recently tuned on
+    this host.
+    """
+    if spec == "default":
+        return DEFAULT_LAYOUT
+    if spec != "auto":
+        return parse_layout(spec)
+    layout = store.get(graph_digest(graph_path))
+    if layout is None:
+        layout = store.latest()
+        if layout is None:
+            log.warning(
+                "no session layout tuned for %s - using default "
+                "threading", graph_path)
+            return DEFAULT_LAYOUT
+    return layout
+
+def load_images(frames_dir, limit=MAX_SAMPLE_FRAMES):
+    """Returns up to limit decoded JPEG frames from frames_dir."""
+    paths = sorted(
+        glob.glob(os.path.join(frames_dir, "*.jpg")) +
+        glob.glob(os.path.join(frames_dir, "*.jpeg")))[:limit]
+    images = []
+    for path in paths:
+        with open(path, "rb") as f:
+            images.append(detect.Detector.init_image(f.read()))
+    return images
+
+def blank_images():
+    return [np.zeros(detect.WARM_IMAGE_SHAPE, dtype=np.uint8)]
+
+def main():
+    args = _parse_args()
+    app_util.init_logging(args.debug)
+    images = (
+        load_images(args.frames_dir) if args.frames_dir
+        else blank_images())
+    if not images:
+        raise SystemExit("no JPEG frames in %s" % args.frames_dir)
+    layout, rate, rates = tune(
+        args.graph, args.labels, images, args.workers, args.duration)
+    for candidate, candidate_rate in rates:
+        print("%-50s %8.1f/s" % (format_layout(candidate), candidate_rate))
+    LayoutStore(args.layout_file).put(
+        graph_digest(args.graph), layout, rate, args.workers)
+    print("Best: %s (%.1f detections/s)" % (format_layout(layout), rate))
+
+def _parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--graph", metavar="PATH",
+        default="frozen_inference_graph.pb",
+        help="Path to frozen detection graph (frozen_inference_graph.pb)")
+    p.add_argument(
+        "--labels", metavar="PATH",
+        default="labels.pbtxt",
+        help="Path to label proto")
+    p.add_argument(
+        "--workers", metavar="N",
+        default=1,
+        type=int,
+        help="Number of concurrent detections to tune for (1)")
+    p.add_argument(
+        "--frames-dir", metavar="PATH",
+        help="Directory of sample JPEG frames (blank frames by default)")
+    p.add_argument(
+        "--duration", metavar="SECONDS",
+        default=DEFAULT_DURATION,
+        type=float,
+        help="Seconds to run each layout (%s)" % DEFAULT_DURATION)
+    p.add_argument(
+        "--layout-file", metavar="PATH",
+        default=DEFAULT_LAYOUT_FILE,
+        help="File to store tuned layouts in (%s)" % DEFAULT_LAYOUT_FILE)
+    p.add_argument(
+        "--debug",
+        action="store_true",
+        help="Print debug info")
+    return p.parse_args()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""Frame-level tracing across pump, image proxy and scan.
+
+Each frame is assigned an ID when it's captured. The ID is written
+to a sidecar file (`<image>.trace`) alongside the image and is copied
+with it to the image proxy and on to scan. Each process records spans
+for the stages a frame goes through:
+
+    pump    capture, push
+    scan    pull (or capture without an image proxy), detect, write,
+            serve
+
+Spans are kept in a ring buffer and are appended periodically by an
+exporter thread to `<trace-dir>/<process>-<pid>.jsonl`. If the
+exporter falls behind, the oldest spans are dropped.
+
+To join spans from trace files into per-frame latency breakdowns run:
+
+    python tracing.py --trace-dir traces
+
+Spans are timed using each host's wall clock, so hosts should be
+time-synchronized for cross-host latencies to be meaningful.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import contextlib
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import app_util
+
+log = logging.getLogger("tracing")
+
+SIDECAR_EXT = app_util.TRACE_SIDECAR_EXT
+
+RING_SIZE = 10000
+
+FLUSH_INTERVAL = 1.0
+
+STAGES = ("capture", "push", "pull", "detect", "write", "serve")
+
+class Tracer(object):
+    """Records frame spans for a process.
+
+    Tracing is disabled if trace_dir is None, in which case spans
+    aren't recorded.
+    """
+
+    def __init__(self, process, trace_dir=None, ring_size=RING_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self.process = process
+        self.trace_dir = trace_dir
+        self.enabled = trace_dir is not None
+        self.flush_interval = flush_interval
+        self._ring = collections.deque(maxlen=ring_size)
+        self._stop_event = threading.Event()
+        self._exporter = None
+
+    def start(self):
+        if not self.enabled:
+            return
+        app_util.ensure_dir(self.trace_dir)
+        path = os.path.join(
+            self.trace_dir, "%s-%i.jsonl" % (self.process, os.getpid()))
+        self._exporter = threading.Thread(target=self._export, args=(path,))
+        self._exporter.daemon = True
+        self._exporter.start()
+        log.info("writing trace spans to %s", path)
+
+    def _export(self, path):
+        while not self._stop_event.wait(self.flush_interval):
+            self._flush(path)
+        self._flush(path)
+
+    def _flush(self, path):
+        lines = []
+        while True:
+            try:
+                lines.append(json.dumps(self._ring.popleft()))
+            except IndexError:
+                break
+        if lines:
+            with open(path, "a") as f:
+                f.write("\n".join(lines) + "\n")
+
+    @contextlib.contextmanager
+    def span(self, frame_id, camera, name):
+        if not self.enabled or frame_id is None:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(frame_id, camera, name, start, time.time())
+
+    def record(self, frame_id, camera, name, start, end):
+        if not self.enabled or frame_id is None:
+            return
+        self._ring.append({
+            "frame": frame_id,
+            "camera": camera,
+            "name": name,
+            "process": self.process,
+            "start": start,
+            "end": end,
+        })
+
+    def close(self):
+        if self._exporter:
+            self._stop_event.set()
+            self._exporter.join()
+            self._exporter = None
+
+def new_frame_id():
+    return uuid.uuid4().hex
+
+def sidecar_path(image_path):
+    return image_path + SIDECAR_EXT
+
+def write_sidecar(image_path, frame_id, camera):
+    with open(sidecar_path(image_path), "w") as f:
+        json.dump({"frame": frame_id, "camera": camera}, f)
+
+def read_sidecar(image_path):
+    """Returns the frame ID in the sidecar for image_path or None."""
+    try:
+        with open(sidecar_path(image_path)) as f:
+            return json.load(f).get("frame")
+    except (IOError, OSError, ValueError):
+        return None
+
+def remove_sidecar(image_path):
+    try:
+        os.remove(sidecar_path(image_path))
+    except OSError:
+        pass
+
+def load_spans(trace_dir):
+    """Returns a dict of frame ID to spans read from trace_dir."""
+    frames = {}
+    for path in sorted(glob.glob(os.path.join(trace_dir, "*.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    log.warning("skipping invalid span in %s", path)
+                    continue
+                frames.setdefault(span["frame"], []).append(span)
+    return frames
+
+def frame_breakdown(spans):
+    """Returns stage durations, waits and total latency for a frame.
+
+    Only the first span of each stage is used (e.g. the first time a
+    detect image is served). Waits are the time between the end of
+    the previous stage and the start of a stage. Total latency is from
+    the start of capture to the end of the first serve and is None if
+    either is missing.
+    """
+    first = {}
+    for span in sorted(spans, key=lambda span: span["start"]):
+        first.setdefault(span["name"], span)
+    durations = {}
+    waits = {}
+    prev_end = None
+    for name in STAGES:
+        span = first.get(name)
+        if span is None:
+            continue
+        durations[name] = span["end"] - span["start"]
+        if prev_end is not None:
+            waits[name] = span["start"] - prev_end
+        prev_end = span["end"]
+    start = first.get("capture")
+    end = first.get("serve")
+    total = end["end"] - start["start"] if start and end else None
+    return durations, waits, total
+
+def summarize(frames, camera=None):
+    """Returns p50 and p99 latencies in ms across frames."""
+    durations = collections.defaultdict(list)
+    waits = collections.defaultdict(list)
+    totals = []
+    count = 0
+    for spans in frames.values():
+        if camera and spans[0]["camera"] != camera:
+            continue
+        count += 1
+        frame_durations, frame_waits, total = frame_breakdown(spans)
+        for name, val in frame_durations.items():
+            durations[name].append(val)
+        for name, val in frame_waits.items():
+            waits[name].append(val)
+        if total is not None:
+            totals.append(total)
+    return {
+        "frames": count,
+        "complete": len(totals),
+        "stages": {
+            name: _percentiles(durations[name])
+            for name in STAGES if durations[name]
+        },
+        "waits": {
+            name: _percentiles(waits[name])
+            for name in STAGES if waits[name]
+        },
+        "total": _percentiles(totals) if totals else None,
+    }
+
+def _percentiles(vals):
+    vals = sorted(vals)
+    pick = lambda p: vals[min(len(vals) - 1, int(p * len(vals)))] * 1000
+    return {"p50": pick(0.5), "p99": pick(0.99), "n": len(vals)}
+
+def _print_summary(summary):
+    print("%(frames)i frame(s), %(complete)i capture to display" % summary)
+    print("%-12s %10s %10s %8s" % ("", "p50 ms", "p99 ms", "n"))
+    for name in STAGES:
+        for label, group in (("  wait", "waits"), (name, "stages")):
+            stats = summary[group].get(name)
+            if stats:
+                print("%-12s %10.1f %10.1f %8i" % (
+                    label, stats["p50"], stats["p99"], stats["n"]))
+    if summary["total"]:
+        total = summary["total"]
+        print("%-12s %10.1f %10.1f %8i" % (
+            "total", total["p50"], total["p99"], total["n"]))
+
+def main():
+    args = _parse_args()
+    app_util.init_logging(args.debug)
+    summary = summarize(load_spans(args.trace_dir), args.camera)
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        _print_summary(summary)
+
+def _parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--trace-dir", metavar="PATH",
+        default="traces",
+        help="Directory containing trace files (traces)")
+    p.add_argument(
+        "--camera",
+        help="Summarize frames for CAMERA only")
+    p.add_argument(
+        "--json",
+        action="store_true",
+        help="Print summary as JSON")
+    p.add_argument(
+        "--debug",
+        action="store_true",
+        help="Print debug info")
+    return p.parse_args()
+
+if __name__ == "__main__":
+    main()